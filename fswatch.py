@@ -0,0 +1,166 @@
+import asyncio
+import ctypes
+import ctypes.util
+import glob
+import logging
+import os
+import struct
+import sys
+import time
+
+# === ОТСЛЕЖИВАНИЕ ФАЙЛОВ ЗАПРОСОВ ===
+# На Linux юзербот узнаёт о новых файлах через inotify сразу после их записи,
+# на остальных системах (или если inotify недоступен) — опросом директории.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+RESCAN_INTERVAL = 30  # секунд: страховочный просмотр директории (пропущенные события, файлы, не удалённые после ошибки)
+
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+logger = logging.getLogger(__name__)
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class PollingWatcher:
+    """
+    Опрос директории через glob раз в poll_interval секунд. Возвращает файлы,
+    которых не было при прошлом опросе, а раз в RESCAN_INTERVAL — все найденные.
+    """
+
+    mode = 'polling'
+
+    def __init__(self, directory, prefix, suffix, poll_interval):
+        self._pattern = os.path.join(directory, f"{prefix}*{suffix}")
+        self._poll_interval = poll_interval
+        self._seen = set()
+        self._last_full_scan = 0.0
+
+    async def start(self):
+        pass
+
+    async def get(self):
+        """Ждёт и возвращает список новых файлов."""
+        while True:
+            files = glob.glob(self._pattern)
+            now = time.monotonic()
+            if now - self._last_full_scan >= RESCAN_INTERVAL:
+                self._last_full_scan = now
+                new_files = files
+            else:
+                new_files = [path for path in files if path not in self._seen]
+            self._seen = set(files)
+            if new_files:
+                return new_files
+            await asyncio.sleep(self._poll_interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Уведомления inotify о закрытых после записи (IN_CLOSE_WRITE) или перемещённых
+    в директорию (IN_MOVED_TO) файлах. При старте и при переполнении очереди
+    событий директория просматривается целиком, чтобы не потерять запросы.
+    """
+
+    mode = 'inotify'
+
+    def __init__(self, directory, prefix, suffix, libc):
+        self._directory = directory
+        self._prefix = prefix
+        self._suffix = suffix
+        self._libc = libc
+        self._fd = None
+        self._ready = asyncio.Event()
+        self._found = {}  # путь -> None, сохраняет порядок появления без повторов
+
+    async def start(self):
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = self._libc.inotify_add_watch(fd, os.fsencode(self._directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, f"inotify_add_watch failed for {self._directory}")
+        self._fd = fd
+        asyncio.get_running_loop().add_reader(fd, self._on_readable)
+        self._rescan()
+
+    def _matches(self, name):
+        return name.startswith(self._prefix) and name.endswith(self._suffix)
+
+    def _add(self, path):
+        self._found[path] = None
+        self._ready.set()
+
+    def _rescan(self):
+        for path in glob.glob(os.path.join(self._directory, f"{self._prefix}*{self._suffix}")):
+            self._add(path)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            _, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("[FS] Переполнение очереди inotify, пересканируем директорию.")
+                self._rescan()
+            elif name and self._matches(name):
+                self._add(os.path.join(self._directory, name))
+
+    async def get(self):
+        """Ждёт и возвращает список новых файлов."""
+        while not self._ready.is_set():
+            try:
+                await asyncio.wait_for(self._ready.wait(), RESCAN_INTERVAL)
+            except asyncio.TimeoutError:
+                self._rescan()
+        files = list(self._found)
+        self._found.clear()
+        self._ready.clear()
+        return files
+
+    def close(self):
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+
+async def create_watcher(directory, prefix, suffix, poll_interval, use_inotify=True):
+    """Создаёт и запускает inotify-наблюдатель, а если он недоступен — опрос директории."""
+    libc = _load_libc() if use_inotify else None
+    if libc is not None:
+        watcher = InotifyWatcher(directory, prefix, suffix, libc)
+        try:
+            await watcher.start()
+            return watcher
+        except OSError as e:
+            logger.warning(f"[FS] inotify недоступен ({e}), используем опрос директории.")
+    watcher = PollingWatcher(directory, prefix, suffix, poll_interval)
+    await watcher.start()
+    return watcher
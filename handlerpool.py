@@ -0,0 +1,73 @@
+import asyncio
+import functools
+import logging
+import time
+
+# === ЛИМИТЫ ОБРАБОТЧИКОВ ===
+# Бот обрабатывает обновления конкурентно (concurrent_updates), обработчики делятся
+# на классы (быстрые — только база, резолвер — ждут юзербота). У каждого класса
+# свой лимит одновременно выполняемых обработчиков и ограниченная очередь ждущих,
+# поэтому поток медленных проверок не задерживает /start, /help и списки.
+
+logger = logging.getLogger(__name__)
+
+
+class HandlerPool:
+    """Лимит одновременных обработчиков одного класса с ограниченной очередью и метриками."""
+
+    def __init__(self, name, workers, max_queue):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self._semaphore = asyncio.Semaphore(workers)
+        self._waiting = 0
+        self._busy = 0
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'max_depth': 0, 'wait_total': 0.0}
+
+    def wrap(self, callback, on_reject=None):
+        """Обработчик для регистрации в приложении: выполняет callback в пределах лимита пула."""
+        @functools.wraps(callback)
+        async def handler(update, context):
+            if self._waiting >= self.max_queue:
+                self.stats['rejected'] += 1
+                logger.warning(f"[Pool] Очередь пула '{self.name}' переполнена, {callback.__name__} отклонён.")
+                if on_reject is not None:
+                    await on_reject(update, context)
+                return None
+            self.stats['submitted'] += 1
+            queued_at = time.monotonic()
+            self._waiting += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], self._waiting)
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self._waiting -= 1
+            self.stats['wait_total'] += time.monotonic() - queued_at
+            self._busy += 1
+            try:
+                result = await callback(update, context)
+            except Exception:
+                self.stats['failed'] += 1
+                raise
+            finally:
+                self._busy -= 1
+                self._semaphore.release()
+            self.stats['completed'] += 1
+            return result
+        return handler
+
+    def metrics(self):
+        """Текущее состояние пула: занятые слоты, глубина очереди и счётчики."""
+        stats = self.stats
+        finished = stats['completed'] + stats['failed']
+        return {
+            'workers': self.workers,
+            'busy': self._busy,
+            'depth': self._waiting,
+            'max_depth': stats['max_depth'],
+            'submitted': stats['submitted'],
+            'completed': stats['completed'],
+            'failed': stats['failed'],
+            'rejected': stats['rejected'],
+            'avg_wait_ms': round(stats['wait_total'] / finished * 1000, 1) if finished else 0.0,
+        }
@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import storage
+
+# === ЗДОРОВЬЕ ЮЗЕРБОТА ===
+# Юзербот раз в HEARTBEAT_INTERVAL секунд пишет в общую базу heartbeat: время,
+# авторизована ли сессия, глубину очереди. main.py по нему и по результатам
+# запросов ведёт автоматический выключатель (circuit breaker): пока юзербот
+# недоступен, запросы к нему сразу завершаются ошибкой вместо ожидания таймаута.
+HEARTBEAT_INTERVAL = 5  # секунд между записями heartbeat
+HEARTBEAT_STALE = 15  # heartbeat старше этого — юзербот считается недоступным
+BREAKER_FAILURE_THRESHOLD = 3  # неудачных запросов подряд до размыкания
+BREAKER_COOLDOWN = 15  # секунд до пробного запроса после размыкания
+BREAKER_PROBE_TIMEOUT = 60  # если пробный запрос не отчитался за это время, разрешаем новый
+HEARTBEAT_CACHE_SECONDS = 1  # как часто main.py перечитывает heartbeat из базы
+
+logger = logging.getLogger(__name__)
+
+
+def init_table(conn=None):
+    conn = conn or storage.get_connection()
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ub_heartbeat (
+                id INTEGER PRIMARY KEY CHECK (id = 1),  -- одна строка
+                updated_at REAL NOT NULL,
+                pid INTEGER,
+                authorized INTEGER NOT NULL,
+                queue_depth INTEGER NOT NULL DEFAULT 0,
+                details TEXT  -- JSON: состояние ограничителя и т. п.
+            )
+        ''')
+
+
+def publish_heartbeat(authorized, queue_depth, details=None):
+    """Вызывается юзерботом: сообщает, что он жив."""
+    conn = storage.get_connection()
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO ub_heartbeat (id, updated_at, pid, authorized, queue_depth, details)
+            VALUES (1, ?, ?, ?, ?, ?)
+        ''', (time.time(), os.getpid(), 1 if authorized else 0, queue_depth,
+              json.dumps(details, ensure_ascii=False) if details is not None else None))
+
+
+def mark_stopped():
+    """Вызывается юзерботом при остановке: main.py разомкнёт выключатель, не дожидаясь устаревания heartbeat."""
+    conn = storage.get_connection()
+    with conn:
+        conn.execute('UPDATE ub_heartbeat SET updated_at = 0, authorized = 0 WHERE id = 1')
+
+
+def read_heartbeat():
+    row = storage.get_connection().execute(
+        'SELECT updated_at, pid, authorized, queue_depth, details FROM ub_heartbeat WHERE id = 1').fetchone()
+    if not row:
+        return None
+    updated_at, pid, authorized, queue_depth, details = row
+    return {
+        'updated_at': updated_at,
+        'pid': pid,
+        'authorized': bool(authorized),
+        'queue_depth': queue_depth,
+        'details': json.loads(details) if details else None,
+    }
+
+
+def heartbeat_problem(heartbeat):
+    """Причина, по которой юзербот считается недоступным, или None."""
+    if heartbeat is None:
+        return "юзербот ещё ни разу не отправлял heartbeat"
+    if heartbeat['updated_at'] == 0:
+        return "юзербот остановлен"
+    age = time.time() - heartbeat['updated_at']
+    if age > HEARTBEAT_STALE:
+        return f"heartbeat устарел на {int(age)} с"
+    if not heartbeat['authorized']:
+        return "сессия юзербота не авторизована"
+    return None
+
+
+class CircuitBreaker:
+    """
+    Выключатель для запросов к юзерботу.
+    closed — запросы идут; open — сразу отказ (heartbeat плохой или
+    BREAKER_FAILURE_THRESHOLD неудач подряд); half_open — после BREAKER_COOLDOWN
+    пропускается один пробный запрос, его успех замыкает выключатель.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, use_heartbeat=True, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.use_heartbeat = use_heartbeat
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.reason = None
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+        self._heartbeat_checked = 0.0
+        self._heartbeat_problem = None
+        self.stats = {'allowed': 0, 'rejected': 0, 'opened': 0}
+
+    def heartbeat_problem(self):
+        """Проблема по heartbeat (с кэшем на HEARTBEAT_CACHE_SECONDS) или None."""
+        if not self.use_heartbeat:
+            return None
+        now = time.monotonic()
+        if now - self._heartbeat_checked >= HEARTBEAT_CACHE_SECONDS:
+            try:
+                self._heartbeat_problem = heartbeat_problem(read_heartbeat())
+            except Exception as e:
+                self._heartbeat_problem = f"не удалось прочитать heartbeat: {e}"
+            self._heartbeat_checked = now
+        return self._heartbeat_problem
+
+    def _open(self, reason):
+        if self.state != self.OPEN:
+            self.stats['opened'] += 1
+            logger.warning(f"[Breaker] Юзербот недоступен ({reason}), запросы к нему приостановлены.")
+        self.state = self.OPEN
+        self.reason = reason
+        self._opened_at = time.monotonic()
+
+    def allow(self):
+        """Можно ли сейчас обращаться к юзерботу. Возвращает (разрешено, причина отказа)."""
+        with self._lock:
+            problem = self.heartbeat_problem()
+            now = time.monotonic()
+            if self.state == self.CLOSED and problem:
+                self._open(problem)
+            elif self.state == self.OPEN:
+                if problem:
+                    self.reason = problem
+                elif now - self._opened_at >= self.cooldown:
+                    self.state = self.HALF_OPEN
+                    self._probe_started = now
+                    logger.info("[Breaker] Пробный запрос к юзерботу.")
+                    self.stats['allowed'] += 1
+                    return True, None
+            elif self.state == self.HALF_OPEN and now - self._probe_started > BREAKER_PROBE_TIMEOUT:
+                self._probe_started = now
+                self.stats['allowed'] += 1
+                return True, None
+            if self.state == self.CLOSED:
+                self.stats['allowed'] += 1
+                return True, None
+            self.stats['rejected'] += 1
+            return False, self.reason or "идёт пробный запрос"
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("[Breaker] Юзербот снова отвечает, запросы возобновлены.")
+            self.state = self.CLOSED
+            self.reason = None
+            self._failures = 0
+
+    def record_failure(self, reason):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._open(reason)
@@ -0,0 +1,154 @@
+import json
+import logging
+import time
+import uuid
+
+import storage
+
+# === ЖУРНАЛ ЗАДАНИЙ ЮЗЕРБОТА ===
+# Каждый файловый запрос main.py дублируется строкой в таблице ub_jobs общей базы.
+# Юзербот берёт задание в аренду (lease) до удаления файла запроса и записывает
+# результат при выполнении. Если юзербот перезапустился посреди задания, после
+# старта он продолжает задания прежнего процесса, а задания с истёкшей арендой
+# подбирает периодически. main.py забирает результат из таблицы, даже если файл
+# ответа так и не появился. Юзербот пишет файл ответа до отметки о выполнении,
+# поэтому main.py, увидев результат в журнале, удаляет уже записанный файл.
+LEASE_SECONDS = 45  # аренда задания; по истечении оно считается брошенным
+# Задание без аренды дольше этого и без файла запроса на диске — файл потерян. Пока файл
+# лежит, задание просто ждёт своей очереди у юзербота и подбирать его нельзя
+PENDING_GRACE = 5  # секунд
+DONE_RETENTION = 3600  # секунд хранения выполненных и просроченных заданий
+
+# Идентификатор процесса-арендатора: задания с чужим владельцем после перезапуска — брошенные
+OWNER = uuid.uuid4().hex
+
+logger = logging.getLogger(__name__)
+
+
+def init_table(conn=None):
+    """Создаёт таблицу заданий (вызывают и main.py, и userbot.py — кто стартует первым)."""
+    conn = conn or storage.get_connection()
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ub_jobs (
+                id TEXT PRIMARY KEY,  -- UUID запроса из имени файла
+                query TEXT NOT NULL,
+                priority TEXT NOT NULL,
+                response_file TEXT,  -- относительное имя файла ответа
+                state TEXT NOT NULL,  -- pending / leased / done
+                lease_owner TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,  -- JSON-ответ юзербота
+                created_at REAL NOT NULL,
+                deadline REAL NOT NULL  -- после этого main.py ответ уже не ждёт
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_ub_jobs_state ON ub_jobs (state, lease_until)')
+
+
+def enqueue(job_id, query, priority, response_file, deadline):
+    conn = storage.get_connection()
+    with conn:
+        conn.execute('''
+            INSERT OR IGNORE INTO ub_jobs (id, query, priority, response_file, state, created_at, deadline)
+            VALUES (?, ?, ?, ?, 'pending', ?, ?)
+        ''', (job_id, query, priority, response_file, time.time(), deadline))
+
+
+def lease(job_id):
+    """
+    Берёт задание в аренду. Возвращает 'leased', 'done' (уже выполнено),
+    'busy' (аренда у другого обработчика ещё действует) или 'missing'
+    (запрос без записи в журнале — например, от старой версии main.py).
+    """
+    conn = storage.get_connection()
+    now = time.time()
+    with conn:
+        cursor = conn.execute('''
+            UPDATE ub_jobs SET state = 'leased', lease_owner = ?, lease_until = ?, attempts = attempts + 1
+            WHERE id = ? AND (state = 'pending' OR (state = 'leased' AND lease_until < ?))
+        ''', (OWNER, now + LEASE_SECONDS, job_id, now))
+    if cursor.rowcount:
+        return 'leased'
+    row = conn.execute('SELECT state FROM ub_jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None:
+        return 'missing'
+    return 'done' if row[0] == 'done' else 'busy'
+
+
+def claim_abandoned(orphaned_only=False, limit=100, request_file_exists=None):
+    """
+    Берёт в аренду брошенные задания, которые main.py ещё ждёт: аренды прежних
+    процессов (orphaned_only=True — при старте юзербота) либо истёкшие аренды и
+    задания, чей файл запроса потерян. request_file_exists(job_id) — лежит ли ещё
+    файл запроса: такие задания остаются обработчику файлов. Возвращает список
+    (id, query, priority, response_file, deadline).
+    """
+    conn = storage.get_connection()
+    now = time.time()
+    if orphaned_only:
+        rows = conn.execute('''
+            SELECT id FROM ub_jobs WHERE state = 'leased' AND lease_owner != ? AND deadline > ?
+            LIMIT ?
+        ''', (OWNER, now, limit)).fetchall()
+    else:
+        rows = conn.execute('''
+            SELECT id, state FROM ub_jobs
+            WHERE deadline > ? AND ((state = 'leased' AND lease_until < ?) OR (state = 'pending' AND created_at < ?))
+            LIMIT ?
+        ''', (now, now, now - PENDING_GRACE, limit)).fetchall()
+        if request_file_exists is not None:
+            rows = [(job_id,) for job_id, state in rows if state != 'pending' or not request_file_exists(job_id)]
+        else:
+            rows = [(job_id,) for job_id, _ in rows]
+    claimed = []
+    for (job_id,) in rows:
+        with conn:
+            cursor = conn.execute('''
+                UPDATE ub_jobs SET state = 'leased', lease_owner = ?, lease_until = ?, attempts = attempts + 1
+                WHERE id = ? AND (state = 'pending' OR (state = 'leased' AND (lease_owner != ? OR lease_until < ?)))
+            ''', (OWNER, now + LEASE_SECONDS, job_id, OWNER, now))
+        if cursor.rowcount:
+            claimed.append(conn.execute('SELECT id, query, priority, response_file, deadline FROM ub_jobs WHERE id = ?',
+                                        (job_id,)).fetchone())
+    return claimed
+
+
+def is_open(job_id):
+    """True, если задание есть в журнале и ещё не выполнено (main.py его ждёт)."""
+    row = storage.get_connection().execute('SELECT state FROM ub_jobs WHERE id = ?', (job_id,)).fetchone()
+    return row is not None and row[0] != 'done'
+
+
+def complete(job_id, result):
+    """Записывает результат. Повторное выполнение того же задания ничего не меняет; True — записал этот вызов."""
+    conn = storage.get_connection()
+    with conn:
+        cursor = conn.execute('''
+            UPDATE ub_jobs SET state = 'done', result = ?, lease_until = NULL
+            WHERE id = ? AND state != 'done'
+        ''', (json.dumps(result, ensure_ascii=False), job_id))
+    return cursor.rowcount == 1
+
+
+def get_result(job_id):
+    """Результат выполненного задания или None, если оно ещё не выполнено."""
+    row = storage.get_connection().execute(
+        "SELECT result FROM ub_jobs WHERE id = ? AND state = 'done'", (job_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def delete(job_id):
+    conn = storage.get_connection()
+    with conn:
+        conn.execute('DELETE FROM ub_jobs WHERE id = ?', (job_id,))
+
+
+def purge():
+    """Удаляет задания, которые main.py уже не заберёт."""
+    conn = storage.get_connection()
+    with conn:
+        cursor = conn.execute('DELETE FROM ub_jobs WHERE deadline < ?', (time.time() - DONE_RETENTION,))
+    if cursor.rowcount:
+        logger.info(f"[Jobs] Удалено старых заданий: {cursor.rowcount}")
@@ -0,0 +1,87 @@
+import logging
+import os
+import socket
+import time
+import uuid
+
+import storage
+
+# === ВЫБОР ЛИДЕРА ДЛЯ ПЛАНИРОВЩИКА ===
+# При нескольких воркерах main.py планировщик запущен в каждом, но задачи
+# (бэкап, синхронизация с GitHub) выполняет только держатель аренды в таблице
+# leader_lease общей базы. Лидер продлевает аренду каждые RENEW_INTERVAL секунд;
+# если он упал, через LEASE_SECONDS аренду забирает другой воркер.
+LEASE_SECONDS = 60
+RENEW_INTERVAL = 20
+
+# Идентификатор процесса-претендента (хост и pid — для логов, uuid — от совпадения pid после перезапуска)
+HOLDER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+logger = logging.getLogger(__name__)
+
+
+def init_table(conn=None):
+    conn = conn or storage.get_connection()
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS leader_lease (
+                name TEXT PRIMARY KEY,  -- что захвачено (например, "scheduler")
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+
+
+def try_acquire(name, ttl=LEASE_SECONDS):
+    """Берёт или продлевает аренду name. True — этот процесс лидер до now + ttl."""
+    conn = storage.get_connection()
+    now = time.time()
+    with conn:
+        conn.execute('''
+            INSERT INTO leader_lease (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE leader_lease.holder = excluded.holder OR leader_lease.expires_at <= ?
+        ''', (name, HOLDER, now + ttl, now))
+        row = conn.execute('SELECT holder FROM leader_lease WHERE name = ?', (name,)).fetchone()
+    return row is not None and row[0] == HOLDER
+
+
+def release(name):
+    """Отдаёт аренду при остановке, чтобы другой воркер не ждал её истечения."""
+    conn = storage.get_connection()
+    with conn:
+        conn.execute('DELETE FROM leader_lease WHERE name = ? AND holder = ?', (name, HOLDER))
+
+
+class Leadership:
+    """Аренда name с кэшем: is_leader() не ходит в базу чаще раза в RENEW_INTERVAL."""
+
+    def __init__(self, name):
+        self.name = name
+        self._leader = False
+        self._checked_at = 0.0
+
+    def renew(self):
+        try:
+            leader = try_acquire(self.name)
+        except Exception as e:
+            logger.warning(f"[Leader] Не удалось продлить аренду '{self.name}': {e}")
+            leader = False
+        if leader != self._leader:
+            logger.info(f"[Leader] {HOLDER} {'стал' if leader else 'больше не'} лидер(ом) '{self.name}'.")
+        self._leader = leader
+        self._checked_at = time.monotonic()
+        return leader
+
+    def is_leader(self):
+        if time.monotonic() - self._checked_at >= RENEW_INTERVAL:
+            return self.renew()
+        return self._leader
+
+    def release(self):
+        if self._leader:
+            try:
+                release(self.name)
+            except Exception as e:
+                logger.warning(f"[Leader] Не удалось освободить аренду '{self.name}': {e}")
+            self._leader = False
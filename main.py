@@ -1,23 +1,79 @@
 import logging
-import sqlite3
 import os
 import re
 import time
 import json
 import uuid
-from telegram import Update, ParseMode, InlineQueryResultPhoto, InputTextMessageContent, InlineQueryResultArticle
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, ConversationHandler, InlineQueryHandler
-import shutil
+import asyncio
+import signal
+import functools
+from telegram import Bot, Update, InlineQueryResultPhoto, InputTextMessageContent, InlineQueryResultArticle
+from telegram.constants import ParseMode
+from telegram.error import TelegramError
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, ConversationHandler, InlineQueryHandler
 from datetime import datetime, timedelta
 import glob
+from collections import OrderedDict
 from apscheduler.schedulers.background import BackgroundScheduler
 import requests
+import storage
+import ubrpc
+import jobstore
+import health
+import handlerpool
+import webhook
+import persistence
+import leader
+import workers
+import media
+import prefix_index
+import rendering
 
 # === ЗАГРУЗКА КОНФИГУРАЦИИ ===
 CONFIG_FILE = 'config.json'
 UB_REQUEST_PREFIX = "ubreq_"
 UB_RESPONSE_PREFIX = "ubresp_"
 COMMUNICATION_DIR = "."
+UB_REQUEST_TIMEOUT = 30  # секунд ожидания ответа юзербота (если для класса запроса нет своего срока)
+# Классы приоритета запросов к юзерботу (см. PRIORITY_OFFSETS в userbot.py):
+# "inline", "pm" (/check и личка), "admin" (добавление в базу), "background" (автообновление, канал)
+UB_DEFAULT_PRIORITY = 'pm'
+# Срок запроса к юзерботу (секунд) по классу: после него main.py перестаёт ждать,
+# а юзербот выбрасывает запрос, не обращаясь к Telegram
+UB_DEADLINES = {
+    'inline': 8,
+    'pm': 20,
+    'admin': 45,
+    'background': 60,
+}
+# Классы от самого строгого к самому мягкому (как PRIORITY_OFFSETS в userbot.py)
+UB_PRIORITY_ORDER = ('inline', 'pm', 'admin', 'background')
+# Клиент ждёт ответа на столько дольше срока запроса: просрочку должен сообщить сам
+# юзербот (deadline_exceeded), а не таймаут на стороне main.py, который неотличим от отказа
+UB_DEADLINE_GRACE = 2  # секунд
+# Файловый обмен: наличие файла ответа проверяется каждые 100 мс, а heartbeat и журнал
+# заданий (запросы в пул БД) — не чаще раза в столько секунд
+UB_FILE_DB_CHECK_INTERVAL = 1.0
+INLINE_ANSWER_BUDGET = 3  # секунд: дольше inline-ответ юзербота не ждёт, а показывает «проверяем…»
+# Сколько помнить ошибочные ответы юзербота (секунд) по классу ошибки.
+# Для flood_wait срок берётся из ответа (retry_after), остальные ошибки не кэшируются.
+NEGATIVE_CACHE_TTL = {
+    'not_user': 24 * 3600,  # канал или чат, а не пользователь
+    'invalid': 24 * 3600,  # недопустимый юзернейм или ID
+    'not_found': 3600,  # юзернейм свободен — его могут занять
+    # 'unresolved' (ID нет в кэше сущностей юзербота) не кэшируется: пользователь может существовать
+}
+# Лимиты обработчиков (см. handlerpool.py): "fast" — команды, которые ходят
+# только в базу, "resolver" — обработчики, ждущие ответа юзербота. workers —
+# сколько обработчиков класса выполняется одновременно, queue — сколько может ждать.
+# Переопределяются секцией "handlers" в config.json. Резолверов одновременно не больше,
+# чем юзербот может обслужить (RESOLVE_CONCURRENCY_MAX в userbot.py), а очередь — столько,
+# сколько он разберёт за срок ответа при RESOLVE_RATE_MAX вызовов в секунду.
+HANDLER_POOL_DEFAULTS = {
+    'fast': {'workers': 32, 'queue': 500},
+    'resolver': {'workers': 32, 'queue': 100},
+}
+WEBHOOK_MAX_PENDING = 1000  # обновлений в очереди бота, дальше вебхук отвечает 503
 def load_settings():
     """Загружает настройки из config.json."""
     if not os.path.exists(CONFIG_FILE):
@@ -29,12 +85,22 @@ def load_settings():
         raise ValueError(f"Ошибка чтения {CONFIG_FILE}: {e}")
 
     # Присваиваем значения глобальным переменным
-    global BOT_TOKEN, ADMIN_IDS, CHANNEL_SCAM, CHANNEL_TRUSTED, CHANNEL_ID
+    global CONFIG, BOT_TOKEN, ADMIN_IDS, CHANNEL_SCAM, CHANNEL_TRUSTED, CHANNEL_ID, UB_IPC_CONFIG, HANDLER_POOLS_CONFIG, WEBHOOK_CONFIG, WORKERS_CONFIG
+    CONFIG = config  # Целиком — для планировщика (backup, github_sync)
     BOT_TOKEN = config['bot_token']
     ADMIN_IDS = set(config['admin_ids']) # Преобразуем список в множество
     CHANNEL_SCAM = config['channel_scam']
     CHANNEL_TRUSTED = config['channel_trusted']
     CHANNEL_ID = config['channel_id']
+    # Обмен с юзерботом: "socket" (RPC с откатом на файлы), "file" (только файлы)
+    # или "embedded" (Telethon-клиент из userbot.py внутри процесса бота)
+    UB_IPC_CONFIG = config.get('userbot', {}).get('ipc', {})
+    HANDLER_POOLS_CONFIG = {name: {**defaults, **config.get('handlers', {}).get(name, {})}
+                            for name, defaults in HANDLER_POOL_DEFAULTS.items()}
+    # Вебхук вместо long polling (см. webhook.py): обновления принимает встроенный HTTP-сервер
+    WEBHOOK_CONFIG = config.get('webhook', {})
+    # Несколько процессов-воркеров (см. workers.py): count, route_by ("user" или "update_id"), queue
+    WORKERS_CONFIG = config.get('workers', {})
 
 # Загружаем настройки при импорте модуля
 load_settings()
@@ -49,17 +115,12 @@ load_settings()
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# === ЭКРАНИРОВАНИЕ ДЛЯ MARKDOWN_V2 ===
-def escape_markdown_v2(text: str) -> str:
-    if not text:
-        return ""
-    # Все спецсимволы MarkdownV2
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', str(text))
+# === ЭКРАНИРОВАНИЕ ДЛЯ MARKDOWN_V2 (см. rendering.py) ===
+escape_markdown_v2 = rendering.escape_markdown_v2
 
 # Инициализация ДБ
 def init_db():
-    conn = sqlite3.connect('scam_base.db')
+    conn = storage.get_connection()
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS scammers (
@@ -108,20 +169,67 @@ def init_db():
             search_date TEXT
         )
     ''')
+# Индексы для поиска по юзернейму без учёта регистра (запросы вида LOWER(username) = ?)
+# и для выборок из search_log по user_id. Создаются и на уже существующих базах.
+    for table in ('user_profiles', 'users', 'scammers', 'trusted'):
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_username_lower ON {table} (LOWER(username))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_log_user_id ON search_log (user_id)')
+# Счётчики поисков по user_id, обновляются в log_search вместо COUNT(*) по search_log
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS search_counters (
+            user_id INTEGER PRIMARY KEY,
+            search_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+# Кэш ошибочных ответов юзербота (канал, несуществующий юзернейм, flood wait)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS negative_cache (
+            query TEXT PRIMARY KEY,  -- нормализованный запрос
+            error_class TEXT NOT NULL,
+            error TEXT,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('DELETE FROM negative_cache WHERE expires_at <= ?', (time.time(),))
+# Версия статуса пользователя: растёт при каждом изменении trusted/scammers/user_profiles
+# по этому user_id, по ней сбрасывается кэш готовых inline-ответов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS status_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
     conn.commit()
-    conn.close()
+# Журнал заданий и heartbeat юзербота (см. jobstore.py, health.py)
+    jobstore.init_table(conn)
+    health.init_table(conn)
+# Состояние диалогов и аренда лидера планировщика (см. persistence.py, leader.py)
+    persistence.init_table(conn)
+    leader.init_table(conn)
+# file_id загруженных картинок статуса (см. media.py)
+    media.init_table(conn)
+    # === МИГРАЦИИ (номер схемы хранится в PRAGMA user_version) ===
+    schema_version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    if schema_version < 1:
+        # Разовое заполнение search_counters из уже накопленного search_log
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO search_counters (user_id, search_count)
+                SELECT user_id, COUNT(*) FROM search_log WHERE user_id IS NOT NULL GROUP BY user_id
+            ''')
+            conn.execute('PRAGMA user_version = 1')
+        logger.info("[DB] search_counters заполнена из search_log.")
+# Нормализация юзернейма для сравнения по индексу LOWER(username)
+def normalize_username(username: str) -> str:
+    return username.lstrip('@').lower() if username else ""
 # Сохранение пользователя, если необходимо
 def save_user_if_needed(update: Update):
     user = update.effective_user
     if not user or not user.username:
         return  # Нет пользователя или нет username — нечего обновлять
-    conn = sqlite3.connect('scam_base.db')
-    cursor = conn.cursor()
-    cursor.execute('''
+    storage.write_queue.submit('''
         INSERT OR REPLACE INTO users (user_id, username) VALUES (?, ?)
     ''', (user.id, user.username))
-    conn.commit()
-    conn.close()
 # Все юзернеймы по айди
 def get_all_usernames_by_user_id(user_id):
     """
@@ -129,11 +237,9 @@ def get_all_usernames_by_user_id(user_id):
     """
     if not user_id:
         return []
-    conn = sqlite3.connect('scam_base.db')
-    cursor = conn.cursor()
+    cursor = storage.get_connection().cursor()
     cursor.execute('SELECT all_usernames FROM user_profiles WHERE user_id = ?', (user_id,))
     row = cursor.fetchone()
-    conn.close()
     if row and row[0]:
         # all_usernames хранится как строка, разделённая запятыми
         return [uname.strip() for uname in row[0].split(',') if uname.strip()]
@@ -142,23 +248,24 @@ def get_all_usernames_by_user_id(user_id):
 def log_search(user_id, query):
     from datetime import datetime
     date = datetime.now().isoformat()
-    conn = sqlite3.connect('scam_base.db')
-    cursor = conn.cursor()
-    cursor.execute('''
+    # Запись уходит в фоновую очередь и не задерживает ответ пользователю
+    statements = [('''
         INSERT INTO search_log (user_id, search_query, search_date) VALUES (?, ?, ?)
-    ''', (user_id, query, date))
-    conn.commit()
-    conn.close()
-# Сколько раз в базе искали человекчка
-def get_search_count(user_id):
-    if not user_id:
-        return 0
-    conn = sqlite3.connect('scam_base.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM search_log WHERE user_id = ?', (user_id,))
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    ''', (user_id, query, date))]
+    if user_id:
+        statements.append(('''
+            INSERT INTO search_counters (user_id, search_count) VALUES (?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET search_count = search_count + 1
+        ''', (user_id,)))
+    storage.write_queue.submit_group(statements)
+# Смена версии статуса (вызывается внутри транзакции, которая меняет статус или профиль)
+def bump_status_version(conn, user_id):
+    if user_id is None:
+        return
+    conn.execute('''
+        INSERT INTO status_versions (user_id, version) VALUES (?, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1
+    ''', (user_id,))
 # Мейн функция для сохранения чела в базу через юзбота
 def save_user_profile_from_userbot(user_id, profile):
     all_usernames = profile.get('all_usernames', [])
@@ -169,24 +276,195 @@ def save_user_profile_from_userbot(user_id, profile):
     else:
         all_usernames_str = profile.get('username', '') or ''
     account_creation = profile.get('account_creation', 'неизвестно')  # <<< НОВОЕ
-    conn = sqlite3.connect('scam_base.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO user_profiles (
-            user_id, username, first_name, last_name, date_created, is_bot, all_usernames
-        ) VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        user_id,
-        profile.get('username'),
-        profile.get('first_name'),
-        profile.get('last_name'),
-        account_creation,  # <<< НОВОЕ
-        1 if profile.get('is_bot') else 0,
-        all_usernames_str
-    ))
-    conn.commit()
-    conn.close()
-def get_user_info_via_userbot(query: str) -> dict:
+    conn = storage.get_connection()
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO user_profiles (
+                user_id, username, first_name, last_name, date_created, is_bot, all_usernames
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            user_id,
+            profile.get('username'),
+            profile.get('first_name'),
+            profile.get('last_name'),
+            account_creation,  # <<< НОВОЕ
+            1 if profile.get('is_bot') else 0,
+            all_usernames_str
+        ))
+        bump_status_version(conn, user_id)
+# RPC-клиент юзербота (создаётся при первом запросе)
+_ub_rpc_client = None
+# Совмещение одинаковых запросов: пока идёт запрос к юзерботу по ключу,
+# остальные обработчики с тем же ключом ждут его результат, а не шлют свой
+# Присоединиться можно только к запросу, который покрывает класс и срок ожидающего: иначе
+# (ожидающий строже или ждёт дольше) отправляется свой запрос — юзербот совместит его
+# с уже идущим и повысит тому приоритет, а ответ придёт в пределах срока ожидающего
+_ub_inflight = {}  # нормализованный запрос -> (asyncio.Future, срок, класс приоритета)
+UB_COALESCE_STATS = {'upstream': 0, 'coalesced': 0, 'reissued': 0}
+NEGATIVE_CACHE_STATS = {'hits': 0, 'misses': 0}
+# Выключатель по heartbeat юзербота (встроенный юзербот heartbeat не пишет — он в этом же процессе)
+userbot_breaker = health.CircuitBreaker(use_heartbeat=UB_IPC_CONFIG.get('mode') != 'embedded')
+def is_userbot_unavailable(result) -> bool:
+    """Ответ означает, что юзербот не ответил (а не что пользователь не найден)."""
+    return bool(result) and 'error' in result and 'error_type' not in result
+# Истёкший срок запроса — не отказ юзербота: он может законно держать запрос
+# (FloodWait в ограничителе, длинная очередь). О том, жив ли юзербот, говорят heartbeat и ошибки связи.
+DEADLINE_ERRORS = ('deadline_exceeded', 'timeout')
+def is_userbot_failure(result) -> bool:
+    """Неудача, которую учитывает выключатель (ошибка связи, а не истёкший срок)."""
+    return is_userbot_unavailable(result) and result['error'] not in DEADLINE_ERRORS
+def get_negative_cache(key: str):
+    """Возвращает сохранённый ответ-ошибку для запроса, если срок ещё не истёк."""
+    cursor = storage.get_connection().cursor()
+    cursor.execute('SELECT error_class, error, expires_at FROM negative_cache WHERE query = ? AND expires_at > ?',
+                   (key, time.time()))
+    row = cursor.fetchone()
+    if not row:
+        NEGATIVE_CACHE_STATS['misses'] += 1
+        return None
+    NEGATIVE_CACHE_STATS['hits'] += 1
+    error_class, error, expires_at = row
+    result = {'error': error, 'error_type': error_class, 'cached': True}
+    if error_class == 'flood_wait':
+        result['retry_after'] = max(1, int(expires_at - time.time()))
+    return result
+def save_negative_cache(key: str, result: dict):
+    """Запоминает ответ-ошибку юзербота на срок, зависящий от класса ошибки."""
+    error_class = result.get('error_type')
+    if error_class == 'flood_wait':
+        ttl = result.get('retry_after') or 0
+    else:
+        ttl = NEGATIVE_CACHE_TTL.get(error_class, 0)
+    if ttl <= 0:
+        return
+    storage.write_queue.submit('''
+        INSERT INTO negative_cache (query, error_class, error, expires_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(query) DO UPDATE SET error_class = excluded.error_class,
+            error = excluded.error, expires_at = excluded.expires_at
+    ''', (key, error_class, result.get('error'), time.time() + ttl))
+def _priority_rank(priority: str) -> int:
+    return UB_PRIORITY_ORDER.index(priority) if priority in UB_PRIORITY_ORDER else UB_PRIORITY_ORDER.index(UB_DEFAULT_PRIORITY)
+def covers_request(inflight, deadline: float, priority: str) -> bool:
+    """Идущий запрос не мягче по классу и не короче по сроку, чем нужен ожидающему."""
+    _, inflight_deadline, inflight_priority = inflight
+    return inflight_deadline >= deadline and _priority_rank(inflight_priority) <= _priority_rank(priority)
+async def get_user_info_via_userbot(query: str, priority: str = UB_DEFAULT_PRIORITY) -> dict:
+    """
+    Запрашивает информацию о пользователе у юзербота с классом приоритета priority.
+    Ответа ждёт не дольше срока класса (UB_DEADLINES), затем {"error": "timeout"}.
+    Недавние ошибки (канал, несуществующий юзернейм, flood wait) отдаются из negative_cache,
+    одновременные запросы одного и того же юзернейма/ID выполняются один раз.
+    Пока юзербот недоступен (userbot_breaker разомкнут), сразу возвращается
+    {"error": "userbot_unavailable"}.
+    """
+    deadline = time.time() + UB_DEADLINES.get(priority, UB_REQUEST_TIMEOUT)
+    key = normalize_username(query.strip())
+    cached = await storage.run(get_negative_cache, key)
+    if cached is not None:
+        logger.info(f"[Main->UB] '{query}': ошибка из кэша ({cached['error_type']}), юзербот не запрашиваем.")
+        return cached
+    inflight = _ub_inflight.get(key)
+    if inflight is not None and not covers_request(inflight, deadline, priority):
+        UB_COALESCE_STATS['reissued'] += 1
+        logger.info(f"[Main->UB] Запрос '{query}' уже выполняется с другим классом или более коротким сроком, "
+                    f"отправляем свой ('{priority}').")
+        inflight = None
+    if inflight is not None:
+        future = inflight[0]
+        UB_COALESCE_STATS['coalesced'] += 1
+        logger.info(f"[Main->UB] Запрос '{query}' уже выполняется, ждём его результат "
+                    f"(сэкономлено запросов: {UB_COALESCE_STATS['coalesced']}).")
+        try:
+            # shield: истёкший срок этого обработчика не отменяет общий запрос
+            return await asyncio.wait_for(asyncio.shield(future), max(0, deadline - time.time()))
+        except asyncio.TimeoutError:
+            logger.error(f"[Main->UB] Срок запроса '{query}' истёк в ожидании уже идущего запроса.")
+            return {"error": "timeout"}
+    future = asyncio.get_running_loop().create_future()
+    _ub_inflight[key] = (future, deadline, priority)
+    UB_COALESCE_STATS['upstream'] += 1
+    try:
+        allowed, reason = await storage.run(userbot_breaker.allow)
+        if not allowed:
+            logger.info(f"[Main->UB] '{query}': юзербот недоступен ({reason}), запрос не отправляем.")
+            result = {"error": "userbot_unavailable", "reason": reason}
+        else:
+            try:
+                result = await _request_userbot(query, priority, deadline)
+            except Exception as e:
+                userbot_breaker.record_failure(str(e))
+                raise
+            # Истёкший срок ничего не говорит о юзерботе: выключатель его не учитывает,
+            # пробный запрос остаётся занятым до настоящего успеха или отказа
+            if is_userbot_failure(result):
+                userbot_breaker.record_failure(result['error'])
+            elif not (result and result.get('error') in DEADLINE_ERRORS):
+                userbot_breaker.record_success()
+        if result and 'error_type' in result:
+            save_negative_cache(key, result)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e if isinstance(e, Exception) else RuntimeError(f"запрос '{query}' отменён"))
+        future.exception()  # Ожидающих может не быть — не пишем в лог «exception was never retrieved»
+        raise
+    finally:
+        if _ub_inflight.get(key, (None,))[0] is future:
+            del _ub_inflight[key]
+async def _request_userbot(query: str, priority: str, deadline: float) -> dict:
+    """
+    В режиме "socket" запрос идёт через RPC; если юзербот не слушает сокет,
+    используется файловый обмен.
+    """
+    global _ub_rpc_client
+    if UB_IPC_CONFIG.get('mode') == 'embedded':
+        return await _get_user_info_embedded(query, priority, deadline)
+    if UB_IPC_CONFIG.get('mode', 'socket') == 'socket':
+        if _ub_rpc_client is None:
+            _ub_rpc_client = ubrpc.RpcClient(ubrpc.address_from_config(UB_IPC_CONFIG, COMMUNICATION_DIR))
+        try:
+            result = await _ub_rpc_client.call('resolve', max(0, deadline - time.time()), grace=UB_DEADLINE_GRACE,
+                                               query=query, priority=priority)
+            logger.info(f"[Main->UB] Ответ по RPC для '{query}' получен.")
+            return result
+        except ubrpc.RpcUnavailable as e:
+            logger.warning(f"[Main->UB] RPC юзербота недоступен ({e}), используем файловый обмен.")
+        except TimeoutError:
+            logger.error(f"[Main->UB] Таймаут ожидания ответа от юзербота по RPC для '{query}'")
+            return {"error": "timeout"}
+    return await _get_user_info_via_files(query, priority, deadline)
+# === ВСТРОЕННЫЙ ЮЗЕРБОТ (режим "embedded") ===
+# Telethon-клиент из userbot.py работает в event loop бота, обработчики
+# вызывают его корутины напрямую, без IPC.
+_embedded_userbot = None
+async def start_embedded_userbot():
+    """Запускает юзербота внутри процесса бота. Сессия должна быть заранее авторизована (python userbot.py --login)."""
+    global _embedded_userbot
+    import userbot  # Импорт только в этом режиме: иначе telethon не нужен
+    try:
+        await userbot.client.start(phone=userbot.PHONE)
+    except Exception as e:
+        raise RuntimeError(f"Не удалось запустить встроенного юзербота: {e}") from e
+    _embedded_userbot = userbot
+    logger.info("[Main] Встроенный юзербот запущен и авторизован.")
+async def stop_embedded_userbot():
+    if _embedded_userbot is None:
+        return
+    try:
+        await _embedded_userbot.client.disconnect()
+    except Exception as e:
+        logger.warning(f"[Main] Ошибка отключения встроенного юзербота: {e}")
+    logger.info("[Main] Встроенный юзербот остановлен.")
+async def _get_user_info_embedded(query: str, priority: str, deadline: float) -> dict:
+    if _embedded_userbot is None:
+        return {"error": "embedded_userbot_not_started"}
+    try:
+        return await asyncio.wait_for(_embedded_userbot.resolve_query(query, priority, deadline),
+                                      max(0, deadline - time.time()) + UB_DEADLINE_GRACE)
+    except asyncio.TimeoutError:
+        logger.error(f"[Main->UB] Таймаут встроенного юзербота для '{query}'")
+        return {"error": "timeout"}
+async def _get_user_info_via_files(query: str, priority: str, deadline: float) -> dict:
     """
     Отправляет запрос юзерботу через файл и ждёт ответ.
     Адаптировано для надёжной работы в Linux.
@@ -204,21 +482,56 @@ def get_user_info_via_userbot(query: str) -> dict:
     
     logger.info(f"[Main->UB] Отправка запроса: '{query}' (UUID: {request_uuid})")
 
+    # Запрос дублируется в журнале заданий: после перезапуска юзербот продолжит его,
+    # а результат можно забрать из журнала, даже если файл ответа не появится
+    try:
+        await storage.run(jobstore.enqueue, request_uuid, query, priority, response_filename, deadline)
+        journaled = True
+    except Exception as e:
+        logger.warning(f"[Main->UB] Не удалось записать задание {request_uuid} в журнал: {e}")
+        journaled = False
+
     max_retries = 3
     retry_delay = 0.1 # Начальная задержка 100мс
 
     for attempt in range(1, max_retries + 1):
         try:
             # 1. Создаём файл запроса
-            # Формат: query\nresponse_filename (относительное имя файла ответа)
+            # Формат: query\nresponse_filename (относительное имя файла ответа)\npriority\ndeadline (unix time)
             with open(full_request_path, 'w', encoding='utf-8') as f:
-                f.write(f"{query}\n{response_filename}")
+                f.write(f"{query}\n{response_filename}\n{priority}\n{deadline}")
             logger.debug(f"[Main->UB] Файл запроса создан: {full_request_path} (попытка {attempt})")
 
             # 2. Ждём появления файла ответа с таймаутом
-            timeout = 30  # секунд
+            timeout = max(0, deadline - time.time()) + UB_DEADLINE_GRACE
             start_time = time.time()
+            next_db_check = 0
             while not os.path.exists(full_response_path):
+                if time.monotonic() < next_db_check:
+                    if time.time() - start_time <= timeout:
+                        await asyncio.sleep(0.1)
+                        continue
+                next_db_check = time.monotonic() + UB_FILE_DB_CHECK_INTERVAL
+                # Юзербот остановился или перестал слать heartbeat — не ждём полный таймаут
+                problem = await storage.run(userbot_breaker.heartbeat_problem)
+                if problem:
+                    logger.error(f"[Main->UB] Юзербот недоступен ({problem}), прекращаем ожидание UUID {request_uuid}.")
+                    try:
+                        os.remove(full_request_path)
+                    except OSError:
+                        pass
+                    return {"error": "userbot_unavailable", "reason": problem}
+                if journaled:
+                    result = await storage.run(jobstore.get_result, request_uuid)
+                    if result is not None:
+                        logger.info(f"[Main->UB] Ответ для UUID {request_uuid} получен из журнала заданий.")
+                        await storage.run(jobstore.delete, request_uuid)
+                        for file_path in (full_request_path, full_response_path):
+                            try:
+                                os.remove(file_path)
+                            except OSError:
+                                pass
+                        return result
                 if time.time() - start_time > timeout:
                     logger.error(f"[Main->UB] Таймаут ожидания ответа от юзербота для UUID {request_uuid} (попытка {attempt})")
                     # Пытаемся удалить файл запроса, если он всё ещё есть
@@ -227,14 +540,16 @@ def get_user_info_via_userbot(query: str) -> dict:
                         logger.debug(f"[Main->UB] Файл запроса удалён по таймауту: {full_request_path}")
                     except OSError as oe:
                         logger.debug(f"[Main->UB] Не удалось удалить файл запроса по таймауту {full_request_path}: {oe}")
-                    if attempt < max_retries:
+                    # Задание в журнале: повторная отправка того же запроса ничего не ускорит,
+                    # юзербот либо ещё выполняет его, либо недоступен
+                    if attempt < max_retries and not journaled and time.time() < deadline:
                         logger.info(f"[Main->UB] Повторная попытка {attempt + 1}/{max_retries} через {retry_delay}s...")
-                        time.sleep(retry_delay)
+                        await asyncio.sleep(retry_delay)
                         retry_delay *= 2 # Экспоненциальная задержка
                         break # Выходим из while, чтобы перейти к следующей попытке for
                     else:
                         return {"error": "timeout"}
-                time.sleep(0.1) # Проверяем каждые 100мс
+                await asyncio.sleep(0.1) # Проверяем каждые 100мс
             
             if not os.path.exists(full_response_path):
                  # Если вышли из while по таймауту и файл так и не появился, продолжаем цикл for
@@ -254,7 +569,7 @@ def get_user_info_via_userbot(query: str) -> dict:
                 except PermissionError as pe:
                     logger.warning(f"[Main->UB] Попытка {read_attempt}/{read_max_retries}: Ошибка доступа к файлу {full_response_path}: {pe}. Повтор через {read_retry_delay}s...")
                     if read_attempt < read_max_retries:
-                        time.sleep(read_retry_delay)
+                        await asyncio.sleep(read_retry_delay)
                         read_retry_delay *= 2 # Экспоненциальная задержка
                     else:
                         raise # Если все попытки исчерпаны, выбрасываем исключение
@@ -270,7 +585,12 @@ def get_user_info_via_userbot(query: str) -> dict:
                 logger.error(f"[Main->UB] Ошибка декодирования JSON из ответа юзербота: {je}. Данные: {data[:100]}...")
                 result = {"error": f"json_decode_error: {je}"}
 
-            # 5. Удаляем файлы запроса и ответа
+            # 5. Удаляем файлы запроса и ответа (и задание из журнала)
+            if journaled:
+                try:
+                    await storage.run(jobstore.delete, request_uuid)
+                except Exception as e:
+                    logger.debug(f"[Main->UB] Не удалось удалить задание {request_uuid} из журнала: {e}")
             try:
                 os.remove(full_request_path)
                 logger.debug(f"[Main->UB] Файл запроса удалён: {full_request_path}")
@@ -296,7 +616,7 @@ def get_user_info_via_userbot(query: str) -> dict:
             
             if attempt < max_retries:
                  logger.info(f"[Main->UB] Повторная попытка {attempt + 1}/{max_retries} через {retry_delay}s...")
-                 time.sleep(retry_delay)
+                 await asyncio.sleep(retry_delay)
                  retry_delay *= 2 # Экспоненциальная задержка
             else:
                  logger.error(f"[Main->UB] Все попытки взаимодействия с юзерботом для '{query}' исчерпаны.")
@@ -304,11 +624,23 @@ def get_user_info_via_userbot(query: str) -> dict:
 
     # Этот return теоретически недостижим, но добавим для полноты
     return {"error": "unreachable_code_reached"}
+# user_id по юзернейму только из своих таблиц — когда юзербот недоступен
+def find_user_id_in_db(username: str):
+    username = normalize_username(username)
+    if not username:
+        return None
+    cursor = storage.get_connection().cursor()
+    for table in ('scammers', 'trusted', 'users'):
+        cursor.execute(f'SELECT user_id FROM {table} WHERE LOWER(username) = ? AND user_id IS NOT NULL LIMIT 1', (username,))
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+    return None
 # Поиск чела в базе
 def find_user_in_table(target: str, table: str):
-    conn = sqlite3.connect('scam_base.db')
+    conn = storage.get_connection()
     cursor = conn.cursor()
-    target_clean = target.lstrip('@').lower()
+    target_clean = normalize_username(target)
     is_digit = target_clean.isdigit()
     # === ВСЕГДА ИЩЕМ ПО user_id ===
     if is_digit:
@@ -321,7 +653,6 @@ def find_user_in_table(target: str, table: str):
             user_id = result[0]
         else:
             # Не нашли user_id — возвращаем None
-            conn.close()
             return None
     # Теперь ищем в таблице по user_id
     if table == 'scammers':
@@ -335,7 +666,6 @@ def find_user_in_table(target: str, table: str):
             WHERE user_id = ?
         ''', (user_id,))
     result = cursor.fetchone()
-    conn.close()
     return result
 # Добавление чела в базу
 def add_user_to_table(user_id, username, original_username, note, table, proof_url=None):
@@ -345,33 +675,35 @@ def add_user_to_table(user_id, username, original_username, note, table, proof_u
     # original_username тоже может быть None, если добавляем по ID
     if original_username:
         original_username = original_username.lstrip('@')
-    conn = sqlite3.connect('scam_base.db')
-    cursor = conn.cursor()
-    if table == 'scammers':
-        cursor.execute(f'''
-            INSERT OR REPLACE INTO {table} (user_id, username, original_username, note, proof_url)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, username, original_username, note, proof_url))
-    else:
-        cursor.execute(f'''
-            INSERT OR REPLACE INTO {table} (user_id, username, original_username, note)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, username, original_username, note))
-    conn.commit()
-    conn.close()
+    conn = storage.get_connection()
+    with conn:
+        if table == 'scammers':
+            conn.execute(f'''
+                INSERT OR REPLACE INTO {table} (user_id, username, original_username, note, proof_url)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, username, original_username, note, proof_url))
+        else:
+            conn.execute(f'''
+                INSERT OR REPLACE INTO {table} (user_id, username, original_username, note)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, username, original_username, note))
+        bump_status_version(conn, user_id)
 # Удаление из базы
 def remove_user_from_table(target: str, table: str):
-    conn = sqlite3.connect('scam_base.db')
-    cursor = conn.cursor()
-    target_clean = target.lstrip('@').lower()
+    conn = storage.get_connection()
+    target_clean = normalize_username(target)
     is_digit = target_clean.isdigit()
-    if is_digit:
-        cursor.execute(f'DELETE FROM {table} WHERE user_id = ?', (int(target_clean),))
-    else:
-        cursor.execute(f'DELETE FROM {table} WHERE LOWER(username) = ?', (target_clean,))
+    with conn:
+        if is_digit:
+            user_ids = [int(target_clean)]
+            cursor = conn.execute(f'DELETE FROM {table} WHERE user_id = ?', (int(target_clean),))
+        else:
+            user_ids = [row[0] for row in conn.execute(f'SELECT user_id FROM {table} WHERE LOWER(username) = ?', (target_clean,))]
+            cursor = conn.execute(f'DELETE FROM {table} WHERE LOWER(username) = ?', (target_clean,))
+        if cursor.rowcount:
+            for user_id in user_ids:
+                bump_status_version(conn, user_id)
     deleted = cursor.rowcount > 0
-    conn.commit()
-    conn.close()
     return deleted
 
 def move_user_between_tables(target: str, from_table: str, to_table: str):
@@ -382,6 +714,66 @@ def move_user_between_tables(target: str, from_table: str, to_table: str):
     remove_user_from_table(target, from_table)
     add_user_to_table(user_id, username, original_username, note, to_table, proof_url)
     return True
+# === РЕЗОЛВЕР СТАТУСА ===
+# Лимит SQL-запросов на одну проверку (PM или inline), превышение логируется.
+# Считаются реально выполненные запросы (storage.count_statements): проверка по базе — 1,
+# с юзерботом и поиском ID по старым юзернеймам — до 6
+CHECK_QUERY_BUDGET = 6
+# Профиль, гарант, скамер, известный юзернейм из users и счётчик поисков — одним запросом.
+# Если передан ID — используется он, иначе user_id ищется в user_profiles по юзернейму.
+STATUS_QUERY = '''
+    SELECT t.user_id,
+           p.user_id, p.username, p.first_name, p.last_name, p.date_created, p.is_bot, p.all_usernames,
+           tr.user_id, tr.username, tr.original_username, tr.note,
+           s.user_id, s.username, s.original_username, s.note, s.proof_url,
+           u.username,
+           COALESCE((SELECT search_count FROM search_counters WHERE user_id = t.user_id), 0),
+           COALESCE((SELECT version FROM status_versions WHERE user_id = t.user_id), 0)
+    FROM (
+        SELECT COALESCE(?, (SELECT user_id FROM user_profiles WHERE LOWER(username) = ? LIMIT 1)) AS user_id
+    ) t
+    LEFT JOIN user_profiles p ON p.user_id = t.user_id
+    LEFT JOIN trusted tr ON tr.user_id = t.user_id
+    LEFT JOIN scammers s ON s.user_id = t.user_id
+    LEFT JOIN users u ON u.user_id = t.user_id
+'''
+def resolve_user_status(target) -> dict:
+    """
+    Определяет статус пользователя по @username или ID за один запрос к базе.
+    Возвращает словарь:
+      user_id      — ID или None, если по юзернейму в user_profiles ничего нет
+      profile      — строка user_profiles (как SELECT user_id, username, ... all_usernames) или None
+      trusted      — строка trusted в формате find_user_in_table или None
+      scammer      — строка scammers в формате find_user_in_table или None
+      known_username — юзернейм из таблицы users или None
+      search_count — сколько раз пользователя искали
+      version      — версия статуса (status_versions), меняется при изменении записи пользователя
+    """
+    target_clean = normalize_username(str(target))
+    user_id = int(target_clean) if target_clean.isdigit() else None
+    cursor = storage.get_connection().cursor()
+    cursor.execute(STATUS_QUERY, (user_id, None if user_id else target_clean))
+    row = cursor.fetchone()
+    resolved_id = row[0]
+    return {
+        'user_id': resolved_id,
+        'profile': row[1:8] if row[1] is not None else None,
+        'trusted': (*row[8:12], None) if row[8] is not None else None,
+        'scammer': row[12:17] if row[12] is not None else None,
+        'known_username': row[17],
+        'search_count': row[18] if resolved_id else 0,
+        'version': row[19],
+    }
+def status_kind(status: dict):
+    """Статус для карточки (rendering.TRUSTED / SCAMMER / UNKNOWN) и строка trusted или scammers."""
+    if status['trusted']:
+        return rendering.TRUSTED, status['trusted']
+    if status['scammer']:
+        return rendering.SCAMMER, status['scammer']
+    return rendering.UNKNOWN, None
+def _check_query_budget(where: str, query: str, queries: int):
+    if queries > CHECK_QUERY_BUDGET:
+        logger.warning(f"[{where}] Проверка '{query}' выполнила {queries} SQL-запросов (лимит {CHECK_QUERY_BUDGET}).")
 # Блок с инфой об юзере
 def get_user_info_block(username: str, user_id: int, note: str = "") -> str:
     """
@@ -412,7 +804,7 @@ def get_social_footer(proof_url: str = None) -> str:
     return footer
 
 # === ОСНОВНЫЕ КОМАНДЫ ===
-def start(update: Update, context: CallbackContext):
+async def start(update: Update, context: CallbackContext):
     # Сохраняем юзера при /start
     save_user_if_needed(update)
     msg = (
@@ -420,125 +812,106 @@ def start(update: Update, context: CallbackContext):
         "🔍 Отправьте `@username` для проверки\\.\n"
         "✅ Бот покажет статус: _скамер_ или _проверенный гарант_\\.\n"
     )
-    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
 # /check
-def handle_check_command(update: Update, context: CallbackContext):
+async def handle_check_command(update: Update, context: CallbackContext):
     if not context.args:
-        update.message.reply_text("❌ Используйте: /check @username или /check ID", parse_mode=ParseMode.MARKDOWN_V2)
+        await update.message.reply_text("❌ Используйте: /check @username или /check ID", parse_mode=ParseMode.MARKDOWN_V2)
         return
     query = context.args[0].strip()
     if not query:
-        update.message.reply_text("❌ Пустой запрос\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        await update.message.reply_text("❌ Пустой запрос\\.", parse_mode=ParseMode.MARKDOWN_V2)
         return
     # Логируем поиск
     log_search(None, query)
-    _handle_user_check(update, context, query)
+    await _handle_user_check(update, context, query)
 # @username in DM
-def handle_check_in_pm(update: Update, context: CallbackContext):
+async def handle_check_in_pm(update: Update, context: CallbackContext):
     # Обрабатываем @username в личке
     query = update.message.text.strip()
     if query.startswith('@'):
         log_search(None, query)
-        _handle_user_check(update, context, query)
+        await _handle_user_check(update, context, query)
 
+# Картинки статуса отправляются по сохранённому file_id, файл загружается только один раз
+status_media = media.MediaRegistry()
 # Мейн функция вывода состояния чела в базе
 
-def _handle_user_check(update: Update, context: CallbackContext, query: str):
+# === ФОНОВОЕ ДОПОЛНЕНИЕ ПРОФИЛЯ ===
+_profile_refreshes = {}  # user_id -> фоновая задача обновления (ссылки держим, чтобы их не собрал GC)
+def profile_needs_update(profile_row) -> bool:
+    """Профиль неполный: нет имени, даты создания или списка юзернеймов."""
+    _, _, first_name, _, date_created, _, all_usernames = profile_row
+    return (not first_name or first_name == 'неизвестно' or not date_created or date_created == 'неизвестно'
+            or not all_usernames)
+async def refresh_profile(user_id, username):
+    # Юзернейм для запроса: из user_profiles или users; без него — по ID
+    query = f"@{username}" if username else f"id{user_id}"
+    logger.info(f"Профиль пользователя {user_id} ({username}) неполный. Обновляем через юзербота в фоне...")
+    user_info = await get_user_info_via_userbot(query, priority='background')
+    if user_info and 'error' not in user_info:
+        await storage.run(save_user_profile_from_userbot, user_id, user_info)
+        index_profile(user_id, user_info)
+        logger.info(f"Профиль пользователя {user_id} успешно обновлён.")
+    else:
+        logger.warning(f"Не удалось получить обновлённые данные для пользователя {user_id} ({query}).")
+def schedule_profile_refresh(user_id, username):
+    """Запускает фоновое обновление профиля, если для этого пользователя оно ещё не идёт."""
+    if user_id in _profile_refreshes:
+        return
+    task = asyncio.create_task(refresh_profile(user_id, username))
+    _profile_refreshes[user_id] = task
+    task.add_done_callback(lambda _: _profile_refreshes.pop(user_id, None))
+async def _handle_user_check(update: Update, context: CallbackContext, query: str):
     clean_query = query.lstrip('@')
     is_id = clean_query.isdigit()
-    # === СНАЧАЛА ПОЛУЧАЕМ user_id ===
-    user_id = None
+    # === СНАЧАЛА ПОЛУЧАЕМ user_id И СТАТУС ОДНИМ ЗАПРОСОМ ===
+    queries = storage.count_statements()
+    status = await storage.run(resolve_user_status, clean_query)
+    user_id = status['user_id']
     username = None
     if is_id:
-        user_id = int(clean_query)
-        # Пробуем получить username из user_profiles
-        conn = sqlite3.connect('scam_base.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT username FROM user_profiles WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        if result:
-            username = result[0]
+        # username из user_profiles, если профиль есть
+        if status['profile']:
+            username = status['profile'][1]
     else:
         username = clean_query
-        # Пробуем получить ID из user_profiles
-        conn = sqlite3.connect('scam_base.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM user_profiles WHERE LOWER(username) = ?', (username.lower(),))
-        result = cursor.fetchone()
-        conn.close()
-        if result:
-            user_id = result[0]
-        else:
+        if not user_id:
             # Пробуем получить ID через юзербота
-            user_info = get_user_info_via_userbot(query)
+            user_info = await get_user_info_via_userbot(query, priority='pm')
             if user_info and 'error' not in user_info:
                 user_id = user_info['id']
                 username = user_info.get('username')
-                # Сохраняем в user_profiles
-                save_user_profile_from_userbot(user_id, user_info)
+                # Сохраняем в user_profiles и перечитываем статус уже по ID
+                await storage.run(save_user_profile_from_userbot, user_id, user_info)
+                status = await storage.run(resolve_user_status, user_id)
+            elif is_userbot_unavailable(user_info):
+                # Юзербот недоступен — отвечаем только по своей базе
+                user_id = await storage.run(find_user_id_in_db, clean_query)
+                if user_id:
+                    status = await storage.run(resolve_user_status, user_id)
+                else:
+                    log_search(None, query)
+                    await update.message.reply_text("⏳ Проверка по юзернейму временно недоступна, а в нашей базе такого юзернейма нет\\. Попробуйте позже или пришлите ID пользователя\\.", parse_mode=ParseMode.MARKDOWN_V2)
+                    return
 
     # === ЛОГИРУЕМ ПОИСК (всегда с user_id, если есть) ===
     log_search(user_id, query)
     # === Если не получили user_id — не ищем ===
     if not user_id:
-        update.message.reply_text("❌ Не удалось получить ID пользователя\\. Попробуйте позже \\(Возможно\\, это канал или чат переходник\\, пришлите юзернейм из этого канала или чата\\, возможно сработает\\)\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        await update.message.reply_text("❌ Не удалось получить ID пользователя\\. Попробуйте позже \\(Возможно\\, это канал или чат переходник\\, пришлите юзернейм из этого канала или чата\\, возможно сработает\\)\\.", parse_mode=ParseMode.MARKDOWN_V2)
         return
 
-    # === ПОЛУЧАЕМ ПРОФИЛЬ ИЗ user_profiles ===
-    conn = sqlite3.connect('scam_base.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, username, first_name, last_name, date_created, is_bot, all_usernames FROM user_profiles WHERE user_id = ?', (user_id,))
-    profile_row = cursor.fetchone()
-    conn.close()
+    # === ПРОФИЛЬ ИЗ user_profiles ===
+    profile_row = status['profile']
 
     # === АВТООБНОВЛЕНИЕ ПРОФИЛЯ (если пользователь найден в базе скам/гарант) ===
-    # Проверим, есть ли пользователь в scammers или trusted
-    is_user_in_db = find_user_in_table(str(user_id), 'scammers') or find_user_in_table(str(user_id), 'trusted')
-
-    if is_user_in_db and profile_row:
-        # Пользователь есть в нашей базе, проверим полноту профиля
-        db_user_id, db_username, db_first_name, db_last_name, db_date_created, db_is_bot, db_all_usernames = profile_row
-        
-        # Определим, достаточно ли данных. Например, если first_name и date_created пусты:
-        # Можно задать свои критерии, например, если нет first_name ИЛИ нет date_created
-        profile_needs_update = not db_first_name or db_first_name == 'неизвестно' or not db_date_created or db_date_created == 'неизвестно' or not db_all_usernames
+    # Ответ не ждёт юзербота: отвечаем сохранённым профилем, а неполный профиль
+    # дополняется фоновой задачей — следующая проверка покажет уже свежие данные
+    if (status['scammer'] or status['trusted']) and profile_row and profile_needs_update(profile_row):
+        schedule_profile_refresh(user_id, profile_row[1] or status['known_username'])
 
-        if profile_needs_update:
-            logger.info(f"Профиль пользователя {db_user_id} ({db_username}) неполный. Попытка обновления через юзербота...")
-            
-            # Получаем username для запроса юзербота. Приоритет: из user_profiles -> из users -> из запроса
-            username_for_request = db_username
-            if not username_for_request:
-                 # Пробуем получить username из таблицы users
-                conn = sqlite3.connect('scam_base.db')
-                cursor = conn.cursor()
-                cursor.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
-                result = cursor.fetchone()
-                conn.close()
-                if result:
-                    username_for_request = result[0] # Уже без @
-
-            # Если так и не нашли username, используем user_id (если юзербот это поддерживает)
-            if not username_for_request:
-                username_for_request = f"id{user_id}"
-
-            # Запрашиваем данные через юзербота
-            user_info = get_user_info_via_userbot(f"@{username_for_request}" if not username_for_request.startswith('id') else username_for_request)
-            
-            if user_info and 'error' not in user_info:
-                # Обновляем профиль в базе
-                save_user_profile_from_userbot(user_id, user_info)
-                logger.info(f"Профиль пользователя {user_id} успешно обновлён.")
-                
-                # Обновляем profile_row для дальнейшего использования
-                conn = sqlite3.connect('scam_base.db')
-                cursor = conn.cursor()
-                cursor.execute('SELECT user_id, username, first_name, last_name, date_created, is_bot, all_usernames FROM user_profiles WHERE user_id = ?', (user_id,))
-                profile_row = cursor.fetchone()
-                conn.close()
-            else:
-                 logger.warning(f"Не удалось получить обновлённые данные для пользователя {user_id} (@{username_for_request}). Используются старые данные.")
+    _check_query_budget("PM", query, queries[0])
 
     # === ИСПОЛЬЗУЕМ profile_row ДЛЯ ФОРМИРОВАНИЯ ОТВЕТА ===
     if profile_row:
@@ -554,500 +927,507 @@ def _handle_user_check(update: Update, context: CallbackContext, query: str):
         # username = username # из более раннего кода
         # is_bot = 0 # предположим
         
-    # Получаем количество поисков
-    search_count = get_search_count(user_id)
-
-    # Формируем список юзернеймов
-    if all_usernames:
-        all_usernames_list = [uname.strip() for uname in all_usernames.split(',') if uname.strip()]
-        all_usernames_str = ', '.join([f"@{escape_markdown_v2(uname)}" for uname in all_usernames_list])
+    # Количество поисков (статус прочитан до log_search, учитываем текущий поиск)
+    search_count = status['search_count'] + 1
+
+    # === Гарант, скамер или не найден (текст карточки — rendering.py) ===
+    kind, record = status_kind(status)
+    if record:
+        card_user_id, record_username, note = record[0], record[1], record[3]
+        proof_url = record[4] if kind == rendering.SCAMMER else None
     else:
-        all_usernames_str = f"@{escape_markdown_v2(username)}" if username else "неизвестен"
-
-    # === Ищем в trusted ===
-    trust_info = find_user_in_table(str(user_id), 'trusted')
-    if trust_info:
-        t_user_id, t_username, t_original_username, t_note, _ = trust_info
-        # Если искали по @username — показываем его
-        if not is_id and clean_query:
-            display_username = clean_query  # тот, по которому искали
-        else:
-            display_username = t_username if t_username else "неизвестен"
-        display = f"@{escape_markdown_v2(display_username)} \\| ID: `{t_user_id}`" if display_username and t_user_id else f"ID: {t_user_id}\n"
-        status_line = "💡`Статус`: *__ГАРАНТ__* ✅\n\n🟢*Данный пользователь является гарантом\\! Следующий вывод был основан на его репутации\\.*"
-        note_line = f"\n\n🔓Дополнительная информация🔑:\n\n{escape_markdown_v2(t_note)}" if t_note else ""
-        info_lines = (
-            f"🔮 Имя: {escape_markdown_v2(first_name)} {escape_markdown_v2(last_name)}\n"
-            f"📓 Юзернеймы: {all_usernames_str}\n"
-            f"🪬 Дата создания: {date_created}\n"
-        )
-        msg = (
-            f"👤 Пользователь: {display}\n\n"
-            f"{info_lines}\n"
-            f"{status_line}{note_line}\n\n"
-            f">Наш чат: @loneasBASE\n>Наш канал: @loneasproofs"
-        )
-        with open('guarantee.jpg', 'rb') as photo:
-            update.message.reply_photo(photo=photo, caption=msg, parse_mode=ParseMode.MARKDOWN_V2)
-        return
-
-    # === Ищем в scammers ===
-    scam_info = find_user_in_table(str(user_id), 'scammers')
-    if scam_info:
-        s_user_id, s_username, s_original_username, s_note, s_proof_url = scam_info
-        # Если искали по @username — показываем его
-        if not is_id and clean_query:
-            display_username = clean_query  # тот, по которому искали
-        else:
-            display_username = s_username if s_username else "неизвестен"
-        display = f"@{escape_markdown_v2(display_username)} \\| ID: `{s_user_id}`" if display_username and s_user_id else f"ID: {s_user_id}\n"
-        status_line = "⚠️ НАЙДЕН В СКАМ\\-БАЗЕ\\!⚠️\n\n💡`Статус`: *__МОШЕННИК__*❌\n\n🔴*Пользователь — скамер\\. Найден в базе @LoneasBasebot\\. Ни в коем случае не контактируйте с данным человеком, не ведитесь на его уловки\\.*"
-        note_line = f"\n\n🔓Дополнительная информация🔑:\n\n{escape_markdown_v2(s_note)}" if s_note else ""
-        info_lines = (
-            f"🔮 Имя: {escape_markdown_v2(first_name)} {escape_markdown_v2(last_name)}\n"
-            f"📓 Юзернеймы: {all_usernames_str}\n"
-            f"🪬 Дата создания: {date_created}\n"
-            f"🔍 Искали в базе {search_count} раз\\(а\\)\n"
-        )
-        proof_line = f">Пруфы: [ссылка]({s_proof_url})" if s_proof_url else ""
-        chat_line = ">Наш чат: @loneasBASE\n>Наш канал: @loneasproofs"
-        if s_proof_url:
-            footer = proof_line + "\n>" + chat_line
-        else:
-            footer = chat_line
-        msg = (
-            f"👤 Пользователь: {display}\n\n"
-            f"{info_lines}\n"
-            f"{status_line}{note_line}\n\n"
-            f"{footer}"
-        )
-        with open('scammer.jpg', 'rb') as photo:
-            update.message.reply_photo(photo=photo, caption=msg, parse_mode=ParseMode.MARKDOWN_V2)
-        return
-
-    # === Не найден ===
+        card_user_id, record_username, note, proof_url = user_id, username, None, None
     # Если искали по @username — показываем его
-    if not is_id and clean_query:
-        display_username = clean_query  # тот, по которому искали
-    else:
-        display_username = username if username else "неизвестен"
-    display = f"@{escape_markdown_v2(display_username)} \\| ID: `{user_id}`" if display_username and user_id else f"ID: {user_id}"
-    status_line = f"💡`Статус`: *__НЕ НАЙДЕН__* 🔍\n\n⚫️Пользователь @{escape_markdown_v2(display_username)} не был найден в нашей базе\\. Данная личность не проверена\\.\n\n🔓Дополнительная информация🔑:\n\nРекомендуется быть осторожным и использовать услуги проверенных гарантов \\- /listtrusted\\.\n"
-    info_lines = (
-        f"🔮 Имя: {escape_markdown_v2(first_name)} {escape_markdown_v2(last_name)}\n"
-        f"📓 Юзернеймы: {all_usernames_str}\n"
-        f"🪬 Дата создания: {date_created}\n"
-        f"🔍 Искали в базе: {search_count} раз\\(а\\)\n"
-    )
-    msg = (
-        f"👤 Пользователь: {display}\n\n"
-        f"{info_lines}\n"
-        f"{status_line}\n"
-        f">Наш чат: @loneasBASE\n>Наш канал: @loneasproofs"
-    )
-    with open('unknown.jpg', 'rb') as photo:
-        update.message.reply_photo(photo=photo, caption=msg, parse_mode=ParseMode.MARKDOWN_V2)
+    display_username = clean_query if not is_id and clean_query else record_username or "неизвестен"
+    template = rendering.STATUS_TEMPLATES[kind]
+    msg = template.render(display_username, card_user_id, first_name, last_name, all_usernames or username,
+                          date_created, search_count, note, proof_url)
+    await status_media.reply_photo(update.message, template.photo, caption=msg, parse_mode=ParseMode.MARKDOWN_V2)
 
 # === АВТООБНОВЛЕНИЕ ID ===
-def auto_update_user_id_on_message(update: Update, context: CallbackContext):
+def update_missing_user_id(user_id, username):
+    """Проставляет ID записям trusted/scammers, добавленным по юзернейму без ID."""
+    conn = storage.get_connection()
+    with conn:
+        cursor = conn.cursor()
+        username_clean = normalize_username(username)
+        # Проверяем в trusted
+        cursor.execute("SELECT user_id FROM trusted WHERE LOWER(username) = ? AND user_id IS NULL", (username_clean,))
+        result = cursor.fetchone()
+        if result:
+            cursor.execute("UPDATE trusted SET user_id = ? WHERE LOWER(username) = ?", (user_id, username_clean))
+            bump_status_version(conn, user_id)
+            logger.info(f"Обновлён ID для @{username} (trusted): {user_id}")
+        else:
+            # Проверяем в scammers
+            cursor.execute("SELECT user_id FROM scammers WHERE LOWER(username) = ? AND user_id IS NULL", (username_clean,))
+            result2 = cursor.fetchone()
+            if result2:
+                cursor.execute("UPDATE scammers SET user_id = ? WHERE LOWER(username) = ?", (user_id, username_clean))
+                bump_status_version(conn, user_id)
+                logger.info(f"Обновлён ID для @{username} (scammers): {user_id}")
+async def auto_update_user_id_on_message(update: Update, context: CallbackContext):
     user = update.effective_user
     if not user or not user.username:
         return  # Нет пользователя или нет username — нечего обновлять
 
     # Проверим, есть ли этот username в базе без ID
-    conn = sqlite3.connect('scam_base.db')
-    cursor = conn.cursor()
-    # Проверяем в trusted
-    cursor.execute("SELECT user_id FROM trusted WHERE username = ? AND user_id IS NULL", (user.username,))
-    result = cursor.fetchone()
-    if result:
-        cursor.execute("UPDATE trusted SET user_id = ? WHERE username = ?", (user.id, user.username))
-        logger.info(f"Обновлён ID для @{user.username} (trusted): {user.id}")
-    else:
-        # Проверяем в scammers
-        cursor.execute("SELECT user_id FROM scammers WHERE username = ? AND user_id IS NULL", (user.username,))
-        result2 = cursor.fetchone()
-        if result2:
-            cursor.execute("UPDATE scammers SET user_id = ? WHERE username = ?", (user.id, user.username))
-            logger.info(f"Обновлён ID для @{user.username} (scammers): {user.id}")
-    conn.commit()
-    conn.close()
+    await storage.run(update_missing_user_id, user.id, user.username)
 
 # === ПУБЛИКАЦИЯ В КАНАЛ ===
-def publish_to_channel(context: CallbackContext, user_id, username, note, proof_url, is_scam):
-    if is_scam:
-        channel = CHANNEL_SCAM
-        status = "МОШЕННИК ❌"
-        extra = f"\n🔗 Пруфы: [ссылка]({proof_url})" if proof_url else ""
-    else:
-        channel = CHANNEL_TRUSTED
-        status = "ГАРАНТ ✅"
-        extra = ""
-    msg = (
-        f"👤 Пользователь: @{escape_markdown_v2(username)} \\| ID: {user_id}\n"
-        f"💡Статус: {status}\n"
-        f"📝 Примечание: {escape_markdown_v2(note)}{extra}"
-    )
+async def publish_to_channel(context: CallbackContext, user_id, username, note, proof_url, is_scam):
+    channel = CHANNEL_SCAM if is_scam else CHANNEL_TRUSTED
+    template = rendering.STATUS_TEMPLATES[rendering.SCAMMER if is_scam else rendering.TRUSTED]
+    msg = template.render_channel_post(username, user_id, note, proof_url if is_scam else None)
     try:
-        context.bot.send_message(chat_id=channel, text=msg, parse_mode=ParseMode.MARKDOWN_V2)
+        await context.bot.send_message(chat_id=channel, text=msg, parse_mode=ParseMode.MARKDOWN_V2)
     except Exception as e:
         logger.error(f"Не удалось опубликовать в канал {channel}: {e}")
 
 # === INLINE РЕЖИМ ===
-def inline_query(update: Update, context: CallbackContext):
+# Inline-ответ ждёт юзербота не дольше INLINE_ANSWER_BUDGET, а сам запрос продолжается
+# фоновой задачей до срока UB_DEADLINES['inline'] и сохраняет профиль — повторный
+# inline-запрос ответит уже из базы
+_inline_resolving = set()  # фоновые задачи (ссылки держим, чтобы их не собрал GC)
+# Готовые inline-результаты по (user_id, версия статуса, юзернейм из запроса): пока
+# версия не сменилась (add_user_to_table, remove_user_from_table, move_user_between_tables,
+# новый профиль), карточка не собирается заново. TTL ограничивает устаревание счётчика поисков.
+INLINE_RENDER_CACHE_SIZE = 5000
+INLINE_RENDER_TTL = 300  # секунд
+# Сколько Telegram может отдавать ответ на тот же запрос из своего кэша, не спрашивая бота.
+# Ответ не зависит от того, кто спрашивает (is_personal=False). Гарант держится меньше
+# всего: если его переведут в скамеры, старая карточка не должна жить долго.
+INLINE_CACHE_TIME = {
+    'trusted': 30,
+    'scammer': 300,
+    'unknown': 60,
+}
+_inline_render_cache = OrderedDict()  # ключ -> (истекает, результат, статус)
+INLINE_RENDER_STATS = {'hits': 0, 'misses': 0}
+def get_cached_inline_result(key):
+    entry = _inline_render_cache.get(key)
+    if entry is None or entry[0] <= time.monotonic():
+        INLINE_RENDER_STATS['misses'] += 1
+        return None
+    _inline_render_cache.move_to_end(key)
+    INLINE_RENDER_STATS['hits'] += 1
+    return entry[1], entry[2]
+async def answer_inline_result(update: Update, key, result, kind: str, candidates=(), next_offset=None):
+    """Запоминает готовый результат и отвечает им (и кандидатами автодополнения) с cache_time по статусу."""
+    _inline_render_cache[key] = (time.monotonic() + INLINE_RENDER_TTL, result, kind)
+    _inline_render_cache.move_to_end(key)
+    while len(_inline_render_cache) > INLINE_RENDER_CACHE_SIZE:
+        _inline_render_cache.popitem(last=False)
+    await answer_card(update, key[0], result, kind, candidates, next_offset)
+async def answer_card(update: Update, user_id, result, kind: str, candidates=(), next_offset=None):
+    cache_time = INLINE_CACHE_TIME[kind] if not candidates else min(INLINE_CACHE_TIME[kind], INLINE_CANDIDATES_CACHE_TIME)
+    await update.inline_query.answer(results=[result] + candidate_results(candidates, exclude_user_id=user_id),
+                                     cache_time=cache_time, is_personal=False,
+                                     next_offset=str(next_offset) if next_offset else None)
+async def resolve_and_save_profile(query: str, priority: str) -> dict:
+    user_info = await get_user_info_via_userbot(query, priority=priority)
+    if user_info and 'error' not in user_info:
+        await storage.run(save_user_profile_from_userbot, user_info['id'], user_info)
+        index_profile(user_info['id'], user_info)
+    return user_info
+def _resolving_inline_result(query: str):
+    """Промежуточный inline-результат, пока юзербот ещё ищет пользователя."""
+    username = escape_markdown_v2(query.lstrip('@'))
+    return InlineQueryResultArticle(
+        id=str(hash(f"resolving_{query}") % 10**16),
+        title=f"⏳ Проверяем @{query.lstrip('@')}…",
+        description="Пользователь ещё ищется, повторите запрос через пару секунд",
+        input_message_content=InputTextMessageContent(
+            message_text=f"⏳ Пользователь @{username} ещё проверяется\\. Повторите запрос через пару секунд\\.",
+            parse_mode=ParseMode.MARKDOWN_V2,
+            disable_web_page_preview=True
+        ),
+    )
+# === АВТОДОПОЛНЕНИЕ ЮЗЕРНЕЙМОВ (см. prefix_index.py) ===
+# Недописанный юзернейм отвечается кандидатами из памяти; юзербот спрашивается
+# только про юзернейм допустимой длины, которого нет в индексе.
+MIN_USERNAME_LENGTH = 5  # короче Telegram юзернеймы не выдаёт
+# Полное перестроение: изменения этого процесса (index_profile, index_listed,
+# unindex_listed) попадают в индекс пачкой через PREFIX_INDEX_APPLY_DELAY, в потоке,
+# а изменения других воркеров — с ближайшим перестроением
+PREFIX_INDEX_REBUILD = 900  # секунд между полными перестроениями индекса из базы
+PREFIX_INDEX_APPLY_DELAY = 0.5  # секунд накопления изменений перед применением
+INLINE_CANDIDATES_CACHE_TIME = 30  # секунд кэша Telegram для ответа с кандидатами
+username_index = prefix_index.PrefixIndex()
+_prefix_rebuilder = None
+_prefix_applier = None
+def load_username_index_rows():
+    """Все известные юзернеймы как (username, user_id, статус) — для PrefixIndex.build."""
+    conn = storage.get_connection()
+    rows = []
+    for user_id, username, original_username in conn.execute('SELECT user_id, username, original_username FROM scammers'):
+        rows.extend((name, user_id, prefix_index.SCAMMER) for name in (username, original_username) if name)
+    for user_id, username, original_username in conn.execute('SELECT user_id, username, original_username FROM trusted'):
+        rows.extend((name, user_id, prefix_index.TRUSTED) for name in (username, original_username) if name)
+    for user_id, username, all_usernames in conn.execute('SELECT user_id, username, all_usernames FROM user_profiles'):
+        names = [username] + (all_usernames.split(',') if all_usernames else [])
+        rows.extend((name.strip(), user_id, prefix_index.UNKNOWN) for name in names if name and name.strip())
+    return prefix_index.PrefixIndex.build(rows)
+def rebuild_username_index():
+    username_index.begin_rebuild()
+    try:
+        username_index.swap(load_username_index_rows())
+    except BaseException:
+        username_index.cancel_rebuild()
+        raise
+async def rebuild_username_index_loop():
+    """Перестраивает индекс при старте и раз в PREFIX_INDEX_REBUILD секунд."""
+    while True:
+        try:
+            started = time.monotonic()
+            # Отдельный поток, а не пул storage: перестроение долгое и не должно занимать потоки запросов
+            await asyncio.to_thread(rebuild_username_index)
+            logger.info(f"[Prefix] Индекс перестроен: {username_index.size} юзернеймов за "
+                        f"{time.monotonic() - started:.1f} с.")
+        except Exception as e:
+            logger.error(f"[Prefix] Не удалось перестроить индекс юзернеймов: {e}")
+        await asyncio.sleep(PREFIX_INDEX_REBUILD)
+async def apply_username_index_changes():
+    """Применяет накопленные изменения индекса в потоке, пока они есть."""
+    global _prefix_applier
+    try:
+        while username_index.has_pending():
+            await asyncio.sleep(PREFIX_INDEX_APPLY_DELAY)
+            await asyncio.to_thread(username_index.apply_pending)
+    except Exception as e:
+        logger.error(f"[Prefix] Не удалось применить изменения индекса юзернеймов: {e}")
+    finally:
+        _prefix_applier = None
+def schedule_username_index_apply():
+    global _prefix_applier
+    if _prefix_applier is None:
+        _prefix_applier = asyncio.create_task(apply_username_index_changes())
+def start_username_index():
+    global _prefix_rebuilder
+    _prefix_rebuilder = asyncio.create_task(rebuild_username_index_loop())
+def stop_username_index():
+    if _prefix_rebuilder is not None:
+        _prefix_rebuilder.cancel()
+    if _prefix_applier is not None:
+        _prefix_applier.cancel()
+def index_profile(user_id, profile: dict):
+    """Юзернеймы профиля от юзербота — в индекс (со статусом «не найден», если пользователь не в списках)."""
+    names = profile.get('all_usernames') or []
+    if isinstance(names, str):
+        names = names.split(',')
+    for name in [profile.get('username')] + list(names):
+        if name:
+            username_index.upsert(name, user_id, prefix_index.UNKNOWN)
+    schedule_username_index_apply()
+def index_listed(user_id, usernames, table: str):
+    """Пользователь добавлен в scammers или trusted (и убран из другого списка)."""
+    status = prefix_index.SCAMMER if table == 'scammers' else prefix_index.TRUSTED
+    other = prefix_index.TRUSTED if status == prefix_index.SCAMMER else prefix_index.SCAMMER
+    if user_id:
+        username_index.demote(other, user_id=user_id)
+    for name in usernames:
+        if name:
+            username_index.upsert(name, user_id, status)
+    schedule_username_index_apply()
+def unindex_listed(target: str):
+    """Пользователь удалён из списков по @username или ID: его записи становятся «не найден»."""
+    target_clean = normalize_username(target)
+    user_id = int(target_clean) if target_clean.isdigit() else None
+    for status in (prefix_index.SCAMMER, prefix_index.TRUSTED):
+        username_index.demote(status, user_id=user_id, username=None if user_id else target_clean)
+    schedule_username_index_apply()
+def card_inline_result(template, result_id: str, username, user_id, text: str):
+    """Inline-результат с готовым текстом карточки и миниатюрой статуса."""
+    return InlineQueryResultArticle(
+        id=result_id,
+        title=template.inline_title(username),
+        description=f"ID: {user_id}" if user_id else "ID неизвестен",
+        input_message_content=InputTextMessageContent(
+            message_text=text,
+            parse_mode=ParseMode.MARKDOWN_V2,
+            disable_web_page_preview=True
+        ),
+        thumbnail_url=template.thumbnail_url,
+        thumbnail_width=48,
+        thumbnail_height=48,
+    )
+@functools.lru_cache(maxsize=20000)
+def candidate_inline_result(username: str, user_id, status: str):
+    """Короткая карточка кандидата автодополнения (собирается один раз на юзернейм и статус)."""
+    template = rendering.STATUS_TEMPLATES[status]
+    return card_inline_result(template, str(hash(f"candidate_{status}_{user_id}_{username.lower()}") % 10**16),
+                              username, user_id, template.render_short(username, user_id))
+def candidate_results(candidates, exclude_user_id=None):
+    return [candidate_inline_result(username, uid, status) for username, uid, status in candidates
+            if exclude_user_id is None or uid != exclude_user_id]
+async def answer_candidates(update: Update, candidates, next_offset, head=None, cache_time=INLINE_CANDIDATES_CACHE_TIME):
+    """Отвечает кандидатами из индекса (после head — полной карточки или «проверяем…», если есть)."""
+    results = ([head] if head is not None else []) + candidate_results(candidates)
+    await update.inline_query.answer(results=results, cache_time=cache_time, is_personal=False,
+                                     next_offset=str(next_offset) if next_offset else None)
+# === INLINE-СЕССИИ ПОЛЬЗОВАТЕЛЕЙ ===
+# Telegram присылает новый inline-запрос на каждое нажатие клавиши, а показан будет
+# только ответ на последний. У пользователя одна сессия: новый запрос вытесняет
+# предыдущий (тот перестаёт ждать и ничего не отвечает), а юзербот спрашивается,
+# только если запрос не менялся INLINE_DEBOUNCE секунд. Сессии живут в памяти
+# процесса — в режиме воркеров запросы пользователя должны идти в один воркер
+# (route_by "user", по умолчанию).
+INLINE_DEBOUNCE = 0.6  # секунд тишины перед запросом к юзерботу
+_inline_sessions = {}  # user_id -> asyncio.Event последнего запроса (set — запрос вытеснен)
+INLINE_SESSION_STATS = {'superseded': 0, 'resolver_avoided': 0, 'resolver_requests': 0}
+def open_inline_session(user_id):
+    """Начинает сессию нового запроса пользователя и вытесняет его предыдущий запрос."""
+    previous = _inline_sessions.get(user_id)
+    if previous is not None:
+        previous.set()
+    superseded = _inline_sessions[user_id] = asyncio.Event()
+    return superseded
+def close_inline_session(user_id, superseded):
+    if _inline_sessions.get(user_id) is superseded:
+        del _inline_sessions[user_id]
+def drop_superseded(query: str, before_resolver: bool = False):
+    """Учитывает вытесненный запрос; before_resolver — он так и не дошёл до юзербота."""
+    INLINE_SESSION_STATS['superseded'] += 1
+    if before_resolver:
+        INLINE_SESSION_STATS['resolver_avoided'] += 1
+    logger.info(f"Inline '{query}': вытеснен более новым запросом, не отвечаем.")
+async def debounce_inline(superseded, key: str) -> bool:
+    """
+    Ждёт, пока запрос не устоится. True — за это время пришёл более новый запрос.
+    Если тот же юзернейм уже запрашивается у юзербота, ждать незачем: запрос совместится.
+    """
+    if key in _ub_inflight:
+        return superseded.is_set()
+    try:
+        await asyncio.wait_for(superseded.wait(), INLINE_DEBOUNCE)
+    except asyncio.TimeoutError:
+        return False
+    return True
+async def inline_query(update: Update, context: CallbackContext):
+    user_id = update.inline_query.from_user.id
+    superseded = open_inline_session(user_id)
+    try:
+        await _inline_query(update, context, superseded)
+    finally:
+        close_inline_session(user_id, superseded)
+async def _inline_query(update: Update, context: CallbackContext, superseded):
     query = update.inline_query.query
     user_id = update.inline_query.from_user.id
     logger.info(f"ПОЛУЧЕН INLINE ЗАПРОС: '{query}' от user_id: {user_id}")
 
     if not query:
         logger.info("Inline запрос пустой, возвращаем пустой результат.")
-        update.inline_query.answer(results=[])
+        await update.inline_query.answer(results=[])
         return
 
     query = query.strip()
     clean_query = query.lstrip('@')
     is_id = clean_query.isdigit()
 
-    # === СНАЧАЛА ПОЛУЧАЕМ user_id ===
-    user_id_to_search = None
+    # === КАНДИДАТЫ АВТОДОПОЛНЕНИЯ ИЗ ПАМЯТИ ===
+    # Первая страница оставляет место под полную карточку, следующие — только кандидаты
+    page_offset = int(update.inline_query.offset) if update.inline_query.offset.isdigit() else 0
+    candidates, next_offset = [], None
+    known = None
+    if not is_id:
+        limit = prefix_index.PAGE_SIZE if page_offset else prefix_index.PAGE_SIZE - 1
+        candidates, next_offset = username_index.search(clean_query, page_offset, limit)
+        if page_offset:
+            await answer_candidates(update, candidates, next_offset)
+            return
+        known = username_index.exact(clean_query)
+        if not known and len(clean_query) < MIN_USERNAME_LENGTH:
+            # Юзернейм ещё набирается — юзербот не спрашиваем
+            await answer_candidates(update, candidates, next_offset)
+            return
+
+    # === СНАЧАЛА ПОЛУЧАЕМ user_id И СТАТУС ОДНИМ ЗАПРОСОМ ===
     username_to_display = None
     first_name = 'неизвестно'
     last_name = ''
     date_created = 'неизвестно'
     all_usernames = ''
-    search_count = 0
-
-    if is_id:
-        user_id_to_search = int(clean_query)
-        # Пробуем получить username и профиль из user_profiles
-        conn = sqlite3.connect('scam_base.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT username FROM user_profiles WHERE user_id = ?', (user_id_to_search,))
-        result = cursor.fetchone()
-        if result:
-            username_to_display = result[0]
-
-        cursor.execute('SELECT first_name, last_name, date_created, all_usernames FROM user_profiles WHERE user_id = ?', (user_id_to_search,))
-        profile = cursor.fetchone()
-        if profile:
-            first_name = profile[0] if profile[0] else 'неизвестно'
-            last_name = profile[1] if profile[1] else ''
-            date_created = profile[2] if profile and profile[2] else 'неизвестно'
-            all_usernames = profile[3] if profile[3] else ''
-        conn.close()
 
-        # Получаем количество поисков
-        search_count = get_search_count(user_id_to_search)
-
-    else:
+    # Юзернейм из индекса уже известен с ID — статус читаем по ID. В индексе есть и старые
+    # юзернеймы (original_username, all_usernames): юзербот не нужен, только если это
+    # текущий юзернейм пользователя по user_profiles, иначе попадание — лишь подсказка
+    queries = storage.count_statements()
+    status = await storage.run(resolve_user_status, known[1] if known and known[1] else clean_query)
+    if known and known[1] and not (status['profile'] and normalize_username(status['profile'][1]) == normalize_username(clean_query)):
+        status = await storage.run(resolve_user_status, clean_query)
+    user_id_to_search = status['user_id']
+    if not is_id:
         username_to_display = clean_query
-        # Пробуем получить ID из user_profiles
-        conn = sqlite3.connect('scam_base.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM user_profiles WHERE LOWER(username) = ?', (username_to_display.lower(),))
-        result = cursor.fetchone()
-        if result:
-            user_id_to_search = result[0]
-
-            # Получаем профиль из user_profiles
-            cursor.execute('SELECT first_name, last_name, date_created, all_usernames FROM user_profiles WHERE user_id = ?', (user_id_to_search,))
-            profile = cursor.fetchone()
-            if profile:
-                first_name = profile[0] if profile[0] else 'неизвестно'
-                last_name = profile[1] if profile[1] else ''
-                date_created = profile[2] if profile and profile[2] else 'неизвестно'
-                all_usernames = profile[3] if profile[3] else ''
-        conn.close()
-
-        # Получаем количество поисков
-        if user_id_to_search:
-            search_count = get_search_count(user_id_to_search)
-
         if not user_id_to_search:
-            # Пробуем получить ID через юзербота
-            user_info = get_user_info_via_userbot(query)
+            # Юзербота спрашиваем только про устоявшийся запрос
+            if await debounce_inline(superseded, normalize_username(query)):
+                drop_superseded(query, before_resolver=True)
+                return
+            # Пробуем получить ID через юзербота (профиль сохраняется в resolve_and_save_profile)
+            INLINE_SESSION_STATS['resolver_requests'] += 1
+            resolving = asyncio.create_task(resolve_and_save_profile(query, 'inline'))
+            _inline_resolving.add(resolving)
+            resolving.add_done_callback(_inline_resolving.discard)
+            # Ждём юзербота, пока не вышел бюджет ответа или запрос не вытеснен;
+            # сам запрос к юзерботу продолжается в фоне и сохранит профиль
+            waiter = asyncio.create_task(superseded.wait())
+            try:
+                done, _ = await asyncio.wait({resolving, waiter}, timeout=INLINE_ANSWER_BUDGET,
+                                             return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+            if resolving not in done:
+                if superseded.is_set():
+                    drop_superseded(query)
+                    return
+                logger.info(f"Inline '{query}': юзербот не успел за {INLINE_ANSWER_BUDGET} с, отвечаем «проверяем…».")
+                await answer_candidates(update, candidates, next_offset, head=_resolving_inline_result(query), cache_time=0)
+                return
+            user_info = resolving.result()
             if user_info and 'error' not in user_info:
                 user_id_to_search = user_info['id']
                 username_to_display = user_info.get('username') # <<< username может быть с | или др. символами
-                # Сохраняем в user_profiles
-                save_user_profile_from_userbot(user_id_to_search, user_info)
-                # Обновляем переменные профиля
-                first_name = user_info.get('first_name', 'неизвестно')
-                last_name = user_info.get('last_name', '')
-                date_created = user_info.get('account_creation', 'неизвестно') # Используем account_creation
-                all_usernames_list = user_info.get('all_usernames', [])
-                if isinstance(all_usernames_list, list):
-                    all_usernames = ','.join(all_usernames_list)
-                else:
-                    all_usernames = user_info.get('username', '') or ''
-
-                # Получаем количество поисков
-                search_count = get_search_count(user_id_to_search)
-
-
-    # === Если не получили user_id — возвращаем пустой результат ===
-    if not user_id_to_search:
-        update.inline_query.answer(results=[], cache_time=0)
+                # Перечитываем статус уже по ID
+                status = await storage.run(resolve_user_status, user_id_to_search)
+            elif is_userbot_unavailable(user_info):
+                # Юзербот недоступен — отвечаем только по своей базе
+                user_id_to_search = await storage.run(find_user_id_in_db, clean_query)
+                if user_id_to_search:
+                    status = await storage.run(resolve_user_status, user_id_to_search)
+    _check_query_budget("Inline", query, queries[0])
+
+    # Переменные профиля из user_profiles
+    profile = status['profile']
+    if profile:
+        if is_id:
+            username_to_display = profile[1]
+        first_name = profile[2] if profile[2] else 'неизвестно'
+        last_name = profile[3] if profile[3] else ''
+        date_created = profile[4] if profile[4] else 'неизвестно'
+        all_usernames = profile[6] if profile[6] else ''
+    search_count = status['search_count']
+
+    if superseded.is_set():
+        drop_superseded(query)
         return
 
-    # Формируем список юзернеймов
-    if all_usernames:
-        all_usernames_list = [uname.strip() for uname in all_usernames.split(',') if uname.strip()]
-        all_usernames_str = ', '.join([f"@{escape_markdown_v2(uname)}" for uname in all_usernames_list])
-    else:
-        all_usernames_str = f"@{escape_markdown_v2(username_to_display)}" if username_to_display else "неизвестен"
-
-    # === Ищем в trusted ===
-    trust_info = find_user_in_table(str(user_id_to_search), 'trusted')
-    if trust_info:
-        t_user_id, t_username, t_original_username, t_note, _ = trust_info
-        if not is_id and clean_query:
-            display_username = clean_query  # тот, по которому искали
-        else:
-            display_username = t_username if t_username else username_to_display if username_to_display else "неизвестен" # юзернейм из базы или от юзербота
-
-        # <<< ЛОГИРОВАНИЕ >>>
-        logger.info(f"Inline trusted - clean_query: '{clean_query}', t_username: '{t_username}', username_to_display: '{username_to_display}', display_username: '{display_username}', first_name: '{first_name}', last_name: '{last_name}', date_created: '{date_created}'")
-
-        # Формируем сообщение как в _handle_user_check, но с экранированием
-        # Формируем строку отображения
-        if display_username and t_user_id:
-            display = f"@{escape_markdown_v2(display_username)} \\| ID: `{t_user_id}`"
-        elif display_username:
-            display = f"@{escape_markdown_v2(display_username)} \\| ID: неизвестен"
-        elif t_user_id:
-            display = f"ID: `{t_user_id}`"
-        else:
-            display = "неизвестен"
-        msg = f"👤 Пользователь: {display}"
-
-        info_lines = (
-            f"\n🔮 Имя: {escape_markdown_v2(first_name)} {escape_markdown_v2(last_name)}\n"
-            f"📓 Юзернеймы: {all_usernames_str}\n\n" # all_usernames_str уже содержит экранированные юзернеймы
-            f"🪬 Дата создания: {escape_markdown_v2(date_created)}\n" # <<< Экранируем date_created
-        )
-        status_line = "💡`Статус`: *__ГАРАНТ__* ✅\n\n🟢*Данный пользователь является гарантом\\! Следующий вывод был основан на его репутации\\.*"
-        note_line = f"\n\n🔓Дополнительная информация🔑:\n\n{escape_markdown_v2(t_note)}\n" if t_note else ""
-        chat_line = ">Наш чат: @loneasBASE\n>Наш канал: @loneasproofs" # <<< Цитаты > теперь в caption
-        msg += f"\n{info_lines}\n{status_line}{note_line}\n{chat_line}"
-
-        # Title и description для отображения в инлайн-поиске
-        title = f"✅ @{escape_markdown_v2(display_username)} (Гарант)" # <<< Экранируем юзернейм в title
-        description = f"ID: {t_user_id}"
-
-        # Используем InlineQueryResultArticle с форматированным сообщением
-        result = InlineQueryResultArticle(
-            id=str(hash(f"trusted_{user_id_to_search}") % 10**16), # Уникальный ID
-            title=title,
-            description=description,
-            input_message_content=InputTextMessageContent(
-                message_text=msg, # <<< Полное сообщение с форматированием
-                parse_mode=ParseMode.MARKDOWN_V2, # <<< parse_mode включен
-                disable_web_page_preview=True
-            ),
-            thumb_url="https://winchanii.ru/media/sb/guarantee8.jpg", # URL миниатюры (иконки)
-            thumb_width=48, # Ширина миниатюры
-            thumb_height=48, # Высота миниатюры
-        )
-        update.inline_query.answer(results=[result], cache_time=0)
+    # === Если не получили user_id — отвечаем только кандидатами (или пустым результатом) ===
+    if not user_id_to_search:
+        await answer_candidates(update, candidates, next_offset, cache_time=0)
         return
 
-    # === Ищем в scammers ===
-    scam_info = find_user_in_table(str(user_id_to_search), 'scammers')
-    if scam_info:
-        s_user_id, s_username, s_original_username, s_note, s_proof_url = scam_info
-        # <<< Правильная логика для display_username >>>
-        if not is_id and clean_query:
-            display_username = clean_query  # тот, по которому искали
-        else:
-            display_username = s_username if s_username else username_to_display if username_to_display else "неизвестен" # юзернейм из базы или от юзербота
-
-        # <<< ЛОГИРОВАНИЕ >>>
-        logger.info(f"Inline scammer - clean_query: '{clean_query}', s_username: '{s_username}', username_to_display: '{username_to_display}', display_username: '{display_username}', first_name: '{first_name}', last_name: '{last_name}', date_created: '{date_created}'")
-
-        # Формируем строку отображения
-        if display_username and s_user_id:
-            display = f"@{escape_markdown_v2(display_username)} \\| ID: `{s_user_id}`"
-        elif display_username:
-            display = f"@{escape_markdown_v2(display_username)} \\| ID: неизвестен"
-        elif s_user_id:
-            display = f"ID: `{s_user_id}`"
-        else:
-            display = "неизвестен"
-        msg = f"👤 Пользователь: {display}"
-
-        info_lines = (
-            f"\n🔮 Имя: {escape_markdown_v2(first_name)} {escape_markdown_v2(last_name)}\n"
-            f"📓 Юзернеймы: {all_usernames_str}\n" # all_usernames_str уже содержит экранированные юзернеймы
-            f"🪬 Дата создания: {escape_markdown_v2(date_created)}\n" # <<< Экранируем date_created
-            f"🔍 Искали в базе: {search_count} раз\\(а\\)"
-        )
-        status_line = "\n⚠️ НАЙДЕН В СКАМ\\-БАЗЕ\\!⚠️\n\n💡`Статус`: *__МОШЕННИК__*❌\n\n🔴*Пользователь — скамер\\. Найден в базе @LoneasBasebot\\. Ни в коем случае не контактируйте с данным человеком, не ведитесь на его уловки\\.*"
-        note_line = f"\n\n🔓Дополнительная информация🔑:\n\n{escape_markdown_v2(s_note)}\n" if s_note else ""
-        proof_line = f">Пруфы: [ссылка]({s_proof_url})" if s_proof_url else ""
-        chat_line = ">Наш чат: @loneasBASE\n>Наш канал: @loneasproofs"
-        if s_proof_url:
-            footer = proof_line + "\n>" + chat_line
-        else:
-            footer = chat_line
-        msg += f"\n{info_lines}\n{status_line}{note_line}\n{footer}"
-
-        # Title и description для отображения в инлайн-поиске
-        title = f"❌ @{escape_markdown_v2(display_username)} (Скамер)" # <<< Экранируем юзернейм в title
-        description = f"ID: {s_user_id}"
-
-        # Используем InlineQueryResultArticle с форматированным сообщением
-        result = InlineQueryResultArticle(
-            id=str(hash(f"scammer_{user_id_to_search}") % 10**16), # Уникальный ID
-            title=title,
-            description=description,
-            input_message_content=InputTextMessageContent(
-                message_text=msg, # <<< Полное сообщение с форматированием
-                parse_mode=ParseMode.MARKDOWN_V2, # <<< parse_mode включен
-                disable_web_page_preview=True
-            ),
-            thumb_url="https://winchanii.ru/media/sb/scammer8.jpg", # URL миниатюры (иконки)
-            thumb_width=48, # Ширина миниатюры
-            thumb_height=48, # Высота миниатюры
-        )
-        update.inline_query.answer(results=[result], cache_time=0)
+    # === Готовая карточка, если статус пользователя не менялся ===
+    cache_key = (user_id_to_search, status['version'], None if is_id else clean_query.lower())
+    cached = get_cached_inline_result(cache_key)
+    if cached is not None:
+        result, kind = cached
+        await answer_card(update, user_id_to_search, result, kind, candidates, next_offset)
         return
 
-    # === Не найден ===
+    # === Гарант, скамер или не найден (текст карточки — rendering.py) ===
+    kind, record = status_kind(status)
+    if record:
+        card_user_id, record_username, note = record[0], record[1], record[3]
+        proof_url = record[4] if kind == rendering.SCAMMER else None
+    else:
+        card_user_id, record_username, note, proof_url = user_id_to_search, None, None, None
     if not is_id and clean_query:
         display_username = clean_query  # тот, по которому искали
     else:
-        display_username = username_to_display if username_to_display else "неизвестен" # юзернейм, полученный по ID
-
-    # <<< ЛОГИРОВАНИЕ >>>
-    logger.info(f"Inline unknown - clean_query: '{clean_query}', username_to_display: '{username_to_display}', display_username: '{display_username}', first_name: '{first_name}', last_name: '{last_name}', date_created: '{date_created}'")
-
-    # Формируем сообщение как в _handle_user_check, но с экранированием
-    # Формируем строку отображения
-    if display_username and user_id_to_search:
-        display = f"@{escape_markdown_v2(display_username)} \\| ID: `{user_id_to_search}`"
-    elif display_username:
-        display = f"@{escape_markdown_v2(display_username)} \\| ID: неизвестен"
-    elif user_id_to_search:
-        display = f"ID: `{user_id_to_search}`"
-    else:
-        display = "неизвестен"
-    msg = f"👤 Пользователь: {display}"
-
-    info_lines = (
-        f"\n🔮 Имя: {escape_markdown_v2(first_name)} {escape_markdown_v2(last_name)}\n"
-        f"📓 Юзернеймы: {all_usernames_str}\n" # all_usernames_str уже содержит экранированные юзернеймы
-        f"🪬 Дата создания: {escape_markdown_v2(date_created)}\n" # <<< Экранируем date_created
-        f"🔍 Найден в базе: {search_count} раз\\(а\\)"
-    )
-    status_line = f"\n💡`Статус`: *__НЕ НАЙДЕН__* 🔍\n\n⚫️Пользователь @{escape_markdown_v2(display_username)} не был найден в нашей базе\\. Данная личность не проверена\\.\n\n🔓Дополнительная информация🔑:\n\nРекомендуется быть осторожным и использовать услуги проверенных гарантов \\- /listtrusted\\.\n"
-    chat_line = ">Наш чат: @loneasBASE\n>Наш канал: @loneasproofs"
-    msg += f"\n{info_lines}\n{status_line}\n{chat_line}"
-
-    # Title и description для отображения в инлайн-поиске
-    title = f"🔍 @{escape_markdown_v2(display_username)} (Не найден)" # <<< Экранируем юзернейм в title
-    description = f"ID: {user_id_to_search}"
-
-    # Используем InlineQueryResultArticle с форматированным сообщением
-    result = InlineQueryResultArticle(
-        id=str(hash(f"unknown_{user_id_to_search}") % 10**16), # Уникальный ID
-        title=title,
-        description=description,
-        input_message_content=InputTextMessageContent(
-            message_text=msg, # <<< Полное сообщение с форматированием
-            parse_mode=ParseMode.MARKDOWN_V2, # <<< parse_mode включен
-            disable_web_page_preview=True
-        ),
-        thumb_url="https://winchanii.ru/media/sb/unknown8.jpg", # URL миниатюры (иконки)
-        thumb_width=48, # Ширина миниатюры
-        thumb_height=48, # Высота миниатюры
-    )
-    update.inline_query.answer(results=[result], cache_time=0)
+        display_username = record_username or username_to_display or "неизвестен"  # из базы или от юзербота
+    logger.info(f"Inline {kind} - clean_query: '{clean_query}', username_to_display: '{username_to_display}', "
+                f"display_username: '{display_username}'")
+    template = rendering.STATUS_TEMPLATES[kind]
+    msg = template.render(display_username, card_user_id, first_name, last_name, all_usernames or username_to_display,
+                          date_created, search_count, note, proof_url)
+    result = card_inline_result(template, str(hash(f"{kind}_{user_id_to_search}") % 10**16), display_username,
+                                card_user_id, msg)
+    await answer_inline_result(update, cache_key, result, kind, candidates, next_offset)
 
 
 # === ОСТАЛЬНЫЕ ФУНКЦИИ ===
 # Добавить в скам
-def add_scammer_start(update: Update, context: CallbackContext):
+async def add_scammer_start(update: Update, context: CallbackContext):
     if update.effective_user.id not in ADMIN_IDS:
-        update.message.reply_text("🚫 Только админы могут добавлять скамеров\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        await update.message.reply_text("🚫 Только админы могут добавлять скамеров\\.", parse_mode=ParseMode.MARKDOWN_V2)
         return ConversationHandler.END
-    update.message.reply_text("👤 Отправьте `@username` или `ID` скамера:")
+    await update.message.reply_text("👤 Отправьте `@username` или `ID` скамера:")
     return WAITING_FOR_TARGET
 # Перемещение из гарант в скам
-def receive_scammer_target(update: Update, context: CallbackContext):
+async def receive_scammer_target(update: Update, context: CallbackContext):
     target = update.message.text.strip().lstrip('@')
     if not target:
-        update.message.reply_text("❌ Некорректно\\. Попробуйте снова\\.")
+        await update.message.reply_text("❌ Некорректно\\. Попробуйте снова\\.")
         return WAITING_FOR_TARGET
-    if find_user_in_table(target, 'trusted'):
-        move_user_between_tables(target, 'trusted', 'scammers')
-        update.message.reply_text(f"ℹ️ Пользователь @{target} перемещён из «проверенных» в «скамеры»\\.")
+    if await storage.run(move_user_between_tables, target, 'trusted', 'scammers'):
+        await update.message.reply_text(f"ℹ️ Пользователь @{target} перемещён из «проверенных» в «скамеры»\\.")
     context.user_data['target'] = target
-    update.message.reply_text("✏️ Примечание \\(или /skip\\):")
+    await update.message.reply_text("✏️ Примечание \\(или /skip\\):")
     return WAITING_FOR_NOTE
 # Пруфы скамера
-def receive_scammer_note(update: Update, context: CallbackContext):
+async def receive_scammer_note(update: Update, context: CallbackContext):
     note = update.message.text if update.message.text != '/skip' else ""
     context.user_data['note'] = note
-    update.message.reply_text("🔗 Отправьте ссылку на пруфы \\(или /skip\\):")
+    await update.message.reply_text("🔗 Отправьте ссылку на пруфы \\(или /skip\\):")
     return WAITING_FOR_PROOF
-def skip_scammer_note(update: Update, context: CallbackContext):
+async def skip_scammer_note(update: Update, context: CallbackContext):
     context.user_data['note'] = ""
-    update.message.reply_text("🔗 Отправьте ссылку на пруфы \\(или /skip\\):")
+    await update.message.reply_text("🔗 Отправьте ссылку на пруфы \\(или /skip\\):")
     return WAITING_FOR_PROOF
-def receive_scammer_proof(update: Update, context: CallbackContext):
+async def receive_scammer_proof(update: Update, context: CallbackContext):
     proof_url = update.message.text.strip()
     if proof_url.lower() == '/skip':
         context.user_data['proof_url'] = None
     elif proof_url.startswith(('http://', 'https://')):
         context.user_data['proof_url'] = proof_url
     else:
-        update.message.reply_text("❌ Некорректная ссылка\\. Отправьте снова или /skip:")
+        await update.message.reply_text("❌ Некорректная ссылка\\. Отправьте снова или /skip:")
         return WAITING_FOR_PROOF
-    _save_to_db(update, context, 'scammers', publish=True)
+    await _save_to_db(update, context, 'scammers', publish=True)
     return ConversationHandler.END
-def skip_scammer_proof(update: Update, context: CallbackContext):
+async def skip_scammer_proof(update: Update, context: CallbackContext):
     context.user_data['proof_url'] = None
-    _save_to_db(update, context, 'scammers', publish=True)
+    await _save_to_db(update, context, 'scammers', publish=True)
     return ConversationHandler.END
 # Добавить гаранта
-def add_trusted_start(update: Update, context: CallbackContext):
+async def add_trusted_start(update: Update, context: CallbackContext):
     if update.effective_user.id not in ADMIN_IDS:
-        update.message.reply_text("🚫 Только админы могут добавлять проверенных\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        await update.message.reply_text("🚫 Только админы могут добавлять проверенных\\.", parse_mode=ParseMode.MARKDOWN_V2)
         return ConversationHandler.END
-    update.message.reply_text("👤 Отправьте `@username` или `ID` проверенного пользователя:")
+    await update.message.reply_text("👤 Отправьте `@username` или `ID` проверенного пользователя:")
     return WAITING_FOR_TRUSTED_TARGET
-def receive_trusted_target(update: Update, context: CallbackContext):
+async def receive_trusted_target(update: Update, context: CallbackContext):
     target = update.message.text.strip().lstrip('@')
     if not target:
-        update.message.reply_text("❌ Некорректно\\. Попробуйте снова\\.")
+        await update.message.reply_text("❌ Некорректно\\. Попробуйте снова\\.")
         return WAITING_FOR_TRUSTED_TARGET
-    if find_user_in_table(target, 'scammers'):
-        move_user_between_tables(target, 'scammers', 'trusted')
-        update.message.reply_text(f"ℹ️ Пользователь @{target} перемещён из «скамеров» в «проверенные»\\.")
+    if await storage.run(move_user_between_tables, target, 'scammers', 'trusted'):
+        await update.message.reply_text(f"ℹ️ Пользователь @{target} перемещён из «скамеров» в «проверенные»\\.")
     context.user_data['target'] = target
-    update.message.reply_text("✏️ Информация \\(или /skip\\):")
+    await update.message.reply_text("✏️ Информация \\(или /skip\\):")
     return WAITING_FOR_TRUSTED_NOTE
-def receive_trusted_note(update: Update, context: CallbackContext):
+async def receive_trusted_note(update: Update, context: CallbackContext):
     note = update.message.text if update.message.text != '/skip' else ""
     context.user_data['note'] = note
-    _save_to_db(update, context, 'trusted', publish=True)
+    await _save_to_db(update, context, 'trusted', publish=True)
     return ConversationHandler.END
-def skip_trusted_note(update: Update, context: CallbackContext):
+async def skip_trusted_note(update: Update, context: CallbackContext):
     context.user_data['note'] = ""
-    _save_to_db(update, context, 'trusted', publish=True)
+    await _save_to_db(update, context, 'trusted', publish=True)
     return ConversationHandler.END
 # Удаление из базы
-def remove_start(update: Update, context: CallbackContext):
+async def remove_start(update: Update, context: CallbackContext):
     if update.effective_user.id not in ADMIN_IDS:
-        update.message.reply_text("🚫 Только админы могут удалять\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        await update.message.reply_text("🚫 Только админы могут удалять\\.", parse_mode=ParseMode.MARKDOWN_V2)
         return ConversationHandler.END
-    update.message.reply_text("🗑️ Отправьте `@username` или `ID` для удаления:")
+    await update.message.reply_text("🗑️ Отправьте `@username` или `ID` для удаления:")
     return WAITING_FOR_REMOVE_TARGET
-def receive_remove_target(update: Update, context: CallbackContext):
+async def receive_remove_target(update: Update, context: CallbackContext):
     target = update.message.text.strip()
-    deleted_scam = remove_user_from_table(target, 'scammers')
-    deleted_trust = remove_user_from_table(target, 'trusted')
+    deleted_scam = await storage.run(remove_user_from_table, target, 'scammers')
+    deleted_trust = await storage.run(remove_user_from_table, target, 'trusted')
+    if deleted_scam or deleted_trust:
+        unindex_listed(target)
     if deleted_scam and deleted_trust:
         msg = "⚠️ Удалён из обеих баз\\."
     elif deleted_scam:
@@ -1056,38 +1436,30 @@ def receive_remove_target(update: Update, context: CallbackContext):
         msg = "🗑️ Удалён из проверенных\\."
     else:
         msg = "❌ Не найден ни в одной базе\\."
-    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
     return ConversationHandler.END
 # /listscam
-def list_scam(update: Update, context: CallbackContext):
-    conn = sqlite3.connect('scam_base.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, original_username FROM scammers") # <<< Используем original_username
-    rows = cursor.fetchall()
-    conn.close()
+async def list_scam(update: Update, context: CallbackContext):
+    rows = await storage.fetch_all("SELECT user_id, original_username FROM scammers") # <<< Используем original_username
     if not rows:
-        update.message.reply_text("Скам\\-база пуста\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        await update.message.reply_text("Скам\\-база пуста\\.", parse_mode=ParseMode.MARKDOWN_V2)
         return
     lines = [f"@{uname}" if uname else f"ID: {uid}" for uid, uname in rows]
     escaped_lines = [escape_markdown_v2(line) for line in lines]
     text = "*🔴 Список скамеров:*\n" + "\n".join(escaped_lines)
-    update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
 # /listtrusted
-def list_trusted(update: Update, context: CallbackContext):
-    conn = sqlite3.connect('scam_base.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, username FROM trusted")
-    rows = cursor.fetchall()
-    conn.close()
+async def list_trusted(update: Update, context: CallbackContext):
+    rows = await storage.fetch_all("SELECT user_id, username FROM trusted")
     if not rows:
-        update.message.reply_text("Нет проверенных пользователей\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        await update.message.reply_text("Нет проверенных пользователей\\.", parse_mode=ParseMode.MARKDOWN_V2)
         return
     lines = [f"@{uname}" if uname else f"ID: {uid}" for uid, uname in rows]
     escaped_lines = [escape_markdown_v2(line) for line in lines]
     text = "*🟢 Проверенные пользователи:*\n" + "\n".join(escaped_lines)
-    update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
 # /help
-def help_command(update: Update, context: CallbackContext):
+async def help_command(update: Update, context: CallbackContext):
     msg = (
         "ℹ️ *Справка по командам*\n"
         "*Для всех:*\n"
@@ -1098,11 +1470,12 @@ def help_command(update: Update, context: CallbackContext):
         "• `/addscam` — добавить скамера\n"
         "• `/addtrusted` — добавить проверенного\n"
         "• `/remove` — удалить из базы\n"
+        "• `/stats` — нагрузка на бота\n"
         "• `/help` — эта справка\n"
     )
-    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
 # сохранение в дб
-def _save_to_db(update: Update, context: CallbackContext, table: str, publish=False):
+async def _save_to_db(update: Update, context: CallbackContext, table: str, publish=False):
     target = context.user_data['target']
     note = context.user_data.get('note', '')
     proof_url = context.user_data.get('proof_url')  # Только для скамеров
@@ -1113,48 +1486,40 @@ def _save_to_db(update: Update, context: CallbackContext, table: str, publish=Fa
     if target.isdigit():
         user_id = int(target)
         # Пробуем получить username из таблицы users
-        conn = sqlite3.connect('scam_base.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        result = await storage.fetch_one("SELECT username FROM users WHERE user_id = ?", (user_id,))
         if result:
             username = result[0]  # Уже без @
     else:
         username = target.lstrip('@')
         original_username = username # <<< Сохраняем оригинальный юзернейм
         # Пробуем получить ID из таблицы users
-        conn = sqlite3.connect('scam_base.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users WHERE LOWER(username) = ?", (username.lower(),))
-        result = cursor.fetchone()
-        conn.close()
+        result = await storage.fetch_one("SELECT user_id FROM users WHERE LOWER(username) = ?", (normalize_username(username),))
         if result:
             user_id = result[0]
         else:
             # Пробуем получить ID через юзербота
-            user_info = get_user_info_via_userbot(username)
+            user_info = await get_user_info_via_userbot(username, priority='admin')
             if user_info and 'error' not in user_info:
                 user_id = user_info['id']
                 username = user_info.get('username')
                 # Сохраняем в user_profiles
-                save_user_profile_from_userbot(user_id, user_info)
+                await storage.run(save_user_profile_from_userbot, user_id, user_info)
 
     # === Если не получили user_id — не добавляем ===
     if not user_id:
-        update.message.reply_text("❌ Не удалось получить ID пользователя\\. Попробуйте позже \\(Возможно\\, это канал или чат переходник\\, пришлите юзернейм из этого канала или чата\\, возможно сработает\\)\\.", parse_mode=ParseMode.MARKDOWN_V2)
+        await update.message.reply_text("❌ Не удалось получить ID пользователя\\. Попробуйте позже \\(Возможно\\, это канал или чат переходник\\, пришлите юзернейм из этого канала или чата\\, возможно сработает\\)\\.", parse_mode=ParseMode.MARKDOWN_V2)
         return
 
     # === Удаляем из другой таблицы, если есть ===
     other_table = 'trusted' if table == 'scammers' else 'scammers'
-    if find_user_in_table(str(user_id), other_table):
-        move_user_between_tables(str(user_id), other_table, table)
+    await storage.run(move_user_between_tables, str(user_id), other_table, table)
 
     # === Сохраняем в базу (только по user_id) ===
     if table == 'scammers':
-        add_user_to_table(user_id, username, original_username, note, table, proof_url)
+        await storage.run(add_user_to_table, user_id, username, original_username, note, table, proof_url)
     else:
-        add_user_to_table(user_id, username, original_username, note, table)
+        await storage.run(add_user_to_table, user_id, username, original_username, note, table)
+    index_listed(user_id, (username, original_username), table)
 
     # === Формируем сообщение для админа ===
     display_parts = []
@@ -1164,21 +1529,59 @@ def _save_to_db(update: Update, context: CallbackContext, table: str, publish=Fa
         display_parts.append(f"ID {user_id}")
     display = " \\| ".join(display_parts) if display_parts else target
     name = "скамер" if table == 'scammers' else "проверенный"
-    update.message.reply_text(f"✅ {name.capitalize()} успешно добавлен: {display}")
+    await update.message.reply_text(f"✅ {name.capitalize()} успешно добавлен: {display}")
 
     # === Публикуем в канал, если нужно ===
     if publish and username and user_id and note:
-        publish_to_channel(context, user_id, username, note, proof_url, table == 'scammers')
+        await publish_to_channel(context, user_id, username, note, proof_url, table == 'scammers')
 
-def cancel(update: Update, context: CallbackContext):
-    update.message.reply_text("❌ Операция отменена\\.", parse_mode=ParseMode.MARKDOWN_V2)
+async def cancel(update: Update, context: CallbackContext):
+    await update.message.reply_text("❌ Операция отменена\\.", parse_mode=ParseMode.MARKDOWN_V2)
     return ConversationHandler.END
 
-def error_handler(update: object, context: CallbackContext):
+async def error_handler(update: object, context: CallbackContext):
     logger.error("Exception while handling an update:", exc_info=context.error)
 
+# === ПУЛЫ ОБРАБОТЧИКОВ ===
+fast_pool = handlerpool.HandlerPool('fast', HANDLER_POOLS_CONFIG['fast']['workers'],
+                                    HANDLER_POOLS_CONFIG['fast']['queue'])
+resolver_pool = handlerpool.HandlerPool('resolver', HANDLER_POOLS_CONFIG['resolver']['workers'],
+                                        HANDLER_POOLS_CONFIG['resolver']['queue'])
+async def reply_overloaded(update: Update, context: CallbackContext):
+    """Ответ, когда очередь пула переполнена (inline-запросы и посты канала просто пропускаются)."""
+    if update.message:
+        try:
+            await update.message.reply_text("⏳ Бот сейчас перегружен, повторите запрос через минуту\\.",
+                                            parse_mode=ParseMode.MARKDOWN_V2)
+        except Exception as e:
+            logger.warning(f"[Pool] Не удалось ответить о перегрузке: {e}")
+def on_fast_pool(callback):
+    return fast_pool.wrap(callback, on_reject=reply_overloaded)
+def on_resolver_pool(callback):
+    return resolver_pool.wrap(callback, on_reject=reply_overloaded)
+# /stats — нагрузка на пулы и юзербота (только админы)
+async def stats_command(update: Update, context: CallbackContext):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    lines = []
+    for pool in (fast_pool, resolver_pool):
+        m = pool.metrics()
+        lines.append(f"Пул {pool.name}: занято {m['busy']}/{m['workers']}, в очереди {m['depth']} "
+                     f"(макс. {m['max_depth']}), выполнено {m['completed']}, ошибок {m['failed']}, "
+                     f"отклонено {m['rejected']}, среднее ожидание {m['avg_wait_ms']} мс")
+    lines.append(f"Юзербот: выключатель {userbot_breaker.state}, запросов {UB_COALESCE_STATS['upstream']}, "
+                 f"совмещено {UB_COALESCE_STATS['coalesced']}, из кэша ошибок {NEGATIVE_CACHE_STATS['hits']}")
+    lines.append(f"Картинки: по file_id {status_media.stats['by_file_id']}, загрузок {status_media.stats['uploads']}, "
+                 f"устаревших file_id {status_media.stats['stale']}")
+    lines.append(f"Inline-карточки: из кэша {INLINE_RENDER_STATS['hits']}, собрано {INLINE_RENDER_STATS['misses']}")
+    lines.append(f"Индекс юзернеймов: {username_index.size}")
+    lines.append(f"Inline-сессии: вытеснено запросов {INLINE_SESSION_STATS['superseded']}, "
+                 f"обращений к юзерботу {INLINE_SESSION_STATS['resolver_requests']}, "
+                 f"сэкономлено {INLINE_SESSION_STATS['resolver_avoided']}")
+    await update.message.reply_text("\n".join(lines))
+
 # === АВТОМАТИЧЕСКОЕ ДОБАВЛЕНИЕ ИЗ КАНАЛА ===
-def monitor_channel_messages(update: Update, context: CallbackContext):
+async def monitor_channel_messages(update: Update, context: CallbackContext):
     # Определяем, является ли обновление сообщением или постом в канале
     message = update.message or update.channel_post
 
@@ -1204,22 +1607,23 @@ def monitor_channel_messages(update: Update, context: CallbackContext):
         proof_url = f"https://t.me/c/{str(message.chat.id)[4:]}/{message.message_id}"
 
         # Получаем user_id через юзербота
-        user_info = get_user_info_via_userbot(f"@{username}")
+        user_info = await get_user_info_via_userbot(f"@{username}", priority='background')
         if user_info and 'error' not in user_info:
             user_id = user_info['id']
 
             # Сохраняем профиль
-            save_user_profile_from_userbot(user_id, user_info)
+            await storage.run(save_user_profile_from_userbot, user_id, user_info)
 
             # Добавляем в базу скамеров, используя username как original_username
-            add_user_to_table(user_id, username, username, note, 'scammers', proof_url)
+            await storage.run(add_user_to_table, user_id, username, username, note, 'scammers', proof_url)
+            index_listed(user_id, (username,), 'scammers')
             # Больше никаких уведомлений в канал
 # Бекапы
 def backup_database():
-    if not CONFIG_FILE.get('backup', {}).get('enabled', False):
+    if not CONFIG.get('backup', {}).get('enabled', False):
         return
 
-    backup_config = CONFIG_FILE['backup']
+    backup_config = CONFIG['backup']
     db_path = 'scam_base.db'
     backup_dir = backup_config['path']
     keep_last_n = backup_config['keep_last_n']
@@ -1233,7 +1637,7 @@ def backup_database():
     backup_filepath = os.path.join(backup_dir, backup_filename)
 
     try:
-        shutil.copy2(db_path, backup_filepath)
+        storage.backup(backup_filepath)
         logger.info(f"Резервная копия базы данных создана: {backup_filepath}")
 
         # Удаление старых бэкапов
@@ -1254,10 +1658,10 @@ def backup_database():
 
 # === ФУНКЦИИ ДЛЯ СИНХРОНИЗАЦИИ С GITHUB ===
 def sync_with_github():
-    if not CONFIG_FILE.get('github_sync', {}).get('enabled', False):
+    if not CONFIG.get('github_sync', {}).get('enabled', False):
         return
 
-    github_config = CONFIG_FILE['github_sync']
+    github_config = CONFIG['github_sync']
     repo_url = github_config['repo_url']
     branch = github_config['branch']
 
@@ -1289,86 +1693,327 @@ def sync_with_github():
         logger.error(f"Неожиданная ошибка при синхронизации с GitHub: {e}")
 
 # === НАСТРОЙКА ПЛАНИРОВЩИКА ЗАДАЧ (APSCHEDULER) ===
+# Планировщик запускается в каждом процессе бота, но задачи выполняет только
+# держатель аренды "scheduler" в общей базе (см. leader.py): при нескольких
+# воркерах бэкап и синхронизация не запускаются в каждом из них.
+scheduler_leadership = leader.Leadership('scheduler')
+def leader_only(job):
+    @functools.wraps(job)
+    def run():
+        if scheduler_leadership.is_leader():
+            job()
+        else:
+            logger.debug(f"Задача {job.__name__} пропущена: планировщик этого процесса не лидер.")
+    return run
 def setup_scheduler():
     """Настраивает планировщик задач для бэкапа и синхронизации."""
     scheduler = BackgroundScheduler()
     
     # Задача бэкапа
-    backup_config = CONFIG_FILE.get('backup', {})
+    backup_config = CONFIG.get('backup', {})
     if backup_config.get('enabled', False):
         interval_hours = backup_config.get('interval_hours', 24)
-        scheduler.add_job(backup_database, 'interval', hours=interval_hours, id='backup_job')
+        scheduler.add_job(leader_only(backup_database), 'interval', hours=interval_hours, id='backup_job')
         logger.info(f"Планировщик бэкапа настроен: каждые {interval_hours} часов.")
 
     # Задача синхронизации с GitHub
-    github_config = CONFIG_FILE.get('github_sync', {})
+    github_config = CONFIG.get('github_sync', {})
     if github_config.get('enabled', False):
         interval_minutes = github_config.get('interval_minutes', 30)
-        scheduler.add_job(sync_with_github, 'interval', minutes=interval_minutes, id='github_sync_job')
+        scheduler.add_job(leader_only(sync_with_github), 'interval', minutes=interval_minutes, id='github_sync_job')
         logger.info(f"Планировщик синхронизации с GitHub настроен: каждые {interval_minutes} минут.")
 
     if scheduler.get_jobs():
+        # Лидер продлевает аренду, остальные процессы пробуют её перехватить, если лидер пропал
+        scheduler.add_job(scheduler_leadership.renew, 'interval', seconds=leader.RENEW_INTERVAL, id='leader_lease_job')
         scheduler.start()
+        scheduler_leadership.renew()
         logger.info("Планировщик задач запущен.")
-    else:
-        logger.info("Планировщик задач не настроен (все задачи отключены).")
+        return scheduler
+    logger.info("Планировщик задач не настроен (все задачи отключены).")
+    return None
+def stop_scheduler(scheduler):
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+    scheduler_leadership.release()
 # === старт ===
-def main():
-    init_db()
-    updater = Updater(BOT_TOKEN, use_context=True)
-    dp = updater.dispatcher
-
+async def on_startup(application: Application):
+    start_username_index()
+    await asyncio.to_thread(status_media.preload, [template.photo for template in rendering.STATUS_TEMPLATES.values()])
+    if UB_IPC_CONFIG.get('mode') == 'embedded':
+        await start_embedded_userbot()
+async def on_shutdown(application: Application):
+    stop_username_index()
+    if _ub_rpc_client is not None:
+        _ub_rpc_client.close()
+    await stop_embedded_userbot()
+def build_application(update_queue=None, with_updater=True) -> Application:
+    """Создаёт приложение бота со всеми обработчиками (один процесс или воркер)."""
+    # Обновления обрабатываются конкурентно; лимит — сумма воркеров пулов, очереди
+    # ждущих обработчиков ограничивает каждый пул сам.
+    # Диалоги и user_data хранятся в общей базе (persistence.py)
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(fast_pool.workers + resolver_pool.workers)
+        .persistence(persistence.SQLitePersistence())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if update_queue is not None:
+        builder = builder.update_queue(update_queue)
+    if not with_updater:
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Обработчики выполняются в пулах: быстрые ответы из базы не ждут, пока
+    # обработчики, обращающиеся к юзерботу, дождутся его ответа.
+    # Шаги диалогов, которые сохраняют запись через юзербота (_save_to_db), — в пуле resolver.
     # Диалоги
-    dp.add_handler(ConversationHandler(
-        entry_points=[CommandHandler('addscam', add_scammer_start)],
+    application.add_handler(ConversationHandler(
+        entry_points=[CommandHandler('addscam', on_fast_pool(add_scammer_start))],
         states={
-            WAITING_FOR_TARGET: [MessageHandler(Filters.text & ~Filters.command, receive_scammer_target)],
+            WAITING_FOR_TARGET: [MessageHandler(filters.TEXT & ~filters.COMMAND, on_fast_pool(receive_scammer_target))],
             WAITING_FOR_NOTE: [
-                MessageHandler(Filters.text & ~Filters.command, receive_scammer_note),
-                CommandHandler('skip', skip_scammer_note)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, on_fast_pool(receive_scammer_note)),
+                CommandHandler('skip', on_fast_pool(skip_scammer_note))
             ],
             WAITING_FOR_PROOF: [
-                MessageHandler(Filters.text & ~Filters.command, receive_scammer_proof),
-                CommandHandler('skip', skip_scammer_proof)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, on_resolver_pool(receive_scammer_proof)),
+                CommandHandler('skip', on_resolver_pool(skip_scammer_proof))
             ]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', on_fast_pool(cancel))],
+        name='addscam',
+        persistent=True
     ))
-    dp.add_handler(ConversationHandler(
-        entry_points=[CommandHandler('addtrusted', add_trusted_start)],
+    application.add_handler(ConversationHandler(
+        entry_points=[CommandHandler('addtrusted', on_fast_pool(add_trusted_start))],
         states={
-            WAITING_FOR_TRUSTED_TARGET: [MessageHandler(Filters.text & ~Filters.command, receive_trusted_target)],
+            WAITING_FOR_TRUSTED_TARGET: [MessageHandler(filters.TEXT & ~filters.COMMAND, on_fast_pool(receive_trusted_target))],
             WAITING_FOR_TRUSTED_NOTE: [
-                MessageHandler(Filters.text & ~Filters.command, receive_trusted_note),
-                CommandHandler('skip', skip_trusted_note)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, on_resolver_pool(receive_trusted_note)),
+                CommandHandler('skip', on_resolver_pool(skip_trusted_note))
             ]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', on_fast_pool(cancel))],
+        name='addtrusted',
+        persistent=True
     ))
-    dp.add_handler(ConversationHandler(
-        entry_points=[CommandHandler('remove', remove_start)],
+    application.add_handler(ConversationHandler(
+        entry_points=[CommandHandler('remove', on_fast_pool(remove_start))],
         states={
-            WAITING_FOR_REMOVE_TARGET: [MessageHandler(Filters.text & ~Filters.command, receive_remove_target)]
+            WAITING_FOR_REMOVE_TARGET: [MessageHandler(filters.TEXT & ~filters.COMMAND, on_fast_pool(receive_remove_target))]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', on_fast_pool(cancel))],
+        name='remove',
+        persistent=True
     ))
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("help", help_command))
-    dp.add_handler(CommandHandler("listscam", list_scam)) # <<< Теперь доступна всем
-    dp.add_handler(CommandHandler("listtrusted", list_trusted))
-    dp.add_handler(CommandHandler("check", handle_check_command))
+    application.add_handler(CommandHandler("start", on_fast_pool(start)))
+    application.add_handler(CommandHandler("help", on_fast_pool(help_command)))
+    application.add_handler(CommandHandler("listscam", on_fast_pool(list_scam))) # <<< Теперь доступна всем
+    application.add_handler(CommandHandler("listtrusted", on_fast_pool(list_trusted)))
+    application.add_handler(CommandHandler("check", on_resolver_pool(handle_check_command)))
+    application.add_handler(CommandHandler("stats", on_fast_pool(stats_command)))
     # Обработка @username только в личке
-    dp.add_handler(MessageHandler(Filters.text & Filters.chat_type.private & ~Filters.command, handle_check_in_pm))
+    application.add_handler(MessageHandler(filters.TEXT & filters.ChatType.PRIVATE & ~filters.COMMAND, on_resolver_pool(handle_check_in_pm)))
     # Автообновление ID на каждое сообщение
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, auto_update_user_id_on_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_fast_pool(auto_update_user_id_on_message)))
     # Inline обработчик
-    dp.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(InlineQueryHandler(on_resolver_pool(inline_query)))
     # Обработчик сообщений в канале для автоматического добавления
-    dp.add_handler(MessageHandler(Filters.photo & (Filters.caption | Filters.text), monitor_channel_messages)) # <<< Новый обработчик
-    dp.add_error_handler(error_handler)
-
-    updater.start_polling()
-    updater.idle()
+    application.add_handler(MessageHandler(filters.PHOTO & (filters.CAPTION | filters.TEXT), on_resolver_pool(monitor_channel_messages))) # <<< Новый обработчик
+    application.add_error_handler(error_handler)
+    return application
+def stop_signal_event() -> asyncio.Event:
+    """Событие, которое выставляют SIGINT/SIGTERM (на Windows остановка — по KeyboardInterrupt)."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    return stop_event
+async def wait_for_stop(stop_event: asyncio.Event, tick=None):
+    """Ждёт остановки, вызывая tick() раз в WORKER_CHECK_INTERVAL секунд."""
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), WORKER_CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            if tick is not None:
+                tick()
+# === ВЕБХУК ===
+async def serve_webhook(bot, accept, stop_event: asyncio.Event, tick=None):
+    """
+    Принимает обновления встроенным HTTP-сервером (webhook.py) вместо getUpdates
+    и передаёт их в accept(data) до остановки. accept возвращает False, когда
+    очередь заполнена: сервер отвечает Telegram 503 и тот повторяет доставку позже.
+    """
+    path = webhook.url_path(WEBHOOK_CONFIG)
+    secret_token = WEBHOOK_CONFIG.get('secret_token') or None
+    server = webhook.WebhookServer(accept, path, secret_token)
+    await server.start(WEBHOOK_CONFIG.get('listen', webhook.DEFAULT_LISTEN),
+                       int(WEBHOOK_CONFIG.get('port', webhook.DEFAULT_PORT)),
+                       webhook.ssl_context(WEBHOOK_CONFIG))
+    try:
+        url = WEBHOOK_CONFIG['url'].rstrip('/') + path
+        cert = WEBHOOK_CONFIG.get('cert') if WEBHOOK_CONFIG.get('self_signed') else None
+        if cert:
+            with open(cert, 'rb') as f:
+                await bot.set_webhook(url, certificate=f, secret_token=secret_token,
+                                      max_connections=WEBHOOK_CONFIG.get('max_connections', 40))
+        else:
+            await bot.set_webhook(url, secret_token=secret_token,
+                                  max_connections=WEBHOOK_CONFIG.get('max_connections', 40))
+        logger.info(f"[Webhook] Вебхук установлен: {WEBHOOK_CONFIG['url'].rstrip('/')}/…")
+        await wait_for_stop(stop_event, tick)
+    finally:
+        await server.stop()
+        logger.info(f"[Webhook] {server.stats}")
+async def run_webhook(application: Application):
+    """Один процесс: обновления с вебхука идут прямо в ограниченную очередь приложения."""
+    def accept(data):
+        try:
+            application.update_queue.put_nowait(Update.de_json(data, application.bot))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    stop_event = stop_signal_event()
+    async with application:
+        await on_startup(application)
+        await application.start()
+        try:
+            await serve_webhook(application.bot, accept, stop_event)
+        finally:
+            await application.stop()
+            await on_shutdown(application)
+# === НЕСКОЛЬКО ВОРКЕРОВ ===
+# Процесс-распределитель получает обновления (long polling или вебхук) и раскладывает
+# их по воркерам (workers.py); каждый воркер — отдельный процесс с полным ботом.
+# Встроенный юзербот с несколькими воркерами не работает: сессия Telethon одна.
+WORKER_CHECK_INTERVAL = 5  # секунд между проверками, живы ли воркеры
+WORKER_UPDATE_QUEUE = 100  # обновлений в очереди приложения внутри воркера
+POLL_TIMEOUT = 30  # секунд long polling в распределителе
+async def serve_worker(application: Application, updates):
+    """Воркер: перекладывает обновления из очереди распределителя в приложение до None."""
+    loop = asyncio.get_running_loop()
+    async with application:
+        await on_startup(application)
+        await application.start()
+        try:
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                if data is None:
+                    break
+                # Очередь приложения ограничена: пока воркер занят, обновления ждут в очереди распределителя
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            await application.stop()
+            await on_shutdown(application)
+def run_worker(index, updates):
+    """Точка входа процесса-воркера. Останавливается по None в очереди, сигналы получает распределитель."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logger.info(f"[Worker {index}] Запуск (pid {os.getpid()}).")
+    storage.write_queue.start()
+    scheduler = setup_scheduler()
+    application = build_application(update_queue=asyncio.Queue(maxsize=WORKER_UPDATE_QUEUE), with_updater=False)
+    try:
+        asyncio.run(serve_worker(application, updates))
+    finally:
+        stop_scheduler(scheduler)
+        log_shutdown_stats()
+        storage.write_queue.stop()
+        storage.close_all()
+        logger.info(f"[Worker {index}] Остановлен.")
+async def poll_to_workers(pool: workers.WorkerPool):
+    """Long polling в распределителе: следующий getUpdates — только когда обновления разложены по очередям."""
+    loop = asyncio.get_running_loop()
+    stop_event = stop_signal_event()
+    stopping = asyncio.create_task(stop_event.wait())
+    async with Bot(BOT_TOKEN) as bot:
+        await bot.delete_webhook()
+        offset = None
+        while not stop_event.is_set():
+            polling = asyncio.create_task(bot.get_updates(offset=offset, timeout=POLL_TIMEOUT))
+            await asyncio.wait({polling, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            if not polling.done():
+                polling.cancel()
+                break
+            try:
+                updates = polling.result()
+            except TelegramError as e:
+                logger.warning(f"[Workers] Ошибка getUpdates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                # Ждём места в очереди воркера: воркер не успевает — новых обновлений не забираем
+                await loop.run_in_executor(None, pool.put, update.to_dict())
+                offset = update.update_id + 1
+            pool.check()
+        if offset is not None:
+            # Подтверждаем Telegram уже разложенные обновления, чтобы после перезапуска они не пришли снова
+            await bot.get_updates(offset=offset, timeout=0)
+async def webhook_to_workers(pool: workers.WorkerPool):
+    stop_event = stop_signal_event()
+    async with Bot(BOT_TOKEN) as bot:
+        await serve_webhook(bot, pool.route, stop_event, tick=pool.check)
+def run_supervisor(count):
+    if UB_IPC_CONFIG.get('mode') == 'embedded':
+        raise ValueError("Режим userbot.ipc.mode = \"embedded\" несовместим с несколькими воркерами: "
+                         "запустите userbot.py отдельно и выберите \"socket\" или \"file\".")
+    route_by = WORKERS_CONFIG.get('route_by', workers.ROUTE_BY_USER)
+    if route_by != workers.ROUTE_BY_USER:
+        logger.warning("[Workers] Распределение не по пользователю: шаги одного диалога могут попасть в разные "
+                       "воркеры, а состояние диалога воркеры видят только после перезапуска.")
+    pool = workers.WorkerPool(run_worker, count, WORKERS_CONFIG.get('queue', workers.DEFAULT_QUEUE_SIZE), route_by)
+    pool.start()
+    logger.info(f"[Workers] Запущено воркеров: {count}, распределение по {route_by}.")
+    try:
+        if WEBHOOK_CONFIG.get('enabled'):
+            asyncio.run(webhook_to_workers(pool))
+        else:
+            asyncio.run(poll_to_workers(pool))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+def log_shutdown_stats():
+    for pool in (fast_pool, resolver_pool):
+        logger.info(f"[Pool] Пул '{pool.name}': {pool.metrics()}")
+    logger.info(f"[Main->UB] Запросов к юзерботу: {UB_COALESCE_STATS['upstream']}, "
+                f"совмещено с уже идущими: {UB_COALESCE_STATS['coalesced']}.")
+    logger.info(f"[Main->UB] Кэш ошибок: попаданий {NEGATIVE_CACHE_STATS['hits']}, "
+                f"промахов {NEGATIVE_CACHE_STATS['misses']}.")
+    logger.info(f"[Breaker] {userbot_breaker.stats}")
+    logger.info(f"[Inline] Сессии: {INLINE_SESSION_STATS}")
+    logger.info(f"Сброс очереди фоновой записи ({storage.write_queue.depth()} записей, "
+                f"переполнений {storage.write_queue.overflowed}, отброшено {storage.write_queue.dropped})...")
+def main():
+    init_db()
+    worker_count = int(WORKERS_CONFIG.get('count', 1))
+    if worker_count > 1:
+        run_supervisor(worker_count)
+        storage.close_all()
+        return
+    storage.write_queue.start()
+    scheduler = setup_scheduler()
+    if WEBHOOK_CONFIG.get('enabled'):
+        application = build_application(
+            update_queue=asyncio.Queue(maxsize=WEBHOOK_CONFIG.get('max_pending', WEBHOOK_MAX_PENDING)))
+        try:
+            asyncio.run(run_webhook(application))
+        except KeyboardInterrupt:
+            pass
+    else:
+        build_application().run_polling()
+    stop_scheduler(scheduler)
+    log_shutdown_stats()
+    storage.write_queue.stop()
+    storage.close_all()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+from telegram.error import BadRequest
+
+import storage
+
+# === РЕЕСТР КАРТИНОК СТАТУСА ===
+# guarantee.jpg, scammer.jpg и unknown.jpg загружаются в Telegram один раз, а
+# полученный file_id сохраняется в таблице media_cache общей базы вместе с
+# SHA-256 содержимого. Следующие ответы отправляют фото по file_id, без
+# повторной загрузки файла. Если файл на диске изменился (другой хэш) или
+# Telegram отверг сохранённый file_id, картинка загружается заново.
+
+logger = logging.getLogger(__name__)
+
+
+def init_table(conn=None):
+    conn = conn or storage.get_connection()
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS media_cache (
+                name TEXT PRIMARY KEY,  -- путь к файлу картинки
+                sha256 TEXT NOT NULL,  -- хэш содержимого, для которого получен file_id
+                file_id TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+
+
+def _load_file_id(name, sha256):
+    row = storage.get_connection().execute(
+        'SELECT file_id FROM media_cache WHERE name = ? AND sha256 = ?', (name, sha256)).fetchone()
+    return row[0] if row else None
+
+
+def _save_file_id(name, sha256, file_id):
+    conn = storage.get_connection()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO media_cache (name, sha256, file_id, updated_at) VALUES (?, ?, ?, ?)',
+                     (name, sha256, file_id, time.time()))
+
+
+def _forget_file_id(name, file_id):
+    conn = storage.get_connection()
+    with conn:
+        conn.execute('DELETE FROM media_cache WHERE name = ? AND file_id = ?', (name, file_id))
+
+
+# Ответы Telegram на file_id, который больше не действует (удалён, просрочен, от другого бота).
+# Прочие ошибки с file_id (не тот тип файла, неверные параметры) сохранённый file_id не сбрасывают
+STALE_FILE_ID_ERRORS = (
+    'wrong file identifier',
+    'wrong remote file identifier',
+    'file reference expired',
+    'file_reference_expired',
+)
+
+
+def is_stale_file_id_error(error):
+    """Telegram не принимает сам file_id, а не, например, подпись или тип файла."""
+    message = str(error).lower()
+    return any(text in message for text in STALE_FILE_ID_ERRORS)
+
+
+class MediaRegistry:
+    """file_id картинок статуса: в памяти, в базе и загрузка при отсутствии."""
+
+    def __init__(self):
+        self._file_ids = {}  # name -> (sha256, file_id)
+        self._hashes = {}  # name -> ((mtime_ns, size), sha256)
+        self._locks = {}  # name -> asyncio.Lock: одна загрузка на картинку
+        self.stats = {'by_file_id': 0, 'uploads': 0, 'stale': 0}
+
+    def _sha256(self, name):
+        """
+        Хэш файла; файл перечитывается, только если изменились mtime или размер.
+        Читает диск — вызывается только вне event loop (sha256, preload).
+        """
+        stat = os.stat(name)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._hashes.get(name)
+        if cached and cached[0] == signature:
+            return cached[1]
+        with open(name, 'rb') as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        self._hashes[name] = (signature, sha256)
+        return sha256
+
+    async def sha256(self, name):
+        return await asyncio.to_thread(self._sha256, name)
+
+    def preload(self, names):
+        """Считает хэши картинок заранее (при старте бота, в потоке)."""
+        for name in names:
+            try:
+                self._sha256(name)
+            except OSError as e:
+                logger.warning(f"[Media] Не удалось прочитать {name}: {e}")
+
+    async def _file_id(self, name, sha256):
+        cached = self._file_ids.get(name)
+        if cached and cached[0] == sha256:
+            return cached[1]
+        file_id = await storage.run(_load_file_id, name, sha256)
+        if file_id:
+            self._file_ids[name] = (sha256, file_id)
+        return file_id
+
+    async def reply_photo(self, message, name, **kwargs):
+        """Отвечает на message картинкой name (по file_id, если он уже есть), kwargs — как у reply_photo."""
+        sha256 = await self.sha256(name)
+        file_id = await self._file_id(name, sha256)
+        if file_id:
+            try:
+                sent = await message.reply_photo(photo=file_id, **kwargs)
+                self.stats['by_file_id'] += 1
+                return sent
+            except BadRequest as e:
+                if not is_stale_file_id_error(e):
+                    raise
+                self.stats['stale'] += 1
+                logger.warning(f"[Media] Telegram отверг file_id для {name} ({e}), загружаем заново.")
+                self._file_ids.pop(name, None)
+                await storage.run(_forget_file_id, name, file_id)
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            # Пока ждали, картинку могла загрузить другая проверка
+            file_id = await self._file_id(name, sha256)
+            if file_id:
+                sent = await message.reply_photo(photo=file_id, **kwargs)
+                self.stats['by_file_id'] += 1
+                return sent
+            with open(name, 'rb') as photo:
+                sent = await message.reply_photo(photo=photo, **kwargs)
+            self.stats['uploads'] += 1
+            file_id = sent.photo[-1].file_id
+            self._file_ids[name] = (sha256, file_id)
+            await storage.run(_save_file_id, name, sha256, file_id)
+            logger.info(f"[Media] {name} загружен в Telegram, file_id сохранён.")
+            return sent
@@ -0,0 +1,133 @@
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import storage
+
+# === СОСТОЯНИЕ ДИАЛОГОВ В ОБЩЕЙ БАЗЕ ===
+# Шаги /addscam, /addtrusted и /remove (состояния ConversationHandler) и
+# context.user_data (цель, примечание, ссылка на пруфы) хранятся в SQLite, а не
+# только в памяти процесса. Диалог переживает перезапуск бота и перезапуск
+# воркера: новый процесс загружает состояния при старте, а user_data пользователя,
+# которого этот воркер ещё не видел, подхватывает из базы перед обновлением
+# (refresh_user_data). Уже загруженный user_data не перезаписывается: в памяти он
+# свежее базы, которая догоняет его раз в UPDATE_INTERVAL.
+# chat_data, bot_data и callback_data бот не использует и не сохраняет.
+UPDATE_INTERVAL = 2  # секунд между сбросами изменённых состояний в базу
+
+logger = logging.getLogger(__name__)
+
+
+def init_table(conn=None):
+    conn = conn or storage.get_connection()
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                name TEXT NOT NULL,  -- имя ConversationHandler
+                key TEXT NOT NULL,  -- JSON-список (chat_id, user_id)
+                state TEXT NOT NULL,  -- JSON-состояние диалога
+                PRIMARY KEY (name, key)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_state (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL  -- JSON context.user_data
+            )
+        ''')
+
+
+def _load_conversations(name):
+    rows = storage.get_connection().execute(
+        'SELECT key, state FROM conversation_state WHERE name = ?', (name,)).fetchall()
+    return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+
+def _save_conversation(name, key, state):
+    conn = storage.get_connection()
+    with conn:
+        if state is None:
+            conn.execute('DELETE FROM conversation_state WHERE name = ? AND key = ?', (name, json.dumps(list(key))))
+        else:
+            conn.execute('INSERT OR REPLACE INTO conversation_state (name, key, state) VALUES (?, ?, ?)',
+                         (name, json.dumps(list(key)), json.dumps(state)))
+
+
+def _load_user_data(user_id=None):
+    conn = storage.get_connection()
+    if user_id is not None:
+        row = conn.execute('SELECT data FROM user_state WHERE user_id = ?', (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    return {uid: json.loads(data) for uid, data in conn.execute('SELECT user_id, data FROM user_state')}
+
+
+def _save_user_data(user_id, data):
+    conn = storage.get_connection()
+    with conn:
+        if data:
+            conn.execute('INSERT OR REPLACE INTO user_state (user_id, data) VALUES (?, ?)',
+                         (user_id, json.dumps(data, ensure_ascii=False)))
+        else:
+            conn.execute('DELETE FROM user_state WHERE user_id = ?', (user_id,))
+
+
+class SQLitePersistence(BasePersistence):
+    """Persistence для Application: диалоги и user_data в общей базе через storage."""
+
+    def __init__(self, update_interval=UPDATE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+
+    async def get_conversations(self, name):
+        return await storage.run(_load_conversations, name)
+
+    async def update_conversation(self, name, key, new_state):
+        await storage.run(_save_conversation, name, key, new_state)
+
+    async def get_user_data(self):
+        return await storage.run(_load_user_data)
+
+    async def update_user_data(self, user_id, data):
+        await storage.run(_save_user_data, user_id, dict(data))
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_data:
+            return
+        stored = await storage.run(_load_user_data, user_id)
+        if stored:
+            user_data.update(stored)
+
+    async def drop_user_data(self, user_id):
+        await storage.run(_save_user_data, user_id, None)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        pass
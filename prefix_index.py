@@ -0,0 +1,219 @@
+import heapq
+import threading
+from bisect import bisect_left
+
+# === ПРЕФИКСНЫЙ ИНДЕКС ЮЗЕРНЕЙМОВ ДЛЯ INLINE-АВТОДОПОЛНЕНИЯ ===
+# Все известные юзернеймы (scammers, trusted, user_profiles.username и
+# all_usernames) лежат в памяти в трёх отсортированных массивах — по статусу.
+# Кандидаты на префикс — диапазон, найденный bisect в каждом массиве; ранжирование
+# «сначала скамеры, затем гаранты, затем остальные, внутри — по алфавиту» получается
+# склейкой диапазонов, поэтому страница из 50 результатов с любого смещения
+# собирается за O(log n + 50), сколько бы юзернеймов ни совпало с префиксом.
+# Новые и изменённые записи (upsert, demote) копятся в очереди и применяются пачкой
+# вне event loop (apply_pending): к копиям массивов, которые затем подменяют старые,
+# так что поиск всегда видит целый индекс. Целиком индекс перестраивается редко,
+# тоже вне event loop.
+SCAMMER = 'scammer'
+TRUSTED = 'trusted'
+UNKNOWN = 'unknown'
+STATUS_ORDER = (SCAMMER, TRUSTED, UNKNOWN)
+PAGE_SIZE = 50  # больше Telegram в одном inline-ответе не принимает
+
+# Юзернеймы Telegram состоят из латиницы, цифр и "_", всё это меньше '\x7f'
+_PREFIX_END = '\x7f'
+# Ключей в одной сортировке при перестроении: sort() большого списка держит GIL
+# целиком, пока не закончит, и останавливает event loop; куски сливаются heapq.merge
+BUILD_SORT_CHUNK = 50000
+
+
+def normalize(username):
+    return username.strip().lstrip('@').lower() if username else ''
+
+
+class PrefixIndex:
+    """Отсортированные массивы юзернеймов по статусу; меняются только подменой целиком."""
+
+    def __init__(self):
+        self._lists = {status: ([], []) for status in STATUS_ORDER}  # статус -> (ключи, записи)
+        self.size = 0
+        self._pending = []  # изменения, ещё не применённые (см. apply_pending)
+        self._journal = None  # изменения, применённые во время перестроения (см. begin_rebuild)
+        self._write_lock = threading.Lock()  # apply_pending и swap по очереди
+
+    @staticmethod
+    def build(rows):
+        """
+        Строит массивы из строк (username, user_id, status). Один и тот же юзернейм
+        одного пользователя попадает в индекс один раз, с самым важным статусом.
+        Возвращает значение для swap(); вызывается вне event loop (в пуле потоков БД).
+        """
+        best = {}
+        for username, user_id, status in rows:
+            key = normalize(username)
+            if not key:
+                continue
+            current = best.get((key, user_id))
+            if current is None or STATUS_ORDER.index(status) < STATUS_ORDER.index(current[2]):
+                best[(key, user_id)] = (username.lstrip('@'), user_id, status)
+        lists = {status: ([], []) for status in STATUS_ORDER}
+        items = [(key, user_id or 0, entry) for (key, user_id), entry in best.items()]
+        chunks = [sorted(items[i:i + BUILD_SORT_CHUNK]) for i in range(0, len(items), BUILD_SORT_CHUNK)]
+        for key, _, entry in heapq.merge(*chunks):
+            keys, entries = lists[entry[2]]
+            keys.append(key)
+            entries.append(entry)
+        return lists, len(best)
+
+    def begin_rebuild(self):
+        """Начало перестроения: изменения, применённые до swap(), повторяются на новом индексе."""
+        with self._write_lock:
+            self._journal = []
+
+    def cancel_rebuild(self):
+        with self._write_lock:
+            self._journal = None
+
+    def swap(self, built):
+        """Подменяет индекс построенным в build(); вызывается вне event loop (повтор журнала)."""
+        lists, size = built
+        with self._write_lock:
+            journal, self._journal = self._journal, None
+            for change in journal or ():
+                size += self._apply(lists, change)
+            self._lists, self.size = lists, size
+
+    def upsert(self, username, user_id, status):
+        """
+        Добавляет юзернейм пользователя со статусом status. Запись того же
+        пользователя с менее важным статусом заменяется, с более важным — остаётся.
+        Изменение попадает в индекс со следующим apply_pending().
+        """
+        if normalize(username):
+            self._pending.append(('upsert', username, user_id, status))
+
+    def demote(self, status, user_id=None, username=None):
+        """
+        Пользователь убран из списка status (скамеры или гаранты): его записи
+        переходят в UNKNOWN. Изменение попадает в индекс со следующим apply_pending().
+        """
+        self._pending.append(('demote', status, user_id, username))
+
+    def has_pending(self):
+        return bool(self._pending)
+
+    def apply_pending(self):
+        """
+        Применяет накопленные upsert и demote к копиям массивов и подменяет ими индекс.
+        Вызывается вне event loop: вставка в массив из миллиона юзернеймов — O(n).
+        """
+        # Новый список до разбора старого: upsert из event loop попадут либо в эту пачку, либо в следующую
+        changes, self._pending = self._pending, []
+        if not changes:
+            return
+        with self._write_lock:
+            lists = {status: (list(keys), list(entries)) for status, (keys, entries) in self._lists.items()}
+            size = self.size
+            for change in changes:
+                size += self._apply(lists, change)
+            if self._journal is not None:
+                self._journal.extend(changes)
+            self._lists, self.size = lists, size
+
+    @classmethod
+    def _apply(cls, lists, change):
+        """Применяет одно изменение к массивам lists; возвращает изменение числа записей."""
+        if change[0] == 'upsert':
+            return cls._upsert(lists, *change[1:])
+        return cls._demote(lists, *change[1:])
+
+    @staticmethod
+    def _find(lists, status, key, user_id):
+        keys, entries = lists[status]
+        i = bisect_left(keys, key)
+        while i < len(keys) and keys[i] == key:
+            if entries[i][1] == user_id:
+                return i
+            i += 1
+        return None
+
+    @staticmethod
+    def _remove(lists, status, i):
+        keys, entries = lists[status]
+        del keys[i]
+        del entries[i]
+
+    @classmethod
+    def _upsert(cls, lists, username, user_id, status):
+        key = normalize(username)
+        delta = 0
+        rank = STATUS_ORDER.index(status)
+        for current in STATUS_ORDER:
+            i = cls._find(lists, current, key, user_id)
+            if i is None:
+                continue
+            if STATUS_ORDER.index(current) <= rank:
+                return delta
+            cls._remove(lists, current, i)
+            delta -= 1
+        keys, entries = lists[status]
+        i = bisect_left(keys, key)
+        keys.insert(i, key)
+        entries.insert(i, (username.strip().lstrip('@'), user_id, status))
+        return delta + 1
+
+    @classmethod
+    def _demote(cls, lists, status, user_id, username):
+        # Списки скамеров и гарантов небольшие, поиск по ним линейный
+        key = normalize(username)
+        keys, entries = lists[status]
+        matched = [i for i, entry in enumerate(entries)
+                   if (user_id is not None and entry[1] == user_id) or (key and keys[i] == key)]
+        delta = 0
+        for i in reversed(matched):
+            entry = entries[i]
+            cls._remove(lists, status, i)
+            delta += cls._upsert(lists, entry[0], entry[1], UNKNOWN) - 1
+        return delta
+
+    def _ranges(self, prefix):
+        lists = self._lists  # один снимок на весь поиск: apply_pending подменяет его целиком
+        for status in STATUS_ORDER:
+            keys, entries = lists[status]
+            lo = bisect_left(keys, prefix)
+            hi = bisect_left(keys, prefix + _PREFIX_END, lo)
+            yield entries, lo, hi
+
+    def search(self, prefix, offset=0, limit=PAGE_SIZE):
+        """
+        Кандидаты (username, user_id, status) для префикса начиная с позиции offset.
+        Возвращает (кандидаты, следующее смещение или None, если страниц больше нет).
+        """
+        prefix = normalize(prefix)
+        results = []
+        skip = offset
+        total = 0
+        for entries, lo, hi in self._ranges(prefix):
+            count = hi - lo
+            total += count
+            if skip >= count:
+                skip -= count
+                continue
+            if len(results) < limit:
+                take = min(count - skip, limit - len(results))
+                results.extend(entries[lo + skip:lo + skip + take])
+            skip = 0
+        next_offset = offset + len(results)
+        return results, (next_offset if results and next_offset < total else None)
+
+    def exact(self, username):
+        """Запись с точно таким юзернеймом (самая важная по статусу) или None."""
+        key = normalize(username)
+        if not key:
+            return None
+        lists = self._lists
+        for status in STATUS_ORDER:
+            keys, entries = lists[status]
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                return entries[i]
+        return None
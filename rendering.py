@@ -0,0 +1,150 @@
+import functools
+
+# === КАРТОЧКИ СТАТУСА ===
+# Карточка пользователя (гарант / скамер / не найден) одна для /check и лички,
+# для inline-режима и, в сокращённом виде, для публикации в канал. Текст статуса,
+# картинка, миниатюра и подписи для каждого статуса лежат в шаблоне STATUS_TEMPLATES;
+# неизменные куски (строки статуса, подвал, список юзернеймов) собираются один раз
+# и запоминаются, на каждую карточку остаётся только подстановка полей профиля.
+TRUSTED = 'trusted'
+SCAMMER = 'scammer'
+UNKNOWN = 'unknown'
+
+# Спецсимволы MarkdownV2 экранируются таблицей str.translate, без регулярного выражения
+_ESCAPE_TABLE = str.maketrans({char: '\\' + char for char in '_*[]()~`>#+-=|{}.!'})
+# Внутри (...) ссылки экранируются только ")" и "\"
+_LINK_ESCAPE_TABLE = str.maketrans({')': '\\)', '\\': '\\\\'})
+
+CHAT_FOOTER = ">Наш чат: @loneasBASE\n>Наш канал: @loneasproofs"
+NOTE_HEADER = "🔓Дополнительная информация🔑:"
+
+
+def escape_markdown_v2(text) -> str:
+    if not text:
+        return ""
+    return str(text).translate(_ESCAPE_TABLE)
+
+
+@functools.lru_cache(maxsize=1024)
+def footer(proof_url=None) -> str:
+    """Подвал карточки: ссылка на пруфы (если есть) и наши чат и канал."""
+    if not proof_url:
+        return CHAT_FOOTER
+    return f">Пруфы: [ссылка]({proof_url.translate(_LINK_ESCAPE_TABLE)})\n{CHAT_FOOTER}"
+
+
+@functools.lru_cache(maxsize=10000)
+def usernames_line(all_usernames, fallback=None) -> str:
+    """Все юзернеймы из user_profiles.all_usernames (через запятую) или один fallback."""
+    names = [name.strip() for name in all_usernames.split(',') if name.strip()] if all_usernames else []
+    if not names:
+        return f"@{escape_markdown_v2(fallback)}" if fallback else "неизвестен"
+    return ', '.join(f"@{escape_markdown_v2(name)}" for name in names)
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_status_line(status_line, escaped_username) -> str:
+    return status_line.format(username=escaped_username)
+
+
+def user_display(username, user_id) -> str:
+    if username and user_id:
+        return f"@{escape_markdown_v2(username)} \\| ID: `{user_id}`"
+    if username:
+        return f"@{escape_markdown_v2(username)} \\| ID: неизвестен"
+    if user_id:
+        return f"ID: `{user_id}`"
+    return "неизвестен"
+
+
+class StatusTemplate:
+    """Всё, что отличает карточку одного статуса от другой."""
+
+    def __init__(self, kind, icon, label, channel_label, photo, thumbnail_url, status_line, short_status_line,
+                 search_count_line=None):
+        self.kind = kind
+        self.icon = icon
+        self.label = label  # подпись в заголовке inline-результата
+        self.channel_label = channel_label  # статус в посте канала
+        self.photo = photo  # картинка ответа в личке (см. media.py)
+        self.thumbnail_url = thumbnail_url
+        # Может содержать {username} — экранированный юзернейм из карточки
+        self._status_line = status_line
+        self._status_is_static = '{username}' not in status_line
+        self.short_status_line = short_status_line  # для кандидатов автодополнения
+        # Строка «Искали в базе» с {search_count} или None, если карточка её не показывает
+        self.search_count_line = search_count_line
+
+    def status_line(self, escaped_username=''):
+        if self._status_is_static:
+            return self._status_line
+        return _format_status_line(self._status_line, escaped_username)
+
+    def render(self, username, user_id, first_name=None, last_name=None, all_usernames=None,
+               date_created=None, search_count=0, note=None, proof_url=None) -> str:
+        """Полный текст карточки (MarkdownV2)."""
+        escaped_username = escape_markdown_v2(username)
+        parts = [
+            f"👤 Пользователь: {user_display(username, user_id)}\n\n"
+            f"🔮 Имя: {escape_markdown_v2(first_name or 'неизвестно')} {escape_markdown_v2(last_name)}\n"
+            f"📓 Юзернеймы: {usernames_line(all_usernames, username)}\n"
+            f"🪬 Дата создания: {escape_markdown_v2(date_created or 'неизвестно')}\n"
+        ]
+        if self.search_count_line:
+            parts.append(self.search_count_line.format(search_count=search_count))
+        parts.append(f"\n{self.status_line(escaped_username)}")
+        if note:
+            parts.append(f"\n\n{NOTE_HEADER}\n\n{escape_markdown_v2(note)}")
+        parts.append(f"\n\n{footer(proof_url)}")
+        return ''.join(parts)
+
+    def render_short(self, username, user_id) -> str:
+        """Короткая карточка кандидата автодополнения."""
+        id_part = f"`{user_id}`" if user_id else "неизвестен"
+        return (
+            f"👤 Пользователь: @{escape_markdown_v2(username)} \\| ID: {id_part}\n\n"
+            f"{self.short_status_line}\n\n"
+            f"{CHAT_FOOTER}"
+        )
+
+    def render_channel_post(self, username, user_id, note, proof_url=None) -> str:
+        """Пост о добавлении пользователя в базу для канала скамеров или гарантов."""
+        extra = f"\n🔗 Пруфы: [ссылка]({proof_url.translate(_LINK_ESCAPE_TABLE)})" if proof_url else ""
+        return (
+            f"👤 Пользователь: @{escape_markdown_v2(username)} \\| ID: {user_id}\n"
+            f"💡Статус: {self.channel_label}\n"
+            f"📝 Примечание: {escape_markdown_v2(note)}{extra}"
+        )
+
+    def inline_title(self, username) -> str:
+        """Заголовок inline-результата — обычный текст, без экранирования."""
+        return f"{self.icon} @{username} ({self.label})" if username else f"{self.icon} ({self.label})"
+
+
+STATUS_TEMPLATES = {
+    TRUSTED: StatusTemplate(
+        TRUSTED, "✅", "Гарант", "ГАРАНТ ✅", 'guarantee.jpg', "https://winchanii.ru/media/sb/guarantee8.jpg",
+        "💡`Статус`: *__ГАРАНТ__* ✅\n\n🟢*Данный пользователь является гарантом\\! "
+        "Следующий вывод был основан на его репутации\\.*",
+        "💡`Статус`: *__ГАРАНТ__* ✅\n\n🟢*Данный пользователь является гарантом\\!*",
+        search_count_line=None,
+    ),
+    SCAMMER: StatusTemplate(
+        SCAMMER, "❌", "Скамер", "МОШЕННИК ❌", 'scammer.jpg', "https://winchanii.ru/media/sb/scammer8.jpg",
+        "⚠️ НАЙДЕН В СКАМ\\-БАЗЕ\\!⚠️\n\n💡`Статус`: *__МОШЕННИК__*❌\n\n🔴*Пользователь — скамер\\. "
+        "Найден в базе @LoneasBasebot\\. Ни в коем случае не контактируйте с данным человеком, "
+        "не ведитесь на его уловки\\.*",
+        "💡`Статус`: *__МОШЕННИК__*❌\n\n🔴*Пользователь — скамер\\. Найден в базе @LoneasBasebot\\. "
+        "Ни в коем случае не контактируйте с данным человеком, не ведитесь на его уловки\\.*",
+        search_count_line="🔍 Искали в базе {search_count} раз\\(а\\)\n",
+    ),
+    UNKNOWN: StatusTemplate(
+        UNKNOWN, "🔍", "Не найден", "НЕ НАЙДЕН 🔍", 'unknown.jpg', "https://winchanii.ru/media/sb/unknown8.jpg",
+        "💡`Статус`: *__НЕ НАЙДЕН__* 🔍\n\n⚫️Пользователь @{username} не был найден в нашей базе\\. "
+        "Данная личность не проверена\\.\n\n" + NOTE_HEADER + "\n\nРекомендуется быть осторожным "
+        "и использовать услуги проверенных гарантов \\- /listtrusted\\.",
+        "💡`Статус`: *__НЕ НАЙДЕН__* 🔍\n\n⚫️Пользователь не был найден в нашей базе\\. "
+        "Данная личность не проверена\\.",
+        search_count_line="🔍 Искали в базе: {search_count} раз\\(а\\)\n",
+    ),
+}
@@ -5,6 +5,7 @@ import json
 import subprocess
 import platform
 import shutil
+import secrets
 from datetime import datetime
 
 CONFIG_FILE = 'config.json'
@@ -32,7 +33,42 @@ DEFAULT_CONFIG = {
     "userbot": {
         "api_id": 24818772,
         "api_hash": "YOUR_API_HASH_HERE",
-        "phone": "+19432259632"
+        "phone": "+19432259632",
+        "ipc": {
+            "mode": "socket", # "socket" — RPC через сокет (с откатом на файлы), "file" — только файлы,
+                              # "embedded" — юзербот внутри процесса main.py (userbot.py отдельно не запускается)
+            "socket_path": "userbot.sock",
+            "tcp_port": 47615 # Используется вместо unix-сокета на Windows
+        }
+    },
+    "handlers": {
+        # Лимиты обработчиков: "fast" — ответы только из базы (/start, /help, списки),
+        # "resolver" — обработчики, ждущие юзербота (/check, inline, сохранение в базу).
+        # workers — одновременно выполняемых, queue — ожидающих своей очереди
+        "fast": {"workers": 32, "queue": 500},
+        "resolver": {"workers": 32, "queue": 100}  # столько, сколько юзербот успевает обслужить
+    },
+    "webhook": {
+        # Вебхук вместо long polling: Telegram шлёт обновления на url + secret_path,
+        # встроенный сервер слушает listen:port (обычно за nginx, который завершает TLS)
+        "enabled": False,
+        "url": "https://bot.example.com", # <<< Публичный адрес, который проксирует nginx
+        "listen": "127.0.0.1",
+        "port": 8443,
+        "secret_path": "",   # Генерируется при настройке
+        "secret_token": "",  # Заголовок X-Telegram-Bot-Api-Secret-Token, генерируется при настройке
+        "cert": "",          # Сертификат TLS, если бот принимает HTTPS сам (без nginx)
+        "key": "",
+        "self_signed": False, # Отправить cert в Telegram при установке вебхука
+        "max_connections": 40,
+        "max_pending": 1000  # Обновлений в очереди, дальше сервер отвечает 503 и Telegram повторяет позже
+    },
+    "workers": {
+        # Несколько процессов main.py на многоядерной машине. При count > 1 main.py
+        # принимает обновления и раскладывает их по воркерам; режим "embedded" юзербота не поддерживается
+        "count": 1,
+        "route_by": "user", # "user" — обновления одного пользователя в один воркер, "update_id" — равномерно
+        "queue": 1000       # Обновлений в очереди одного воркера
     }
 }
 
@@ -78,12 +114,13 @@ def get_admin_ids():
 
 def check_dependencies():
     """Проверяет, установлены ли необходимые библиотеки."""
-    required_packages = ['python-telegram-bot', 'telethon', 'apscheduler'] # <<< Добавлен apscheduler
+    required_packages = ['python-telegram-bot>=21.0', 'telethon', 'apscheduler'] # <<< Добавлен apscheduler
     missing_packages = []
     for package in required_packages:
         try:
-            if package == 'python-telegram-bot':
-                __import__('telegram')
+            if package.startswith('python-telegram-bot'):
+                # main.py работает на asyncio-версии библиотеки (Application), v13 не подходит
+                from telegram.ext import Application  # noqa: F401
             elif package == 'telethon':
                 __import__('telethon')
             elif package == 'apscheduler':
@@ -102,7 +139,7 @@ def check_dependencies():
                 print("Зависимости успешно установлены!")
             except subprocess.CalledProcessError as e:
                 print(f"Ошибка установки зависимостей: {e}")
-                print("Пожалуйста, установите их вручную: pip install python-telegram-bot telethon apscheduler")
+                print("Пожалуйста, установите их вручную: pip install 'python-telegram-bot>=21.0' telethon apscheduler")
         else:
             print("Установка зависимостей пропущена. Убедитесь, что они установлены перед запуском бота.")
     else:
@@ -129,9 +166,34 @@ def configure_github_sync(config):
         config['github_sync']['branch'] = get_input("Ветка для синхронизации", config['github_sync']['branch'])
         config['github_sync']['interval_minutes'] = int(get_input("Интервал синхронизации (минуты)", str(config['github_sync']['interval_minutes'])))
 
+def configure_webhook(config):
+    """Настраивает приём обновлений через вебхук."""
+    print("\n--- Настройка вебхука ---")
+    webhook_config = config.setdefault('webhook', dict(DEFAULT_CONFIG['webhook']))
+    webhook_config['enabled'] = input("Принимать обновления через вебхук вместо long polling? (y/N): ").lower().strip() in ['y', 'yes', 'д', 'да']
+    if webhook_config['enabled']:
+        webhook_config['url'] = get_input("Публичный HTTPS-адрес бота (без пути)", webhook_config.get('url', DEFAULT_CONFIG['webhook']['url']))
+        webhook_config['listen'] = get_input("Адрес, на котором слушает сервер", webhook_config.get('listen', DEFAULT_CONFIG['webhook']['listen']))
+        webhook_config['port'] = int(get_input("Порт", str(webhook_config.get('port', DEFAULT_CONFIG['webhook']['port']))))
+        webhook_config['cert'] = get_input("Путь к сертификату TLS (пусто, если TLS завершает nginx)", webhook_config.get('cert', ''))
+        if webhook_config['cert']:
+            webhook_config['key'] = get_input("Путь к закрытому ключу TLS", webhook_config.get('key', ''))
+            webhook_config['self_signed'] = input("Сертификат самоподписанный? (y/N): ").lower().strip() in ['y', 'yes', 'д', 'да']
+        # Секреты генерируются один раз и сохраняются при повторной настройке
+        if not webhook_config.get('secret_path'):
+            webhook_config['secret_path'] = secrets.token_urlsafe(24)
+        if not webhook_config.get('secret_token'):
+            webhook_config['secret_token'] = secrets.token_urlsafe(32)
+        print(f"Путь вебхука: /{webhook_config['secret_path']} (проксируйте его в nginx на {webhook_config['listen']}:{webhook_config['port']})")
+
 def create_service_files(config):
-    """Создает файлы для запуска как службы (systemd unit для Linux, .bat для Windows)."""
+    """
+    Создает файлы для запуска как службы (systemd unit для Linux, .bat для Windows).
+    Во встроенном режиме юзербот работает внутри основного бота: отдельная служба
+    запустила бы второй клиент на том же файле сессии, поэтому она не создаётся.
+    """
     system = platform.system().lower()
+    embedded = config['userbot'].get('ipc', {}).get('mode') == 'embedded'
     
     if system == "linux":
         service_content_main = f"""[Unit]
@@ -164,22 +226,24 @@ RestartSec=5
 [Install]
 WantedBy=multi-user.target
 """
+        services = {"scambase_main.service": service_content_main}
+        if not embedded:
+            services["scambase_userbot.service"] = service_content_userbot
         try:
-            with open("scambase_main.service", "w") as f:
-                f.write(service_content_main)
-            with open("scambase_userbot.service", "w") as f:
-                f.write(service_content_userbot)
+            for name, content in services.items():
+                with open(name, "w") as f:
+                    f.write(content)
             print("\nФайлы служб systemd созданы:")
-            print("- scambase_main.service")
-            print("- scambase_userbot.service")
+            for name in services:
+                print(f"- {name}")
             print("Чтобы установить и запустить как службы, выполните:")
-            print("sudo cp scambase_main.service /etc/systemd/system/")
-            print("sudo cp scambase_userbot.service /etc/systemd/system/")
+            for name in services:
+                print(f"sudo cp {name} /etc/systemd/system/")
             print("sudo systemctl daemon-reload")
-            print("sudo systemctl enable scambase_main.service")
-            print("sudo systemctl enable scambase_userbot.service")
-            print("sudo systemctl start scambase_main.service")
-            print("sudo systemctl start scambase_userbot.service")
+            for name in services:
+                print(f"sudo systemctl enable {name}")
+            for name in services:
+                print(f"sudo systemctl start {name}")
         except Exception as e:
             print(f"Ошибка создания файлов служб: {e}")
 
@@ -194,14 +258,16 @@ cd /d "{os.getcwd()}"
 "{sys.executable}" {USERBOT_PY_TEMPLATE}
 pause
 """
+        scripts = {"run_main.bat": bat_content_main}
+        if not embedded:
+            scripts["run_userbot.bat"] = bat_content_userbot
         try:
-            with open("run_main.bat", "w") as f:
-                f.write(bat_content_main)
-            with open("run_userbot.bat", "w") as f:
-                f.write(bat_content_userbot)
+            for name, content in scripts.items():
+                with open(name, "w") as f:
+                    f.write(content)
             print("\nBAT-файлы для запуска созданы:")
-            print("- run_main.bat")
-            print("- run_userbot.bat")
+            for name in scripts:
+                print(f"- {name}")
             print("Вы можете запустить их двойным кликом или использовать для планировщика заданий Windows.")
         except Exception as e:
             print(f"Ошибка создания BAT-файлов: {e}")
@@ -233,11 +299,23 @@ def main():
     # 4. Настройка синхронизации с GitHub
     configure_github_sync(config)
 
+    # 4.1. Настройка вебхука
+    configure_webhook(config)
+
     # 5. Настройка юзербота
     print("\n--- Настройка юзербота ---")
     config['userbot']['api_id'] = int(get_input("Введите ваш API ID (с my.telegram.org)", str(config['userbot']['api_id'])))
     config['userbot']['api_hash'] = get_input("Введите ваш API Hash (с my.telegram.org)", config['userbot']['api_hash'], is_secret=True)
     config['userbot']['phone'] = get_input("Введите номер телефона для юзербота (+1234567890)", config['userbot']['phone'])
+    ipc_config = config['userbot'].setdefault('ipc', dict(DEFAULT_CONFIG['userbot']['ipc']))
+    ipc_config['mode'] = get_input("Режим связи с юзерботом (socket/file/embedded)", ipc_config.get('mode', 'socket'))
+
+    # 5.1. Количество процессов бота
+    workers_config = config.setdefault('workers', dict(DEFAULT_CONFIG['workers']))
+    if ipc_config['mode'] == 'embedded':
+        workers_config['count'] = 1
+    else:
+        workers_config['count'] = int(get_input("Количество процессов-воркеров бота", str(workers_config.get('count', 1))))
 
     # 6. Сохранить конфигурацию
     save_config(config)
@@ -252,8 +330,11 @@ def main():
     print("Конфигурация сохранена.")
     print("Теперь вы можете запустить бота:")
     print(f"- Основной бот: {sys.executable} {MAIN_PY_TEMPLATE}")
-    print(f"- Юзербот:      {sys.executable} {USERBOT_PY_TEMPLATE}")
+    if config['userbot']['ipc']['mode'] == 'embedded':
+        print(f"- Юзербот встроен в основной бот. Один раз авторизуйте сессию: {sys.executable} {USERBOT_PY_TEMPLATE} --login")
+    else:
+        print(f"- Юзербот:      {sys.executable} {USERBOT_PY_TEMPLATE}")
     print("(Убедитесь, что зависимости установлены и config.json настроен правильно)")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,282 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# === ХРАНИЛИЩЕ: ОБЩИЙ СЛОЙ СОЕДИНЕНИЙ С SQLITE ===
+# Каждый поток (пул потоков БД, планировщик, юзербот) получает своё долгоживущее
+# соединение вместо connect/close на каждый запрос. База переводится в WAL,
+# поэтому читатели не блокируются записью из log_search.
+DB_PATH = 'scam_base.db'
+BUSY_TIMEOUT = 30  # секунд ожидания блокировки записи
+CACHE_SIZE_KIB = 20000  # ~20 МБ страничного кэша на соединение
+MMAP_SIZE = 256 * 1024 * 1024  # 256 МБ memory-mapped I/O
+# Фоновая запись (write-behind) для некритичных записей: search_log, users
+WRITE_QUEUE_SIZE = 10000  # максимум ожидающих записей, дальше — через пул потоков БД
+WRITE_OVERFLOW_MAX = 1000  # групп в пуле потоков БД сверх очереди, дальше записи отбрасываются
+WRITE_OVERFLOW_LOG_INTERVAL = 10  # секунд между предупреждениями о переполнении
+WRITE_BATCH_SIZE = 200  # записей в одной транзакции
+WRITE_FLUSH_INTERVAL = 0.05  # секунд ожидания добора пачки
+# Асинхронный доступ (main.py на asyncio): запросы выполняются в небольшом пуле
+# потоков, у каждого потока своё соединение, event loop не блокируется
+DB_THREADS = 4
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+# Счётчик SQL-запросов текущей проверки (см. count_statements); run() переносит контекст
+# в поток БД, поэтому запросы из пула считаются в счётчик вызвавшего обработчика
+_statement_counter = contextvars.ContextVar('statement_counter', default=None)
+_UNCOUNTED_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA')
+
+
+def count_statements():
+    """
+    Начинает подсчёт SQL-запросов в текущем контексте (обработчике) и возвращает
+    счётчик — список из одного числа. Фоновая запись (write_queue) не считается.
+    """
+    counter = [0]
+    _statement_counter.set(counter)
+    return counter
+
+
+def _trace_statement(statement):
+    counter = _statement_counter.get()
+    if counter is not None and not statement.lstrip().upper().startswith(_UNCOUNTED_STATEMENTS):
+        counter[0] += 1
+
+
+def _open_connection():
+    """Открывает соединение и применяет прагмы."""
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # В режиме WAL synchronous=NORMAL не теряет целостность, но убирает fsync на каждый коммит
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KIB}')
+    cursor.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+    conn.set_trace_callback(_trace_statement)
+    return conn
+
+
+def get_connection():
+    """
+    Возвращает соединение текущего потока, создавая его при первом обращении.
+    Для записи используйте `with conn:` — коммит или откат выполнятся автоматически.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+        logger.debug(f"[DB] Открыто соединение для потока {threading.current_thread().name}")
+    return conn
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='db')
+        return _executor
+
+
+async def run(func, *args, **kwargs):
+    """Выполняет синхронную функцию, работающую с базой, в пуле потоков БД и возвращает её результат."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_get_executor(), functools.partial(context.run, func, *args, **kwargs))
+
+
+def _fetch(sql, params, one):
+    cursor = get_connection().execute(sql, params)
+    return cursor.fetchone() if one else cursor.fetchall()
+
+
+async def fetch_one(sql, params=()):
+    return await run(_fetch, sql, params, True)
+
+
+async def fetch_all(sql, params=()):
+    return await run(_fetch, sql, params, False)
+
+
+def close_all():
+    """Останавливает пул потоков БД и закрывает все открытые соединения (при завершении бота)."""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"[DB] Ошибка закрытия соединения: {e}")
+    _local.__dict__.clear()
+
+
+def backup(dest_path):
+    """
+    Делает консистентную копию базы через backup API.
+    Простое копирование файла в режиме WAL теряет ещё не перенесённые в базу страницы.
+    """
+    dest = sqlite3.connect(dest_path)
+    try:
+        get_connection().backup(dest)
+    finally:
+        dest.close()
+
+
+class WriteBehindQueue:
+    """
+    Очередь отложенной записи: запросы копятся в ограниченной очереди и
+    выполняются фоновым потоком пачками в одной транзакции (каждые
+    WRITE_FLUSH_INTERVAL секунд или по WRITE_BATCH_SIZE записей).
+    Пока поток не запущен, запись выполняется сразу; при переполненной очереди
+    группа уходит в пул потоков БД, чтобы не блокировать вызывающий event loop,
+    а сверх WRITE_OVERFLOW_MAX таких групп — отбрасывается.
+    """
+
+    _STOP = object()
+
+    def __init__(self, max_size=WRITE_QUEUE_SIZE, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL):
+        self._queue = queue.Queue(maxsize=max_size)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._thread = None
+        self.overflowed = 0  # групп, не поместившихся в очередь
+        self.dropped = 0  # из них отброшено: пул потоков БД тоже не успевает
+        self._overflow_lock = threading.Lock()
+        self._overflow_pending = 0
+        self._overflow_logged_at = 0.0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='db-write-behind', daemon=True)
+        self._thread.start()
+        logger.info("[DB] Поток фоновой записи запущен.")
+
+    def stop(self):
+        """Дописывает всё, что осталось в очереди, и останавливает поток."""
+        if self._thread is None:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._thread = None
+        logger.info("[DB] Поток фоновой записи остановлен, очередь сброшена.")
+
+    def depth(self):
+        """Количество записей, ожидающих сброса в базу."""
+        return self._queue.qsize()
+
+    def submit(self, sql, params=()):
+        self.submit_group([(sql, params)])
+
+    def submit_group(self, statements):
+        """Ставит в очередь несколько запросов, которые попадут в одну транзакцию."""
+        if self._thread is not None:
+            try:
+                self._queue.put_nowait(statements)
+                return
+            except queue.Full:
+                self._overflow(statements)
+                return
+        self._write([statements])
+
+    def _overflow(self, statements):
+        with self._overflow_lock:
+            self.overflowed += 1
+            handoff = self._overflow_pending < WRITE_OVERFLOW_MAX
+            if handoff:
+                self._overflow_pending += 1
+            else:
+                self.dropped += 1
+            now = time.monotonic()
+            report = now - self._overflow_logged_at >= WRITE_OVERFLOW_LOG_INTERVAL
+            if report:
+                self._overflow_logged_at = now
+        if report:
+            logger.warning(f"[DB] Очередь фоновой записи переполнена: записи уходят в пул потоков БД "
+                           f"(переполнений {self.overflowed}, отброшено {self.dropped}).")
+        if handoff:
+            _get_executor().submit(self._write_overflow, statements)
+
+    def _write_overflow(self, statements):
+        try:
+            self._write([statements])
+        finally:
+            with self._overflow_lock:
+                self._overflow_pending -= 1
+
+    def _drain(self):
+        groups = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return groups
+            if item is not self._STOP:
+                groups.append(item)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                self._write(self._drain())
+                return
+            batch = [item]
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    # Дописываем пачку и всё, что submit успел положить после сигнала
+                    self._write(batch + self._drain())
+                    return
+                batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch):
+        if not batch:
+            return
+        conn = get_connection()
+        try:
+            with conn:
+                for statements in batch:
+                    for sql, params in statements:
+                        conn.execute(sql, params)
+        except sqlite3.Error as e:
+            # Пачка откатилась целиком — повторяем по группам, чтобы не потерять остальные записи
+            logger.error(f"[DB] Ошибка пакетной записи ({len(batch)} записей): {e}. Повтор по одной.")
+            for statements in batch:
+                try:
+                    with conn:
+                        for sql, params in statements:
+                            conn.execute(sql, params)
+                except sqlite3.Error as group_error:
+                    logger.error(f"[DB] Запись отброшена: {group_error}")
+
+
+write_queue = WriteBehindQueue()
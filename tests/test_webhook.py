@@ -0,0 +1,182 @@
+"""
+Тесты вебхука (webhook.py): записанные обновления Telegram (tools/sample_updates.json)
+отправляются POST-запросами на локальный WebhookServer — тот же сервер, что поднимает
+serve_webhook в main.py, с accept как в run_webhook (ограниченная очередь обновлений).
+
+Запуск из корня репозитория:
+    python -m pytest -q tests
+"""
+import asyncio
+import json
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import webhook  # noqa: E402
+
+PATH = '/test-secret-path'
+SECRET = 'test-secret-token'
+UPDATES_FILE = os.path.join(ROOT, 'tools', 'sample_updates.json')
+
+
+def load_updates():
+    with open(UPDATES_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class WebhookServerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def start_server(self, max_pending=100):
+        # accept как в run_webhook: обновление в очередь приложения или False, если она заполнена
+        self.queue = asyncio.Queue(maxsize=max_pending)
+
+        def accept(data):
+            try:
+                self.queue.put_nowait(data)
+            except asyncio.QueueFull:
+                return False
+            return True
+
+        self.server = webhook.WebhookServer(accept, PATH, SECRET)
+        self.port = await self.server.start('127.0.0.1', 0)
+        self.addAsyncCleanup(self.server.stop)
+
+    def dispatched(self):
+        updates = []
+        while not self.queue.empty():
+            updates.append(self.queue.get_nowait()['update_id'])
+        return updates
+
+    async def request(self, head, body=b''):
+        """Отправляет один запрос (строка запроса и заголовки без пустой строки) и возвращает (статус, заголовки)."""
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        try:
+            writer.write(head.encode('latin-1') + b'\r\n' + body)
+            await writer.drain()
+            return await self.read_response(reader)
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_response(reader):
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                return status, headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    async def post(self, update, path=PATH, secret=SECRET):
+        body = json.dumps(update, ensure_ascii=False).encode('utf-8')
+        head = f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\nConnection: close\r\n"
+        if secret is not None:
+            head += f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+        return await self.request(head, body)
+
+    async def test_recorded_updates_are_dispatched_in_order(self):
+        await self.start_server()
+        updates = load_updates()
+        for update in updates:
+            status, _ = await self.post(update)
+            self.assertEqual(status, 200)
+        self.assertEqual(self.dispatched(), [update['update_id'] for update in updates])
+        self.assertEqual(self.server.stats['accepted'], len(updates))
+
+    async def test_keep_alive_connection_serves_several_updates(self):
+        await self.start_server()
+        updates = load_updates()
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        try:
+            for update in updates:
+                body = json.dumps(update, ensure_ascii=False).encode('utf-8')
+                writer.write((f"POST {PATH} HTTP/1.1\r\nContent-Length: {len(body)}\r\n"
+                              f"X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n\r\n").encode('latin-1') + body)
+                await writer.drain()
+                status, headers = await self.read_response(reader)
+                self.assertEqual(status, 200)
+                self.assertEqual(headers['connection'], 'keep-alive')
+        finally:
+            writer.close()
+        self.assertEqual(self.dispatched(), [update['update_id'] for update in updates])
+
+    async def test_wrong_path_is_not_found(self):
+        await self.start_server()
+        status, _ = await self.post(load_updates()[0], path='/other-path')
+        self.assertEqual(status, 404)
+        self.assertEqual(self.dispatched(), [])
+
+    async def test_wrong_method_is_rejected(self):
+        await self.start_server()
+        status, headers = await self.request(f"GET {PATH} HTTP/1.1\r\nConnection: close\r\n")
+        self.assertEqual(status, 405)
+        self.assertEqual(headers['allow'], 'POST')
+
+    async def test_wrong_or_missing_secret_token_is_forbidden(self):
+        await self.start_server()
+        update = load_updates()[0]
+        for secret in ('wrong-token', None):
+            status, _ = await self.post(update, secret=secret)
+            self.assertEqual(status, 403)
+        self.assertEqual(self.dispatched(), [])
+        self.assertEqual(self.server.stats['forbidden'], 2)
+
+    async def test_invalid_json_is_bad_request(self):
+        await self.start_server()
+        for body in (b'{not json', b'[1, 2]', b'{"message": {}}'):
+            status, _ = await self.request(
+                f"POST {PATH} HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n"
+                f"X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n", body)
+            self.assertEqual(status, 400)
+        self.assertEqual(self.dispatched(), [])
+
+    async def test_too_large_body_is_rejected_before_reading(self):
+        await self.start_server()
+        status, headers = await self.request(
+            f"POST {PATH} HTTP/1.1\r\nContent-Length: {webhook.MAX_BODY_SIZE + 1}\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n")
+        self.assertEqual(status, 413)
+        self.assertEqual(headers['connection'], 'close')
+
+    async def test_too_long_header_line_is_rejected(self):
+        await self.start_server()
+        status, _ = await self.request(
+            f"POST {PATH} HTTP/1.1\r\nX-Padding: {'a' * (webhook.MAX_HEADER_LINE + 1)}\r\nContent-Length: 0\r\n")
+        self.assertEqual(status, 431)
+
+    async def test_too_many_headers_are_rejected(self):
+        await self.start_server()
+        padding = ''.join(f"X-Header-{i}: {i}\r\n" for i in range(webhook.MAX_HEADERS + 1))
+        status, _ = await self.request(f"POST {PATH} HTTP/1.1\r\n{padding}Content-Length: 0\r\n")
+        self.assertEqual(status, 431)
+
+    async def test_chunked_body_requires_length(self):
+        await self.start_server()
+        status, _ = await self.request(
+            f"POST {PATH} HTTP/1.1\r\nTransfer-Encoding: chunked\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n", b'0\r\n\r\n')
+        self.assertEqual(status, 411)
+
+    async def test_full_queue_answers_503_with_retry_after(self):
+        await self.start_server(max_pending=2)
+        updates = load_updates()
+        statuses = []
+        for update in updates[:3]:
+            status, headers = await self.post(update)
+            statuses.append(status)
+        self.assertEqual(statuses, [200, 200, 503])
+        self.assertEqual(headers['retry-after'], str(webhook.RETRY_AFTER))
+        self.assertEqual(self.dispatched(), [update['update_id'] for update in updates[:2]])
+        self.assertEqual(self.server.stats['rejected'], 1)
+        # Очередь освободилась — Telegram повторяет доставку, и обновление принимается
+        status, _ = await self.post(updates[2])
+        self.assertEqual(status, 200)
+        self.assertEqual(self.dispatched(), [updates[2]['update_id']])
+
+
+if __name__ == '__main__':
+    unittest.main()
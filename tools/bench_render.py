@@ -0,0 +1,78 @@
+"""
+Бенчмарк сборки карточек статуса (rendering.py).
+
+Меряет:
+  - экранирование MarkdownV2: регулярное выражение, собираемое на каждый вызов
+    (как было в main.py), против таблицы str.translate;
+  - время сборки полной карточки каждого статуса, короткой карточки кандидата
+    и поста для канала.
+
+Запуск из корня репозитория:
+    python tools/bench_render.py [--number 20000]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import rendering  # noqa: E402
+
+PROFILE = {
+    'username': 'some_user.name',
+    'user_id': 123456789,
+    'first_name': 'Иван (Vanya)',
+    'last_name': 'Петров-Водкин',
+    'all_usernames': 'some_user.name,old_name_1,old-name-2',
+    'date_created': 'Dec 2013',
+    'search_count': 42,
+    'note': 'Кинул на 5.000р. [пруфы] в канале! #scam',
+    'proof_url': 'https://t.me/loneasproofs/123',
+}
+
+
+def regex_escape(text):
+    """Экранирование в том виде, в каком оно было в main.py."""
+    if not text:
+        return ""
+    escape_chars = r'_*[]()~`>#+-=|{}.!'
+    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', str(text))
+
+
+def report(name, seconds, number):
+    print(f"{name:<36} {seconds / number * 1e6:8.2f} мкс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000, help='повторов на каждый замер')
+    args = parser.parse_args()
+    number = args.number
+
+    text = PROFILE['note']
+    assert regex_escape(text) == rendering.escape_markdown_v2(text)
+    print(f"Повторов: {number}\n")
+    print("Экранирование одной строки:")
+    report("  re.sub (старое)", timeit.timeit(lambda: regex_escape(text), number=number), number)
+    report("  str.translate", timeit.timeit(lambda: rendering.escape_markdown_v2(text), number=number), number)
+
+    print("\nКарточка целиком:")
+    for kind, template in rendering.STATUS_TEMPLATES.items():
+        note = PROFILE['note'] if kind != rendering.UNKNOWN else None
+        proof_url = PROFILE['proof_url'] if kind == rendering.SCAMMER else None
+        seconds = timeit.timeit(lambda: template.render(
+            PROFILE['username'], PROFILE['user_id'], PROFILE['first_name'], PROFILE['last_name'],
+            PROFILE['all_usernames'], PROFILE['date_created'], PROFILE['search_count'], note, proof_url),
+            number=number)
+        report(f"  {kind}", seconds, number)
+    template = rendering.STATUS_TEMPLATES[rendering.SCAMMER]
+    report("  кандидат автодополнения", timeit.timeit(
+        lambda: template.render_short(PROFILE['username'], PROFILE['user_id']), number=number), number)
+    report("  пост в канал", timeit.timeit(lambda: template.render_channel_post(
+        PROFILE['username'], PROFILE['user_id'], PROFILE['note'], PROFILE['proof_url']), number=number), number)
+
+
+if __name__ == '__main__':
+    main()
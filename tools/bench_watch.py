@@ -0,0 +1,89 @@
+"""
+Бенчмарк отслеживания файлов запросов юзербота: опрос директории против inotify.
+
+Для каждого режима меряет:
+  - нагрузку на CPU в простое (процессорное время за секунду ожидания без запросов);
+  - задержку подхвата файла: от закрытия файла запроса до момента, когда наблюдатель его вернул.
+
+Запуск из корня репозитория:
+    python tools/bench_watch.py [--samples 100] [--idle 5]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fswatch  # noqa: E402
+
+PREFIX = 'ubreq_'
+SUFFIX = '.txt'
+POLL_INTERVAL = 0.1  # как CHECK_INTERVAL в userbot.py
+
+
+async def measure_idle_cpu(watcher, seconds):
+    waiter = asyncio.ensure_future(watcher.get())
+    cpu_start = time.process_time()
+    await asyncio.sleep(seconds)
+    cpu_used = time.process_time() - cpu_start
+    waiter.cancel()
+    return cpu_used / seconds
+
+
+async def measure_pickup(watcher, directory, samples):
+    written = {}
+
+    def writer():
+        for i in range(samples):
+            time.sleep(random.uniform(0.02, 0.2))
+            path = os.path.join(directory, f"{PREFIX}{i}{SUFFIX}")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(f"@user{i}\nubresp_{i}.json")
+            written[path] = time.perf_counter()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    # Время подхвата запоминаем отдельно: событие может прийти раньше, чем писатель сохранит своё время
+    picked = {}
+    while len(picked) < samples:
+        files = await watcher.get()
+        now = time.perf_counter()
+        for path in files:
+            picked.setdefault(path, now)
+            os.remove(path)
+    thread.join()
+    return [picked[path] - written[path] for path in written]
+
+
+async def run_mode(use_inotify, samples, idle_seconds):
+    with tempfile.TemporaryDirectory() as directory:
+        watcher = await fswatch.create_watcher(directory, PREFIX, SUFFIX, POLL_INTERVAL, use_inotify=use_inotify)
+        try:
+            idle_cpu = await measure_idle_cpu(watcher, idle_seconds)
+            latencies = await measure_pickup(watcher, directory, samples)
+        finally:
+            watcher.close()
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{watcher.mode:<8} | CPU в простое: {idle_cpu * 100:6.3f}% | "
+          f"задержка подхвата: медиана {statistics.median(latencies) * 1000:7.2f} мс, "
+          f"p95 {p95 * 1000:7.2f} мс, макс {latencies[-1] * 1000:7.2f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--samples', type=int, default=100, help="количество файлов запросов на режим")
+    parser.add_argument('--idle', type=float, default=5.0, help="секунд простоя для замера CPU")
+    args = parser.parse_args()
+    asyncio.run(run_mode(False, args.samples, args.idle))
+    asyncio.run(run_mode(True, args.samples, args.idle))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Проверка вебхука: отправляет записанные обновления Telegram POST-запросами.
+
+Без --url поднимает webhook.WebhookServer локально с очередью --max-pending и
+медленным обработчиком (--handle-ms на обновление), чтобы увидеть 503 при
+переполнении очереди. С --url шлёт обновления запущенному боту (main.py в режиме
+вебхука) — тот обработает их как настоящие.
+
+Запуск из корня репозитория:
+    python tools/post_updates.py [--updates tools/sample_updates.json] [--repeat 50]
+    python tools/post_updates.py --url http://127.0.0.1:8443/<secret_path> --secret <secret_token>
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import webhook  # noqa: E402
+
+LOCAL_PATH = '/local-test'
+LOCAL_SECRET = 'local-test-secret'
+
+
+def load_updates(path):
+    """Обновления из JSON-массива или JSONL (по одному обновлению на строку)."""
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+async def post_all(url, secret, updates):
+    """Отправляет обновления по одному keep-alive соединению, возвращает [(статус, секунды)]."""
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    results = []
+    try:
+        for update in updates:
+            body = json.dumps(update, ensure_ascii=False).encode('utf-8')
+            head = (f"POST {parts.path or '/'} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n")
+            if secret:
+                head += f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+            started = time.perf_counter()
+            writer.write((head + '\r\n').encode('latin-1') + body)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            while (await reader.readline()) not in (b'\r\n', b''):
+                pass
+            results.append((status, time.perf_counter() - started))
+    finally:
+        writer.close()
+    return results
+
+
+async def run_local(updates, max_pending, handle_ms):
+    queue = asyncio.Queue(maxsize=max_pending)
+    handled = []
+
+    def accept(data):
+        try:
+            queue.put_nowait(data)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def consumer():
+        while True:
+            data = await queue.get()
+            await asyncio.sleep(handle_ms / 1000)
+            handled.append(data['update_id'])
+
+    server = webhook.WebhookServer(accept, LOCAL_PATH, LOCAL_SECRET)
+    port = await server.start('127.0.0.1', 0)
+    consumer_task = asyncio.create_task(consumer())
+    try:
+        results = await post_all(f"http://127.0.0.1:{port}{LOCAL_PATH}", LOCAL_SECRET, updates)
+        # Неверный токен должен отклоняться
+        forbidden = await post_all(f"http://127.0.0.1:{port}{LOCAL_PATH}", 'wrong', updates[:1])
+        while len(handled) < server.stats['accepted']:
+            await asyncio.sleep(handle_ms / 1000)
+    finally:
+        consumer_task.cancel()
+        await server.stop()
+    report(results)
+    print(f"неверный токен: HTTP {forbidden[0][0]}; обработано: {len(handled)}; сервер: {server.stats}")
+
+
+def report(results):
+    statuses = Counter(status for status, _ in results)
+    latencies = sorted(seconds for _, seconds in results)
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    print(f"отправлено {len(results)}: " + ", ".join(f"HTTP {s} × {n}" for s, n in sorted(statuses.items())))
+    print(f"время ответа: медиана {statistics.median(latencies) * 1000:.2f} мс, "
+          f"p95 {p95 * 1000:.2f} мс, макс {latencies[-1] * 1000:.2f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--updates', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_updates.json'),
+                        help="файл с записанными обновлениями (JSON-массив или JSONL)")
+    parser.add_argument('--repeat', type=int, default=50, help="сколько раз отправить набор обновлений")
+    parser.add_argument('--url', help="адрес вебхука запущенного бота (без него — локальный сервер)")
+    parser.add_argument('--secret', default='', help="secret_token из config.json (для --url)")
+    parser.add_argument('--max-pending', type=int, default=20, help="размер очереди локального сервера")
+    parser.add_argument('--handle-ms', type=float, default=5.0, help="время обработки обновления локально, мс")
+    args = parser.parse_args()
+    updates = load_updates(args.updates)
+    # Каждое повторение получает свой update_id, как при настоящей доставке
+    batch = [dict(update, update_id=update['update_id'] + i * len(updates))
+             for i in range(args.repeat) for update in updates]
+    if args.url:
+        report(asyncio.run(post_all(args.url, args.secret, batch)))
+    else:
+        asyncio.run(run_local(batch, args.max_pending, args.handle_ms))
+
+
+if __name__ == '__main__':
+    main()
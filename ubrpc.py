@@ -0,0 +1,207 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import time
+import uuid
+
+# === RPC МЕЖДУ main.py И userbot.py ===
+# Кадр: 4 байта длины (big-endian) + JSON в UTF-8.
+# Запрос:  {"id": "...", "method": "resolve", "query": "@username", "deadline": <unix time>}
+# Ответ:   {"id": "...", "result": {...}}
+# По одному соединению идёт сколько угодно запросов одновременно, ответы сопоставляются по id.
+DEFAULT_SOCKET_PATH = 'userbot.sock'
+DEFAULT_TCP_HOST = '127.0.0.1'
+DEFAULT_TCP_PORT = 47615
+CONNECT_TIMEOUT = 1.0  # секунд
+MAX_FRAME_SIZE = 1024 * 1024  # 1 МБ
+
+_HEADER = struct.Struct('>I')
+
+logger = logging.getLogger(__name__)
+
+
+class RpcUnavailable(ConnectionError):
+    """Юзербот не слушает сокет или соединение оборвалось до получения ответа."""
+
+
+def address_from_config(ipc_config, base_dir='.'):
+    """
+    Возвращает адрес RPC: ('unix', path) или ('tcp', (host, port)).
+    Unix-сокет используется везде, где он поддерживается, иначе — localhost TCP.
+    """
+    ipc_config = ipc_config or {}
+    if hasattr(socket, 'AF_UNIX') and sys.platform != 'win32' and not ipc_config.get('tcp'):
+        path = ipc_config.get('socket_path', DEFAULT_SOCKET_PATH)
+        return 'unix', os.path.join(base_dir, path)
+    host = ipc_config.get('tcp_host', DEFAULT_TCP_HOST)
+    port = int(ipc_config.get('tcp_port', DEFAULT_TCP_PORT))
+    return 'tcp', (host, port)
+
+
+def encode_frame(message):
+    data = json.dumps(message, ensure_ascii=False).encode('utf-8')
+    if len(data) > MAX_FRAME_SIZE:
+        raise ValueError(f"Слишком большой кадр: {len(data)} байт")
+    return _HEADER.pack(len(data)) + data
+
+
+def _decode_length(header):
+    (length,) = _HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Слишком большой кадр: {length} байт")
+    return length
+
+
+async def read_frame_async(reader):
+    length = _decode_length(await reader.readexactly(_HEADER.size))
+    return json.loads((await reader.readexactly(length)).decode('utf-8'))
+
+
+# === КЛИЕНТ (main.py, asyncio) ===
+class RpcClient:
+    """
+    Клиент для event loop бота: одно постоянное соединение, одновременные запросы
+    мультиплексируются по id, ответы разбирает задача-читатель.
+    """
+
+    def __init__(self, address):
+        self._address = address
+        self._connect_lock = asyncio.Lock()
+        self._writer = None
+        self._reader = None  # задача-читатель текущего соединения
+        self._pending = {}  # id -> (Future, writer соединения, в которое ушёл запрос)
+
+    async def _connect(self):
+        family, addr = self._address
+        try:
+            if family == 'unix':
+                connecting = asyncio.open_unix_connection(addr)
+            else:
+                connecting = asyncio.open_connection(*addr)
+            reader, writer = await asyncio.wait_for(connecting, CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise RpcUnavailable(f"не удалось подключиться к {addr}: {e}")
+        self._writer = writer
+        self._reader = asyncio.create_task(self._read_loop(reader, writer))
+        logger.info(f"[RPC] Подключено к юзерботу: {addr}")
+        return writer
+
+    def _reset(self, writer, reason):
+        if self._writer is not writer:
+            return
+        self._writer = None
+        writer.close()
+        # Все запросы, отправленные в это соединение, ответа уже не получат
+        for future, future_writer in list(self._pending.values()):
+            if future_writer is writer and not future.done():
+                future.set_exception(RpcUnavailable(reason))
+        logger.warning(f"[RPC] Соединение с юзерботом сброшено: {reason}")
+
+    async def _read_loop(self, reader, writer):
+        reason = "соединение закрыто"
+        try:
+            while True:
+                message = await read_frame_async(reader)
+                entry = self._pending.get(message.get('id'))
+                if entry is not None and not entry[0].done():
+                    entry[0].set_result(message.get('result'))
+        except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+            reason = str(e) or reason
+        finally:
+            self._reset(writer, reason)
+
+    async def call(self, method, timeout, grace=0, **params):
+        """
+        Выполняет запрос со сроком timeout секунд и ждёт ответ не дольше timeout + grace:
+        за grace юзербот успевает сам ответить deadline_exceeded на просроченный запрос.
+        RpcUnavailable — юзербот недоступен по сокету, TimeoutError — ответ не успел.
+        """
+        request_id = uuid.uuid4().hex
+        message = dict(params, id=request_id, method=method, deadline=time.time() + timeout)
+        future = asyncio.get_running_loop().create_future()
+        try:
+            async with self._connect_lock:
+                writer = self._writer or await self._connect()
+            self._pending[request_id] = (future, writer)
+            try:
+                writer.write(encode_frame(message))
+                await writer.drain()
+            except OSError as e:
+                self._reset(writer, str(e))
+                raise RpcUnavailable(f"ошибка отправки: {e}")
+            try:
+                return await asyncio.wait_for(future, timeout + grace)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"нет ответа от юзербота за {timeout + grace} с")
+        finally:
+            self._pending.pop(request_id, None)
+
+    def close(self):
+        if self._writer is not None:
+            self._reset(self._writer, "клиент закрыт")
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+
+
+# === СЕРВЕР (userbot.py, asyncio) ===
+async def serve(handler, address):
+    """
+    Запускает RPC-сервер. handler(request: dict) -> dict вызывается для каждого запроса
+    в отдельной задаче; просроченные по deadline запросы не выполняются.
+    """
+
+    async def process(message, writer, write_lock):
+        request_id = message.get('id')
+        remaining = message.get('deadline', float('inf')) - time.time()
+        if remaining <= 0:
+            logger.info(f"[RPC] Запрос {request_id} просрочен до начала обработки, пропускаем.")
+            result = {'error': 'deadline_exceeded'}
+        else:
+            try:
+                result = await asyncio.wait_for(handler(message), remaining)
+            except asyncio.TimeoutError:
+                logger.warning(f"[RPC] Запрос {request_id} не уложился в deadline.")
+                result = {'error': 'deadline_exceeded'}
+            except Exception as e:
+                logger.error(f"[RPC] Ошибка обработки запроса {request_id}: {e}", exc_info=True)
+                result = {'error': f"Критическая ошибка обработки в юзерботе: {type(e).__name__}: {e}"}
+        if writer.is_closing():
+            return
+        try:
+            async with write_lock:
+                writer.write(encode_frame({'id': request_id, 'result': result}))
+                await writer.drain()
+        except ConnectionError as e:
+            logger.debug(f"[RPC] Не удалось отправить ответ {request_id}: {e}")
+
+    async def on_connection(reader, writer):
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                message = await read_frame_async(reader)
+                task = asyncio.create_task(process(message, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError as e:
+            logger.error(f"[RPC] Некорректный кадр, закрываем соединение: {e}")
+        finally:
+            writer.close()
+
+    family, addr = address
+    if family == 'unix':
+        if os.path.exists(addr):
+            os.remove(addr)  # Сокет от предыдущего запуска
+        server = await asyncio.start_unix_server(on_connection, path=addr)
+        os.chmod(addr, 0o600)
+    else:
+        server = await asyncio.start_server(on_connection, host=addr[0], port=addr[1])
+    logger.info(f"[RPC] Сервер слушает {addr}")
+    return server
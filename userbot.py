@@ -7,18 +7,26 @@ from telethon.errors import (
     UsernameInvalidError, PeerIdInvalidError, FloodWaitError,
     PhoneNumberInvalidError, PhoneCodeInvalidError, SessionPasswordNeededError,
     AuthKeyUnregisteredError, UserDeactivatedError, AuthKeyDuplicatedError,
-    FirstNameInvalidError
+    FirstNameInvalidError, UsernameNotOccupiedError
     # LastNameInvalidError - УДАЛЕН, так как не существует в этой версии Telethon
 )
 import logging
 import json
 import time
 import os
+import sys
 import asyncio
 import glob
+import heapq
+import itertools
 import traceback
 from datetime import datetime
 import glob
+import ubrpc
+import fswatch
+import jobstore
+import health
+import storage
 CONFIG_FILE = 'config.json'
 
 def load_settings():
@@ -32,10 +40,12 @@ def load_settings():
         raise ValueError(f"Ошибка чтения {CONFIG_FILE}: {e}")
 
     # Присваиваем значения глобальным переменным
-    global API_ID, API_HASH, PHONE
+    global API_ID, API_HASH, PHONE, IPC_CONFIG
     API_ID = config['userbot']['api_id']
     API_HASH = config['userbot']['api_hash']
     PHONE = config['userbot']['phone']
+    # Обмен с main.py: "socket" (RPC + файлы) или "file" (только файлы)
+    IPC_CONFIG = config['userbot'].get('ipc', {})
 
 # Загружаем настройки при импорте модуля
 load_settings()
@@ -44,8 +54,32 @@ UB_REQUEST_PREFIX = "ubreq_"
 UB_RESPONSE_PREFIX = "ubresp_"
 # Папка для файлов (по умолчанию текущая директория)
 COMMUNICATION_DIR = "."
-CHECK_INTERVAL = 0.1 # Минимальная задержка для снижения нагрузки на CPU
+CHECK_INTERVAL = 0.1 # Интервал опроса директории, если inotify недоступен
 MAX_CONCURRENT_TASKS = 500 # Максимальное количество одновременных задач обработки
+FILE_WORKERS = 32 # Постоянные обработчики файловых запросов (медленный запрос занимает только один из них)
+JOB_RECLAIM_INTERVAL = 5 # Секунд между проверками брошенных заданий в журнале (jobstore)
+# Адаптивное ограничение вызовов get_entity (ResolveUsername): корзина токенов + AIMD.
+# На FloodWait скорость и параллельность уменьшаются вдвое, после серии успехов растут обратно.
+RESOLVE_RATE = 2.0 # Начальная скорость, вызовов в секунду
+RESOLVE_RATE_MIN = 0.2
+RESOLVE_RATE_MAX = 10.0
+RESOLVE_RATE_STEP = 0.2 # Прибавка скорости после серии успехов
+RESOLVE_BURST = 5 # Ёмкость корзины токенов
+RESOLVE_CONCURRENCY = 8 # Начальное число одновременных вызовов
+RESOLVE_CONCURRENCY_MIN = 1
+RESOLVE_CONCURRENCY_MAX = 32
+RESOLVE_INCREASE_EVERY = 20 # Успехов подряд для увеличения скорости и параллельности
+FLOOD_WAIT_MAX_PARK = 60 # Дольше этого (секунд) запросы не ждут окончания FloodWait, а получают ошибку
+# Классы приоритета запросов и их смещение в секундах. Очереди (файлы запросов и ожидание
+# ограничителя) упорядочены по «время поступления + смещение», поэтому фоновый запрос,
+# прождавший дольше своего смещения, всё же обгонит свежие интерактивные — без голодания.
+PRIORITY_OFFSETS = {
+    'inline': 0, # inline-запросы: у Telegram короткий срок ответа
+    'pm': 2, # /check и проверка в личке
+    'admin': 5, # добавление в базу администратором
+    'background': 60, # автообновление профилей, посты канала
+}
+DEFAULT_PRIORITY = 'pm'
 
 client = TelegramClient(os.path.join(COMMUNICATION_DIR, 'userbot_session'), API_ID, API_HASH)
 
@@ -62,22 +96,204 @@ logger = logging.getLogger(__name__)
 
 # Семафор для ограничения количества одновременных задач
 semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
+# Файлы запросов, которые уже стоят в очереди или обрабатываются
+in_flight_files = set()
+# Совмещение одинаковых запросов: нормализованный запрос -> [задача get_user_info, число ожидающих, ResolveTicket]
+in_flight_resolves = {}
+coalesce_stats = {'upstream': 0, 'coalesced': 0, 'expired': 0, 'escalated': 0}
+_priority_seq = itertools.count()
 
-async def get_user_info(username_or_id):
+
+def priority_key(priority):
+    """Ключ сортировки запроса класса priority, поступившего сейчас (меньше — раньше)."""
+    if priority not in PRIORITY_OFFSETS:
+        priority = DEFAULT_PRIORITY
+    return time.monotonic() + PRIORITY_OFFSETS[priority], next(_priority_seq), priority
+
+
+class ResolveTicket:
+    """
+    Место вызова get_entity в очереди ограничителя. Совмещённый запрос более
+    строгого класса повышает приоритет уже идущего вызова (escalate), а не ждёт
+    его на приоритете первого запроса.
+    """
+
+    def __init__(self, priority=DEFAULT_PRIORITY):
+        self.arrived = time.monotonic()
+        self.seq = next(_priority_seq)
+        self.priority = priority if priority in PRIORITY_OFFSETS else DEFAULT_PRIORITY
+
+    def key(self):
+        return self.arrived + PRIORITY_OFFSETS[self.priority], self.seq
+
+    def __lt__(self, other):
+        return self.key() < other.key()
+
+    def escalate(self, priority):
+        """Повышает класс до priority, если он строже текущего. True — приоритет изменился."""
+        if priority in PRIORITY_OFFSETS and PRIORITY_OFFSETS[priority] < PRIORITY_OFFSETS[self.priority]:
+            self.priority = priority
+            return True
+        return False
+
+
+class FloodParkedError(Exception):
+    """Аккаунт в FloodWait дольше FLOOD_WAIT_MAX_PARK — запрос не ждёт, а сразу получает ошибку."""
+
+    def __init__(self, seconds):
+        super().__init__(f"Flood wait: {seconds} секунд")
+        self.seconds = seconds
+
+
+class AdaptiveLimiter:
+    """
+    Ограничитель вызовов к Telegram: корзина токенов задаёт скорость, счётчик
+    активных вызовов — параллельность. FloodWait глобально «паркует» все вызовы
+    на e.seconds и вдвое уменьшает оба предела (AIMD), каждые
+    RESOLVE_INCREASE_EVERY успехов подряд они аддитивно растут обратно.
+    Ожидающие получают разрешение в порядке priority_key.
+    """
+
+    def __init__(self):
+        self.rate = RESOLVE_RATE
+        self.concurrency = RESOLVE_CONCURRENCY
+        self._tokens = RESOLVE_BURST
+        self._refilled_at = time.monotonic()
+        self._parked_until = 0.0
+        self._active = 0
+        self._waiters = [] # куча ResolveTicket
+        self._successes = 0
+        self._cond = asyncio.Condition()
+
+    def _refill(self, now):
+        self._tokens = min(RESOLVE_BURST, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    async def acquire(self, priority=DEFAULT_PRIORITY):
+        """
+        Ждёт разрешения на вызов; priority — класс или ResolveTicket.
+        FloodParkedError — если FloodWait продлится дольше FLOOD_WAIT_MAX_PARK.
+        """
+        entry = priority if isinstance(priority, ResolveTicket) else ResolveTicket(priority)
+        async with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._parked_until > now:
+                        wait = self._parked_until - now
+                        if wait > FLOOD_WAIT_MAX_PARK:
+                            raise FloodParkedError(int(wait) + 1)
+                    elif self._waiters[0] is not entry or self._active >= self.concurrency:
+                        wait = None # Ждём своей очереди или освобождения слота
+                    elif self._tokens >= 1:
+                        self._tokens -= 1
+                        self._active += 1
+                        return
+                    else:
+                        wait = (1 - self._tokens) / self.rate
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                # Уходим из очереди (получив разрешение, по ошибке или отмене) — следующий проверяет свою очередь
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    async def reprioritize(self):
+        """Пересобирает очередь после ResolveTicket.escalate и будит ожидающих."""
+        async with self._cond:
+            heapq.heapify(self._waiters)
+            self._cond.notify_all()
+
+    async def release(self, flood_seconds=None):
+        """Освобождает слот; flood_seconds — вызов завершился FloodWait на столько секунд."""
+        async with self._cond:
+            self._active -= 1
+            if flood_seconds is not None:
+                self._parked_until = max(self._parked_until, time.monotonic() + flood_seconds)
+                self._tokens = 0
+                self._successes = 0
+                self.rate = max(RESOLVE_RATE_MIN, self.rate / 2)
+                self.concurrency = max(RESOLVE_CONCURRENCY_MIN, self.concurrency // 2)
+                logger.warning(f"[UB] FloodWait {flood_seconds} с: запросы приостановлены, "
+                               f"скорость {self.rate:.2f}/с, параллельность {self.concurrency}.")
+            else:
+                self._successes += 1
+                if self._successes >= RESOLVE_INCREASE_EVERY:
+                    self._successes = 0
+                    if self.rate < RESOLVE_RATE_MAX or self.concurrency < RESOLVE_CONCURRENCY_MAX:
+                        self.rate = min(RESOLVE_RATE_MAX, self.rate + RESOLVE_RATE_STEP)
+                        self.concurrency = min(RESOLVE_CONCURRENCY_MAX, self.concurrency + 1)
+                        logger.info(f"[UB] Лимит вызовов увеличен: скорость {self.rate:.2f}/с, "
+                                    f"параллельность {self.concurrency}.")
+            self._cond.notify_all()
+
+    def stats(self):
+        """Текущее состояние ограничителя."""
+        return {
+            'rate': round(self.rate, 2),
+            'concurrency': self.concurrency,
+            'active': self._active,
+            'waiting': {priority: sum(1 for entry in self._waiters if entry.priority == priority)
+                        for priority in PRIORITY_OFFSETS},
+            'parked_for': max(0, round(self._parked_until - time.monotonic(), 1)),
+        }
+
+
+resolve_limiter = AdaptiveLimiter()
+
+
+async def limited_get_entity(username_or_id, priority=DEFAULT_PRIORITY):
+    """
+    client.get_entity через resolve_limiter; на FloodWait ждёт его окончания и повторяет вызов.
+    priority — класс или ResolveTicket (одно место в очереди на все повторы).
+    """
+    if not isinstance(priority, ResolveTicket):
+        priority = ResolveTicket(priority)
+    while True:
+        await resolve_limiter.acquire(priority)
+        try:
+            entity = await client.get_entity(username_or_id)
+        except FloodWaitError as e:
+            await resolve_limiter.release(flood_seconds=e.seconds)
+            if e.seconds > FLOOD_WAIT_MAX_PARK:
+                raise
+            logger.info(f"[UB] '{username_or_id}' ждёт окончания FloodWait ({e.seconds} с) для повтора.")
+            continue
+        except BaseException:
+            await resolve_limiter.release()
+            raise
+        await resolve_limiter.release()
+        return entity
+
+def parse_entity_query(username_or_id):
+    """Запрос по ID приходит как "id123456" (или просто число) — get_entity нужен int."""
+    if isinstance(username_or_id, str):
+        digits = username_or_id[2:] if username_or_id.lower().startswith('id') else username_or_id
+        if digits.isdigit():
+            return int(digits)
+    return username_or_id
+
+async def get_user_info(username_or_id, priority=DEFAULT_PRIORITY):
     """Получает информацию о пользователе."""
+    username_or_id = parse_entity_query(username_or_id)
     try:
         # Проверка на пустой или слишком короткий запрос
         if not username_or_id or (isinstance(username_or_id, str) and len(username_or_id.lstrip('@')) < 4):
              logger.warning(f"Запрос слишком короткий или пустой: '{username_or_id}'. Пропускаем.")
-             return {'error': 'Запрос слишком короткий или пустой.'}
+             return {'error': 'Запрос слишком короткий или пустой.', 'error_type': 'invalid'}
 
         logger.info(f"Попытка получить информацию для: {username_or_id}")
-        entity = await client.get_entity(username_or_id)
+        entity = await limited_get_entity(username_or_id, priority)
         
         # Проверяем, является ли сущность пользователем
         if not isinstance(entity, User):
             logger.warning(f"Найденная сущность '{username_or_id}' не является пользователем (тип: {type(entity).__name__}). Пропускаем.")
-            return {'error': f'Сущность "{username_or_id}" не является пользователем.'}
+            return {'error': f'Сущность "{username_or_id}" не является пользователем.', 'error_type': 'not_user'}
 
         # Получаем дату создания аккаунта (для пользователей это обычно дата регистрации)
         # У объекта User нет прямого атрибута date. Возможно, имелось в виду другое?
@@ -113,20 +329,76 @@ async def get_user_info(username_or_id):
 
     except UsernameInvalidError:
         logger.error(f"Недопустимое имя пользователя или ID: {username_or_id}")
-        return {'error': f'Недопустимое имя пользователя или ID: {username_or_id}'}
+        return {'error': f'Недопустимое имя пользователя или ID: {username_or_id}', 'error_type': 'invalid'}
     except PeerIdInvalidError:
         logger.error(f"Недопустимый ID пользователя: {username_or_id}")
-        return {'error': f'Недопустимый ID пользователя: {username_or_id}'}
-    except FloodWaitError as e:
+        return {'error': f'Недопустимый ID пользователя: {username_or_id}', 'error_type': 'invalid'}
+    except UsernameNotOccupiedError as e:
+        logger.warning(f"Пользователь не найден: {username_or_id} ({e})")
+        return {'error': f'Пользователь не найден: {username_or_id}', 'error_type': 'not_found'}
+    except ValueError as e:
+        # get_entity бросает ValueError и для ID, которого нет в кэше сущностей сессии:
+        # пользователь может существовать, поэтому это не not_found (main.py такое не кэширует)
+        logger.warning(f"Не удалось найти сущность: {username_or_id} ({e})")
+        return {'error': f'Не удалось найти пользователя: {username_or_id}', 'error_type': 'unresolved'}
+    except (FloodWaitError, FloodParkedError) as e:
+        # Короткие FloodWait limited_get_entity пережидает сам, сюда доходят только длинные
         logger.error(f"Flood wait for {e.seconds} seconds.")
-        # Можно сразу повторить запрос, но для простоты просто возвращаем ошибку
-        # return await get_user_info(username_or_id) # <<< Вариант с повтором
-        return {'error': f'Flood wait: {e.seconds} секунд.'}
+        return {'error': f'Flood wait: {e.seconds} секунд.', 'error_type': 'flood_wait', 'retry_after': e.seconds}
     except Exception as e:
         logger.error(f"Неожиданная ошибка при получении информации для {username_or_id}: {e}", exc_info=True)
         return {'error': f'Произошла ошибка: {e}'}
 
 
+async def get_user_info_shared(query, priority=DEFAULT_PRIORITY):
+    """
+    get_user_info с совмещением: одновременные запросы одного юзернейма/ID
+    ждут один вызов к Telegram. Вызов идёт с самым строгим классом из ожидающих,
+    а срок у каждого ожидающего свой (см. get_user_info_until). Отмена одного
+    ожидающего (например, по deadline) не отменяет сам вызов, пока его результат
+    ждёт кто-то ещё.
+    """
+    key = query.strip().lstrip('@').lower()
+    entry = in_flight_resolves.get(key)
+    if entry is None:
+        coalesce_stats['upstream'] += 1
+        ticket = ResolveTicket(priority)
+        entry = [asyncio.ensure_future(get_user_info(query, ticket)), 0, ticket]
+        in_flight_resolves[key] = entry
+        entry[0].add_done_callback(lambda _: in_flight_resolves.pop(key, None) if in_flight_resolves.get(key) is entry else None)
+    else:
+        coalesce_stats['coalesced'] += 1
+        logger.info(f"[UB] Запрос '{query}' уже выполняется, ждём его результат "
+                    f"(сэкономлено вызовов: {coalesce_stats['coalesced']}).")
+    task = entry[0]
+    entry[1] += 1
+    try:
+        if entry[2].escalate(priority):
+            coalesce_stats['escalated'] += 1
+            logger.info(f"[UB] Приоритет запроса '{query}' повышен до '{priority}'.")
+            await resolve_limiter.reprioritize()
+        return await asyncio.shield(task)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and not task.done():
+            # Результат больше никому не нужен — не тратим на него вызов к Telegram
+            in_flight_resolves.pop(key, None)
+            task.cancel()
+            coalesce_stats['expired'] += 1
+            logger.info(f"[UB] Запрос '{query}' больше никто не ждёт, отменяем.")
+
+
+async def get_user_info_until(query, priority, deadline):
+    """get_user_info_shared с ограничением по сроку (unix time); после него — {'error': 'deadline_exceeded'}."""
+    remaining = deadline - time.time() if deadline else None
+    if remaining is not None and remaining <= 0:
+        return {'error': 'deadline_exceeded'}
+    try:
+        return await asyncio.wait_for(get_user_info_shared(query, priority), remaining)
+    except asyncio.TimeoutError:
+        return {'error': 'deadline_exceeded'}
+
+
 async def process_single_request_file(filepath):
     """Обрабатывает один файл запроса."""
     async with semaphore: # Ограничиваем количество одновременных задач
@@ -154,6 +426,11 @@ async def process_single_request_file(filepath):
 
             query = lines[0].strip()
             expected_response_filename = lines[1].strip() # Относительное имя файла ответа
+            priority = lines[2].strip() if len(lines) > 2 else DEFAULT_PRIORITY # Необязательный класс приоритета
+            try:
+                deadline = float(lines[3]) if len(lines) > 3 else None # Необязательный срок (unix time)
+            except ValueError:
+                deadline = None
 
             # Проверяем, что expected_response_filename находится в рабочей директории
             # и имеет правильный префикс, чтобы избежать записи куда-то не туда
@@ -179,6 +456,16 @@ async def process_single_request_file(filepath):
 
             logger.info(f"[UB] Запрос UUID {request_uuid}: '{query}', Ответ ожидается в: {full_expected_response_path}")
 
+            # Берём задание в аренду до удаления файла: если юзербот упадёт, задание останется в журнале
+            job_state = await storage.run(jobstore.lease, request_uuid)
+            if job_state in ('done', 'busy'):
+                logger.info(f"[UB] Запрос UUID {request_uuid} уже {'выполнен' if job_state == 'done' else 'в работе'}, пропускаем.")
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+                return
+
             # Удаляем файл запроса сразу после чтения и валидации
             try:
                 os.remove(filepath)
@@ -197,8 +484,17 @@ async def process_single_request_file(filepath):
                 return
                     
             # Получаем информацию (это ваша существующая функция)
-            info = await get_user_info(query) # <<< Убедитесь, что эта функция существует
-            
+            info = await get_user_info_until(query, priority, deadline)
+            if info.get('error') == 'deadline_exceeded':
+                # main.py уже не ждёт ответ — файл ответа не пишем, иначе он так и останется в директории
+                logger.info(f"[UB] Срок запроса UUID {request_uuid} ('{query}') истёк, ответ не записываем.")
+                if job_state == 'leased':
+                    await storage.run(jobstore.complete, request_uuid, info)
+                return
+            if job_state == 'leased' and not await storage.run(jobstore.is_open, request_uuid):
+                logger.info(f"[UB] Запрос UUID {request_uuid} уже выполнен другим обработчиком.")
+                return
+
             # Записываем ответ в указанный файл
             response_data = json.dumps(info, ensure_ascii=False, indent=2)
             # Используем 'x' режим, чтобы упасть, если файл уже существует (что маловероятно, но на всякий случай)
@@ -206,6 +502,8 @@ async def process_single_request_file(filepath):
                 f.write(response_data)
             
             logger.info(f"[UB] Ответ для запроса UUID {request_uuid} ('{query}') записан в {full_expected_response_path}")
+            if job_state == 'leased':
+                await storage.run(jobstore.complete, request_uuid, info)
 
         except FileNotFoundError:
             # Файл мог быть удален другой задачей или процессом
@@ -236,44 +534,177 @@ async def process_single_request_file(filepath):
 
 
 
+async def resolve_query(query, priority=DEFAULT_PRIORITY, deadline=None):
+    """Обрабатывает запрос от main.py (по RPC или во встроенном режиме)."""
+    query = (query or '').strip()
+    if not query:
+        return {"error": "Пустой запрос"}
+    async with semaphore: # Общий лимит с обработкой файлов
+        return await get_user_info_until(query, priority, deadline)
+
+
+async def handle_rpc_request(request):
+    """Обрабатывает запрос, пришедший по RPC-сокету от main.py."""
+    method = request.get('method')
+    if method == 'stats':
+        return {'limiter': resolve_limiter.stats(), 'coalesce': dict(coalesce_stats)}
+    if method != 'resolve':
+        logger.error(f"[UB] Неизвестный RPC-метод: {method}")
+        return {"error": f"Неизвестный метод: {method}"}
+    logger.info(f"[UB] RPC-запрос {request.get('id')}: '{request.get('query')}'")
+    return await resolve_query(request.get('query'), request.get('priority', DEFAULT_PRIORITY), request.get('deadline'))
+
+
+async def process_job(job_id, query, priority, response_file, deadline):
+    """Выполняет задание из журнала, файл запроса которого уже удалён (продолжение после перезапуска)."""
+    logger.info(f"[UB] Продолжаем брошенное задание {job_id}: '{query}'")
+    try:
+        info = await resolve_query(query, priority, deadline)
+        if info.get('error') == 'deadline_exceeded':
+            logger.info(f"[UB] Срок задания {job_id} истёк, ответ не записываем.")
+            await storage.run(jobstore.complete, job_id, info)
+            return
+    except Exception as e:
+        logger.error(f"[UB] Ошибка выполнения задания {job_id}: {e}", exc_info=True)
+        info = {"error": f"Критическая ошибка обработки в юзерботе: {type(e).__name__}: {e}"}
+    if not await storage.run(jobstore.is_open, job_id):
+        return # Задание уже выполнено другим обработчиком или main.py перестал его ждать
+    # Сначала файл ответа, потом отметка в журнале (см. jobstore.py)
+    if response_file and response_file.startswith(UB_RESPONSE_PREFIX) and os.path.basename(response_file) == response_file:
+        try:
+            with open(os.path.join(COMMUNICATION_DIR, response_file), 'x', encoding='utf-8') as f:
+                f.write(json.dumps(info, ensure_ascii=False, indent=2))
+            logger.info(f"[UB] Ответ на задание {job_id} записан в {response_file}")
+        except FileExistsError:
+            pass
+        except OSError as e:
+            logger.warning(f"[UB] Не удалось записать ответ на задание {job_id}: {e}. main.py возьмёт его из журнала.")
+    await storage.run(jobstore.complete, job_id, info)
+
+
+def request_file_exists(job_id):
+    """Файл запроса задания ещё на диске — его возьмёт обработчик файлов в порядке приоритета."""
+    return os.path.exists(os.path.join(COMMUNICATION_DIR, f"{UB_REQUEST_PREFIX}{job_id}.txt"))
+
+
+async def resume_jobs_loop():
+    """
+    При старте продолжает задания, взятые прежним процессом юзербота, затем раз в
+    JOB_RECLAIM_INTERVAL подбирает задания с истёкшей арендой и чистит журнал.
+    """
+    orphaned_only = True
+    tasks = set()
+    while True:
+        try:
+            jobs = await storage.run(jobstore.claim_abandoned, orphaned_only=orphaned_only,
+                                     request_file_exists=request_file_exists)
+            if jobs:
+                logger.info(f"[UB] Брошенных заданий в журнале: {len(jobs)}, продолжаем.")
+            for job in jobs:
+                task = asyncio.create_task(process_job(*job))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if not orphaned_only:
+                await storage.run(jobstore.purge)
+            orphaned_only = False
+        except Exception as e:
+            logger.error(f"[UB] Ошибка проверки журнала заданий: {e}", exc_info=True)
+        await asyncio.sleep(JOB_RECLAIM_INTERVAL)
+
+
+async def heartbeat_loop(request_queue):
+    """Раз в health.HEARTBEAT_INTERVAL сообщает main.py, что юзербот жив и авторизован."""
+    while True:
+        try:
+            authorized = client.is_connected() and await client.is_user_authorized()
+            limiter = resolve_limiter.stats()
+            queue_depth = request_queue.qsize() + sum(limiter['waiting'].values()) + limiter['active']
+            await storage.run(health.publish_heartbeat, authorized, queue_depth, {'limiter': limiter})
+        except Exception as e:
+            logger.error(f"[UB] Не удалось записать heartbeat: {e}")
+        await asyncio.sleep(health.HEARTBEAT_INTERVAL)
+
+
+def read_request_priority(filepath):
+    """Класс приоритета из третьей строки файла запроса (в старом формате её нет)."""
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            lines = f.read().strip().splitlines()
+    except OSError:
+        return DEFAULT_PRIORITY
+    return lines[2].strip() if len(lines) > 2 else DEFAULT_PRIORITY
+
+
+async def feed_request_files(watcher, request_queue):
+    """
+    Передаёт новые файлы запросов от наблюдателя в очередь с приоритетом,
+    пропуская уже взятые в работу.
+    """
+    while True:
+        try:
+            request_files = await watcher.get()
+        except Exception as e:
+            logger.error(f"[UB] Ошибка отслеживания файлов запросов: {e}", exc_info=True)
+            await asyncio.sleep(CHECK_INTERVAL)
+            continue
+        new_files = [filepath for filepath in request_files if filepath not in in_flight_files]
+        if new_files:
+            logger.info(f"[UB] Найдено {len(new_files)} новых файлов запросов, в работе: {len(in_flight_files)}.")
+        for filepath in new_files:
+            in_flight_files.add(filepath)
+            request_queue.put_nowait((priority_key(read_request_priority(filepath)), filepath))
+
+
+async def request_file_worker(request_queue):
+    """Постоянный обработчик: берёт файлы из очереди по одному, не дожидаясь остальных."""
+    while True:
+        _, filepath = await request_queue.get()
+        try:
+            await process_single_request_file(filepath)
+        except Exception as e:
+            logger.error(f"[UB] Задача обработки {filepath} завершилась с ошибкой: {e}", exc_info=True)
+        finally:
+            in_flight_files.discard(filepath)
+            request_queue.task_done()
+
+
 async def main_loop():
     """Главная функция цикла юзербота."""
     await client.start(phone=PHONE) # <<< Убедитесь, что client, PHONE определены
     logger.info("[UB] Юзербот запущен и авторизован.")
     logger.info(f"[UB] Рабочая директория: {os.path.abspath(COMMUNICATION_DIR)}")
 
-    while True:
+    # RPC-сокет для main.py; файловый обмен ниже остаётся как запасной канал
+    rpc_server = None
+    if IPC_CONFIG.get('mode', 'socket') == 'socket':
+        rpc_server = await ubrpc.serve(handle_rpc_request, ubrpc.address_from_config(IPC_CONFIG, COMMUNICATION_DIR))
+
+    # Новые файлы запросов: inotify на Linux, опрос директории в остальных случаях
+    watcher = await fswatch.create_watcher(COMMUNICATION_DIR, UB_REQUEST_PREFIX, '.txt', CHECK_INTERVAL,
+                                           use_inotify=IPC_CONFIG.get('inotify', True))
+    logger.info(f"[UB] Отслеживание файлов запросов: {watcher.mode}")
+
+    await storage.run(jobstore.init_table)
+    await storage.run(health.init_table)
+    request_queue = asyncio.PriorityQueue()
+    workers = [asyncio.create_task(request_file_worker(request_queue)) for _ in range(FILE_WORKERS)]
+    workers.append(asyncio.create_task(resume_jobs_loop()))
+    workers.append(asyncio.create_task(heartbeat_loop(request_queue)))
+    try:
+        await feed_request_files(watcher, request_queue)
+    finally:
+        logger.info(f"[UB] Вызовов get_entity: {coalesce_stats['upstream']}, "
+                    f"совмещено с уже идущими: {coalesce_stats['coalesced']}. "
+                    f"Ограничитель: {resolve_limiter.stats()}")
+        for worker in workers:
+            worker.cancel()
         try:
-            # Ищем все файлы запросов с нужным префиксом
-            request_pattern = os.path.join(COMMUNICATION_DIR, f"{UB_REQUEST_PREFIX}*.txt")
-            request_files = glob.glob(request_pattern)
-            
-            if request_files:
-                logger.info(f"[UB] Найдено {len(request_files)} файлов запросов для обработки.")
-                tasks = []
-                for filepath in request_files:
-                    # Создаем задачу для каждой пары файлов
-                    task = asyncio.create_task(process_single_request_file(filepath))
-                    tasks.append(task)
-                
-                if tasks:
-                    # Ждем завершения всех задач обработки
-                    # return_exceptions=True позволяет продолжить работу, даже если одна задача упала
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
-                    # Можно прологгировать результаты, если нужно
-                    # for i, res in enumerate(results):
-                    #     if isinstance(res, Exception):
-                    #         logger.error(f"[UB] Задача {i} завершилась с ошибкой: {res}")
-            
-            # else:
-            #     logger.debug(f"[UB] Файлы с паттерном {request_pattern} не найдены. Ждем {CHECK_INTERVAL} секунд...")
-            
+            await storage.run(health.mark_stopped)
         except Exception as e:
-            logger.error(f"[UB] Критическая ошибка в главном цикле: {e}", exc_info=True)
-            # Продолжаем цикл даже при критической ошибке
-        
-        # Ждем перед следующей проверкой
-        await asyncio.sleep(CHECK_INTERVAL)
+            logger.warning(f"[UB] Не удалось отметить остановку в heartbeat: {e}")
+        watcher.close()
+        if rpc_server is not None:
+            rpc_server.close()
 
 # Если у вас основная точка входа в функции main(), замените её или вызывайте main_loop из неё
 async def main():
@@ -288,5 +719,15 @@ async def main():
         await client.disconnect() # <<< Убедитесь, что client определен
         logger.info("[UB] Клиент Telegram отключен.")
 
+async def login():
+    """Только авторизация сессии (python userbot.py --login): для встроенного режима, без обработки запросов."""
+    await client.start(phone=PHONE)
+    me = await client.get_me()
+    logger.info(f"[UB] Сессия авторизована: @{me.username or me.id}. Юзербот можно запускать из main.py.")
+    await client.disconnect()
+
 if __name__ == '__main__':
-    client.loop.run_until_complete(main()) # <<< Убедитесь, что client определен
+    if '--login' in sys.argv[1:]:
+        client.loop.run_until_complete(login())
+    else:
+        client.loop.run_until_complete(main()) # <<< Убедитесь, что client определен
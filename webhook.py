@@ -0,0 +1,177 @@
+import asyncio
+import hmac
+import json
+import logging
+import ssl
+
+# === ВЕБХУК: ВСТРОЕННЫЙ HTTP-СЕРВЕР ДЛЯ ОБНОВЛЕНИЙ TELEGRAM ===
+# Telegram присылает каждое обновление POST-запросом на https://<url>/<secret_path>
+# с заголовком X-Telegram-Bot-Api-Secret-Token. Сервер проверяет путь и токен,
+# разбирает JSON и передаёт обновление в accept(data). Если accept вернул False
+# (очередь обновлений бота заполнена), отвечаем 503 — Telegram повторит доставку
+# позже, а бот не набирает в памяти больше, чем успевает обработать.
+DEFAULT_LISTEN = '127.0.0.1'
+DEFAULT_PORT = 8443
+MAX_BODY_SIZE = 1024 * 1024  # 1 МБ: обновления Telegram намного меньше
+MAX_HEADER_LINE = 8 * 1024
+MAX_HEADERS = 100
+IDLE_TIMEOUT = 75  # секунд простоя keep-alive соединения
+READ_TIMEOUT = 10  # секунд на чтение одного запроса
+RETRY_AFTER = 1  # секунд: подсказка Telegram при переполненной очереди
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+_REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+    411: 'Length Required', 413: 'Payload Too Large', 431: 'Request Header Fields Too Large',
+    503: 'Service Unavailable',
+}
+
+logger = logging.getLogger(__name__)
+
+
+class BadRequest(Exception):
+    """Запрос нельзя разобрать; соединение закрывается после ответа status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def url_path(webhook_config):
+    """Путь вебхука: секретная часть URL, по которой Telegram отправляет обновления."""
+    return '/' + (webhook_config.get('secret_path') or '').strip('/')
+
+
+def ssl_context(webhook_config):
+    """SSL-контекст из cert/key конфигурации или None, если TLS завершает nginx."""
+    cert = webhook_config.get('cert')
+    if not cert:
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, webhook_config.get('key') or None)
+    return context
+
+
+class WebhookServer:
+    """HTTP/1.1-сервер для вебхука Telegram с проверкой секрета и ограничением очереди."""
+
+    def __init__(self, accept, path, secret_token=None):
+        self._accept = accept
+        self._path = path
+        self._secret_token = secret_token.encode('utf-8') if secret_token else None
+        self._server = None
+        self.stats = {'accepted': 0, 'rejected': 0, 'forbidden': 0, 'invalid': 0}
+
+    async def start(self, host, port, ssl_ctx=None):
+        """Запускает сервер и возвращает фактический порт (при port=0 его выбирает система)."""
+        self._server = await asyncio.start_server(self._on_connection, host=host, port=port, ssl=ssl_ctx,
+                                                  limit=MAX_HEADER_LINE)
+        logger.info(f"[Webhook] Сервер слушает {host}:{port}{' (TLS)' if ssl_ctx else ''}, путь {self._path[:4]}…")
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _on_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return
+                if not request_line:
+                    return
+                try:
+                    method, target, headers, body = await asyncio.wait_for(
+                        self._read_request(request_line, reader), READ_TIMEOUT)
+                except BadRequest as e:
+                    self.stats['invalid'] += 1
+                    logger.warning(f"[Webhook] Некорректный запрос: {e}")
+                    await self._respond(writer, e.status, keep_alive=False)
+                    return
+                status, extra = self._handle(method, target, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, extra, keep_alive)
+                if not keep_alive:
+                    return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ssl.SSLError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, request_line, reader):
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            raise BadRequest(400, f"строка запроса {request_line[:80]!r}")
+        method, target, _ = parts
+        headers = {}
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                raise BadRequest(431, "слишком длинный заголовок")
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise BadRequest(431, "слишком много заголовков")
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise BadRequest(411, "chunked-тело не поддерживается")
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise BadRequest(400, "некорректный Content-Length")
+        if length < 0 or length > MAX_BODY_SIZE:
+            raise BadRequest(413, f"тело {length} байт")
+        body = await reader.readexactly(length) if length else b''
+        return method, target, headers, body
+
+    def _handle(self, method, target, headers, body):
+        """Возвращает (HTTP-статус, дополнительные заголовки) для одного запроса."""
+        if target.split('?', 1)[0] != self._path:
+            return 404, {}
+        if method != 'POST':
+            return 405, {'Allow': 'POST'}
+        if self._secret_token is not None:
+            received = headers.get(SECRET_HEADER, '').encode('utf-8')
+            if not hmac.compare_digest(received, self._secret_token):
+                self.stats['forbidden'] += 1
+                logger.warning("[Webhook] Запрос с неверным секретным токеном отклонён.")
+                return 403, {}
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError):
+            self.stats['invalid'] += 1
+            return 400, {}
+        if not isinstance(data, dict) or 'update_id' not in data:
+            self.stats['invalid'] += 1
+            return 400, {}
+        try:
+            accepted = self._accept(data)
+        except Exception as e:
+            self.stats['invalid'] += 1
+            logger.error(f"[Webhook] Не удалось принять обновление {data.get('update_id')}: {e}")
+            return 400, {}
+        if not accepted:
+            self.stats['rejected'] += 1
+            if self.stats['rejected'] % 100 == 1:
+                logger.warning(f"[Webhook] Очередь обновлений заполнена, отвечаем 503 "
+                               f"(отклонено всего: {self.stats['rejected']}).")
+            return 503, {'Retry-After': str(RETRY_AFTER)}
+        self.stats['accepted'] += 1
+        return 200, {}
+
+    @staticmethod
+    async def _respond(writer, status, extra=None, keep_alive=True):
+        headers = {'Content-Length': '0', 'Connection': 'keep-alive' if keep_alive else 'close'}
+        headers.update(extra or {})
+        head = f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+        head += ''.join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write((head + '\r\n').encode('latin-1'))
+        await writer.drain()
@@ -0,0 +1,105 @@
+import logging
+import multiprocessing
+import queue
+import zlib
+
+# === НЕСКОЛЬКО ВОРКЕРОВ main.py ===
+# Процесс-распределитель получает обновления Telegram (long polling или вебхук)
+# и раскладывает их по процессам-воркерам через очереди multiprocessing. Каждый
+# воркер — полноценный бот со своим event loop и пулами обработчиков; общая у них
+# только база. Обновления распределяются по хэшу ID пользователя (все обновления
+# одного пользователя, включая шаги диалогов, попадают в один воркер) или по
+# update_id (равномерно, без привязки пользователя к воркеру).
+ROUTE_BY_USER = 'user'
+ROUTE_BY_UPDATE = 'update_id'
+DEFAULT_QUEUE_SIZE = 1000  # обновлений в очереди одного воркера
+STOP_TIMEOUT = 30  # секунд на завершение воркера после сигнала остановки
+
+# Поля обновления, у объекта которых есть отправитель "from"
+_USER_FIELDS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+                'chat_join_request', 'message_reaction')
+_CHAT_FIELDS = ('channel_post', 'edited_channel_post')
+
+logger = logging.getLogger(__name__)
+
+
+def routing_key(update, route_by=ROUTE_BY_USER):
+    """Ключ распределения для обновления в виде JSON-словаря Bot API."""
+    if route_by == ROUTE_BY_USER:
+        for field in _USER_FIELDS:
+            obj = update.get(field)
+            if obj:
+                sender = obj.get('from') or obj.get('user')
+                if sender:
+                    return sender['id']
+        for field in _CHAT_FIELDS:
+            obj = update.get(field)
+            if obj:
+                return obj['chat']['id']
+    return update['update_id']
+
+
+class WorkerPool:
+    """Процессы-воркеры, каждый со своей ограниченной очередью обновлений."""
+
+    def __init__(self, target, count, queue_size=DEFAULT_QUEUE_SIZE, route_by=ROUTE_BY_USER):
+        # spawn: одинаково на Linux и Windows, воркер не наследует потоки распределителя
+        self._context = multiprocessing.get_context('spawn')
+        self._target = target
+        self.route_by = route_by
+        self._queues = [self._context.Queue(queue_size) for _ in range(count)]
+        self._processes = [None] * count
+        self.stats = {'routed': 0, 'rejected': 0, 'restarts': 0}
+
+    def _spawn(self, index):
+        process = self._context.Process(target=self._target, args=(index, self._queues[index]),
+                                        name=f"bot-worker-{index}")
+        process.start()
+        self._processes[index] = process
+        logger.info(f"[Workers] Воркер {index} запущен (pid {process.pid}).")
+
+    def start(self):
+        for index in range(len(self._queues)):
+            self._spawn(index)
+
+    def _queue_for(self, update):
+        key = routing_key(update, self.route_by)
+        # crc32, а не hash(): распределение не должно зависеть от PYTHONHASHSEED
+        return self._queues[zlib.crc32(str(key).encode()) % len(self._queues)]
+
+    def route(self, update):
+        """Кладёт обновление в очередь воркера без ожидания. False — очередь заполнена."""
+        try:
+            self._queue_for(update).put_nowait(update)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            return False
+        self.stats['routed'] += 1
+        return True
+
+    def put(self, update):
+        """Кладёт обновление, ожидая места в очереди (long polling: не забираем новых, пока воркер занят)."""
+        self._queue_for(update).put(update)
+        self.stats['routed'] += 1
+
+    def check(self):
+        """Перезапускает упавших воркеров; их очереди сохраняются, обновления не теряются."""
+        for index, process in enumerate(self._processes):
+            if process is not None and not process.is_alive():
+                logger.error(f"[Workers] Воркер {index} завершился с кодом {process.exitcode}, перезапускаем.")
+                self.stats['restarts'] += 1
+                self._spawn(index)
+
+    def stop(self):
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"[Workers] Воркер {index} не завершился за {STOP_TIMEOUT} с, останавливаем принудительно.")
+                process.terminate()
+                process.join()
+        logger.info(f"[Workers] {self.stats}")